@@ -0,0 +1,227 @@
+"""Administrative requests, served next to the tile requests.
+
+BSD Licensed, Copyright (c) 2006-2010 TileCache Contributors
+
+A data feed announces that a product got new data with a POST to
+``/admin/updated`` carrying ``product`` and, optionally, the ``valid`` time
+(YYYYmmddHHMM) of the new data.  The product is named like the layers
+``Request.getLayer`` resolves, less the trailing time token, for example
+``ridge::USCOMP-N0Q``, ``mrms::a2m``, ``goes::EAST-13`` or a plain layer
+name.  The tiles of the "current" layer are invalidated up to
+``invalidate_zooms`` and re-rendered up to ``warm_zooms``, as are the tiles
+of the archive layer for the valid time, so that the first user after an
+update gets a hit.  Requests must carry the ``admin_token`` from
+``[tilecache_options]`` as a bearer token, without one the endpoint is off.
+
+The same can be done from the command line, in-process::
+
+    python -m TileCache.Admin --config tilecache.cfg updated \\
+        ridge::USCOMP-N0Q 202510191200
+
+or against a running server with ``--url`` and ``--token``.
+
+When the service counts tile popularity, see TileCache.Popularity, a GET of
+``/admin/popular`` lists the most requested tiles as JSON, at most
+``limit`` of them, and a POST renders them again in the background.  The
+counts are those of the worker process answering the request.
+"""
+
+import argparse
+import hmac
+import json
+import sys
+
+import TileCache.Popularity as Popularity
+import TileCache.Pyramid as Pyramid
+from TileCache.Background import log_failure
+from TileCache.base import (
+    MalformedRequestException,
+    Request,
+    TileCacheException,
+    TileCacheLayerNotFoundException,
+    parse_zooms,
+)
+
+
+def product_layers(product, valid=None):
+    """The layer names affected by new data for product at valid."""
+    if "::" not in product:
+        return [product]
+    names = [f"{product}-0"]
+    if valid:
+        names.append(f"{product}-{valid}")
+    return names
+
+
+def refresh(service, layer, warm_zooms, invalidate_zooms):
+    """Drop the cached tiles of layer and render the low zoom ones again.
+
+    Returns how many tiles were rendered and how many were dropped.
+    """
+    rendered = 0
+    dropped = 0
+    for z in sorted(warm_zooms | invalidate_zooms, reverse=True):
+        if z >= len(layer.resolutions):
+            continue
+        for tile in Pyramid.tiles(layer, z):
+            # variants are served ahead of the base tile, drop them either
+            # way, they are transcoded again on demand
+            for variant in layer.variants:
+                service.cache.delete(service.variantTile(tile, variant))
+            if z in warm_zooms:
+                service.renderTile(tile, force=True)
+                rendered += 1
+            else:
+                service.cache.delete(tile)
+                dropped += 1
+    return rendered, dropped
+
+
+def updated(service, product, valid=None):
+    """Resolve the layers touched by an update, raising on bad names."""
+    if valid is not None and (len(valid) != 12 or not valid.isdigit()):
+        raise MalformedRequestException("valid should be YYYYmmddHHMM")
+    req = Request(service)
+    return [req.getLayer(name) for name in product_layers(product, valid)]
+
+
+def zoom_options(service):
+    """The warm and invalidate zoom levels from [tilecache_options]"""
+    options = service.tilecache_options
+    warm = parse_zooms(options.get("warm_zooms", "0-3"))
+    invalidate = parse_zooms(options.get("invalidate_zooms", "0-6"))
+    return warm, invalidate
+
+
+def authorized(service, environ):
+    """Does the request carry the admin token?"""
+    token = service.tilecache_options.get("admin_token")
+    if not token:
+        return False
+    auth = environ.get("HTTP_AUTHORIZATION", "")
+    if not auth.startswith("Bearer "):
+        return False
+    return hmac.compare_digest(auth[7:].encode(), token.encode())
+
+
+def popular(service, params, environ):
+    """List or re-render the most requested tiles"""
+    if service.popularity is None:
+        return "404 File Not Found", "text/plain", b"popularity is off"
+    try:
+        limit = int(params.get("limit", 0)) or None
+    except ValueError:
+        return "400 Bad Request", "text/plain", b"limit should be a number"
+    entries = service.popularity.topk(limit)
+    if environ.get("REQUEST_METHOD") == "POST":
+        future = service.background.submit(
+            ("popular",), Popularity.warm, service, entries
+        )
+        if future is not None:
+            future.add_done_callback(log_failure)
+        status = "202 Accepted"
+    else:
+        status = "200 OK"
+    body = json.dumps(
+        {"tiles": [{"tile": key, "count": count} for key, count in entries]}
+    )
+    return status, "application/json", body.encode("utf-8")
+
+
+def dispatch(service, params, path_info, environ):
+    """Handle an admin request, returning status, content type and body"""
+    if not service.tilecache_options.get("admin_token"):
+        return "404 File Not Found", "text/plain", b"Not Found"
+    if not authorized(service, environ):
+        return "403 Forbidden", "text/plain", b"Forbidden"
+    action = path_info.rstrip("/").rsplit("/", 1)[-1]
+    if action == "popular":
+        return popular(service, params, environ)
+    if action != "updated":
+        return "404 File Not Found", "text/plain", b"Unknown admin action"
+    if environ.get("REQUEST_METHOD") != "POST":
+        return "405 Method Not Allowed", "text/plain", b"POST required"
+    product = params.get("product")
+    if not product:
+        return "400 Bad Request", "text/plain", b"product is required"
+    try:
+        layers = updated(service, product, params.get("valid"))
+    except (
+        MalformedRequestException,
+        TileCacheException,
+        TileCacheLayerNotFoundException,
+    ) as exp:
+        return "400 Bad Request", "text/plain", str(exp).encode("utf-8")
+    warm, invalidate = zoom_options(service)
+    for layer in layers:
+        future = service.background.submit(
+            ("updated", layer.name), refresh, service, layer, warm, invalidate
+        )
+        if future is not None:
+            future.add_done_callback(log_failure)
+    body = json.dumps({"layers": [layer.name for layer in layers]})
+    return "202 Accepted", "application/json", body.encode("utf-8")
+
+
+def main(argv=None):
+    """Command line entry point"""
+    # Service imports this module
+    from TileCache.Service import Service
+
+    parser = argparse.ArgumentParser(description="TileCache administration")
+    target = parser.add_mutually_exclusive_group(required=True)
+    target.add_argument("--config", help="act in-process with this cfg")
+    target.add_argument("--url", help="post to this tilecache URL")
+    parser.add_argument("--token", help="admin token for --url")
+    sub = parser.add_subparsers(dest="action", required=True)
+    upd = sub.add_parser("updated", help="announce new data for a product")
+    upd.add_argument("product")
+    upd.add_argument("valid", nargs="?", help="YYYYmmddHHMM")
+    pop = sub.add_parser("popular", help="list the most requested tiles")
+    pop.add_argument("--limit", type=int, default=0)
+    pop.add_argument(
+        "--warm", action="store_true", help="render them again as well"
+    )
+    args = parser.parse_args(argv)
+    # only the command line talks HTTP, keep it out of the workers
+    import requests
+
+    if args.action == "popular":
+        if not args.url:
+            parser.error("popular needs --url, counts live in the server")
+        resp = requests.request(
+            "POST" if args.warm else "GET",
+            f"{args.url.rstrip('/')}/admin/popular",
+            params={"limit": args.limit},
+            headers={"Authorization": f"Bearer {args.token}"},
+            timeout=60,
+        )
+        if not resp.ok:
+            sys.stdout.write(f"{resp.status_code} {resp.text}\n")
+            return 1
+        for entry in resp.json()["tiles"]:
+            sys.stdout.write(f"{entry['tile']} {entry['count']}\n")
+        return 0
+
+    if args.url:
+        resp = requests.post(
+            f"{args.url.rstrip('/')}/admin/{args.action}",
+            data={"product": args.product, "valid": args.valid},
+            headers={"Authorization": f"Bearer {args.token}"},
+            timeout=60,
+        )
+        sys.stdout.write(f"{resp.status_code} {resp.text}\n")
+        return 0 if resp.ok else 1
+
+    service = Service.load(args.config)
+    warm, invalidate = zoom_options(service)
+    for layer in updated(service, args.product, args.valid):
+        rendered, dropped = refresh(service, layer, warm, invalidate)
+        sys.stdout.write(
+            f"{layer.name}: rendered {rendered}, dropped {dropped}\n"
+        )
+    return 0
+
+
+if __name__ == "__main__":
+    sys.exit(main())
@@ -0,0 +1,84 @@
+"""Run work off the request path.
+
+BSD Licensed, Copyright (c) 2006-2010 TileCache Contributors
+"""
+
+import multiprocessing
+import sys
+import threading
+from concurrent.futures import ProcessPoolExecutor, ThreadPoolExecutor
+
+
+class Background(object):
+    """A bounded thread pool that coalesces work submitted under one key"""
+
+    def __init__(self, workers=4, max_pending=256):
+        """Constructor, threads are only started by the first submit."""
+        self.workers = int(workers)
+        self.max_pending = int(max_pending)
+        self._pending = {}
+        self._lock = threading.Lock()
+        self._executor = None
+
+    def submit(self, key, func, *args):
+        """Run func(*args) in the pool and return its future.
+
+        While work for key is queued or running the same future is
+        returned, and None is returned when the queue is full.
+        """
+        with self._lock:
+            future = self._pending.get(key)
+            if future is not None:
+                return future
+            if len(self._pending) >= self.max_pending:
+                return None
+            if self._executor is None:
+                self._executor = ThreadPoolExecutor(
+                    max_workers=self.workers,
+                    thread_name_prefix="tilecache",
+                )
+            future = self._executor.submit(func, *args)
+            self._pending[key] = future
+        future.add_done_callback(lambda f: self._done(key, f))
+        return future
+
+    def _done(self, key, future):
+        with self._lock:
+            if self._pending.get(key) is future:
+                del self._pending[key]
+
+    def pending(self):
+        """Number of queued or running jobs"""
+        with self._lock:
+            return len(self._pending)
+
+
+class Processes(object):
+    """A process pool for CPU bound work, started on first use"""
+
+    def __init__(self, workers=2):
+        """Constructor"""
+        self.workers = int(workers)
+        self._lock = threading.Lock()
+        self._executor = None
+
+    def run(self, func, *args):
+        """Run func(*args) in a worker process and return its result.
+
+        Workers are spawned rather than forked, this process has threads.
+        """
+        with self._lock:
+            if self._executor is None:
+                self._executor = ProcessPoolExecutor(
+                    max_workers=self.workers,
+                    mp_context=multiprocessing.get_context("spawn"),
+                )
+        return self._executor.submit(func, *args).result()
+
+
+def log_failure(future):
+    """Done callback writing the error of a fire and forget job to stderr"""
+    exp = future.exception()
+    if exp is not None:
+        emsg = str(exp).replace("\n", " ")
+        sys.stderr.write(f"TileCache Background Exception: {emsg}\n")
@@ -0,0 +1,267 @@
+"""Fetch many tiles of a layer in one round trip.
+
+BSD Licensed, Copyright (c) 2006-2010 TileCache Contributors
+
+``/bundle/1.0.0/<layer>/<z>?tiles=x,y;x,y;...`` or
+``/bundle/1.0.0/<layer>/<z>?range=minx,miny,maxx,maxy`` returns the listed
+tiles, numbered like in a regular TMS request, in one response.  The tiles
+are looked up with one batched cache read and the misses are rendered
+concurrently.  By default the body is a sequence of frames::
+
+    "TCB1" count:u32
+    count times: z:u8 x:u32 y:u32 status:u16 length:u32 data
+
+all big endian, where status is the HTTP status the tile would have had
+on its own and data is empty unless it is 200.  With ``format=multipart``
+a multipart/mixed body is returned instead.
+"""
+
+import os
+import struct
+import time
+from concurrent.futures import ThreadPoolExecutor
+
+import TileCache.Timing as Timing
+from TileCache import (
+    BackendWMSFailure,
+    DeadlineExceeded,
+    OutOfBoundsTile,
+    OutOfBoundsZoomLevel,
+    RateLimited,
+)
+from TileCache.base import (
+    MalformedRequestException,
+    TileCacheException,
+    TileCacheFutureException,
+    TileCacheLayerNotFoundException,
+)
+from TileCache.Cache import IMMUTABLE
+from TileCache.Services.TMS import TMS
+
+MAGIC = b"TCB1"
+COUNT = struct.Struct(">I")
+FRAME = struct.Struct(">BIIHI")
+CONTENT_TYPE = "application/x-tilecache-bundle"
+
+
+def check_zoom(zoom):
+    """Raise unless zoom fits in a frame"""
+    if not 0 <= zoom <= 0xFF:
+        raise MalformedRequestException(f"Invalid zoom level {zoom}")
+
+
+def check_index(value):
+    """Raise unless the tile column or row value fits in a frame"""
+    if not 0 <= value <= 0xFFFFFFFF:
+        raise MalformedRequestException(f"Invalid tile index {value}")
+
+
+def parse_tiles(fields):
+    """The (x, y) pairs asked for by the tiles or range parameter"""
+    try:
+        if fields.get("tiles"):
+            pairs = []
+            for token in fields["tiles"].split(";"):
+                if token:
+                    (x, y) = token.split(",")
+                    pairs.append((int(x), int(y)))
+            for x, y in pairs:
+                check_index(x)
+                check_index(y)
+            return pairs
+        if fields.get("range"):
+            (minx, miny, maxx, maxy) = map(int, fields["range"].split(","))
+            for value in (minx, miny, maxx, maxy):
+                check_index(value)
+            return [
+                (x, y)
+                for y in range(miny, maxy + 1)
+                for x in range(minx, maxx + 1)
+            ]
+    except ValueError as exp:
+        raise MalformedRequestException(f"Invalid tile list: {exp}") from exp
+    raise MalformedRequestException("Either tiles or range is required.")
+
+
+def status_of(exp):
+    """The HTTP status a failed tile would have had on its own"""
+    if isinstance(exp, (OutOfBoundsTile, OutOfBoundsZoomLevel)):
+        return 422
+    if isinstance(exp, (TileCacheException, TileCacheLayerNotFoundException)):
+        return 404
+    if isinstance(exp, DeadlineExceeded):
+        return 504
+    if isinstance(exp, RateLimited):
+        return 429
+    if isinstance(exp, (BackendWMSFailure, TileCacheFutureException)):
+        return 503
+    return 500
+
+
+def prefetch(service, tiles):
+    """The (status, data) pairs of the tiles needing no render, in order,
+    with None for the others.
+
+    Entries of tiles may be exceptions, carried over as their status.
+    The cached tiles come from one batched read.
+    """
+    results = [None] * len(tiles)
+    lookup = []
+    for idx, tile in enumerate(tiles):
+        if isinstance(tile, Exception):
+            results[idx] = (status_of(tile), b"")
+        elif not tile.layer.inDataExtent(tile) and tile.layer.blankTile():
+            results[idx] = serve(service, tile)
+        else:
+            lookup.append(idx)
+    with Timing.stage("cache"):
+        datas = service.cache.get_many([tiles[idx] for idx in lookup])
+    for idx, data in zip(lookup, datas, strict=True):
+        if data:
+            results[idx] = serve(service, tiles[idx], data)
+    return results
+
+
+def iter_many(service, tiles, workers=8, results=None):
+    """Return an iterator of (status, data) pairs for each tile, in order.
+
+    The tiles missing from the results of prefetch, which is called
+    unless they are given, are submitted to at most workers threads
+    before this returns, so that the iterator only waits on renders.
+    Every tile goes through ``Service.renderTile`` like a single tile
+    request would.  Renders that did not start yet are dropped when the
+    iterator is closed early.
+    """
+    if results is None:
+        results = prefetch(service, tiles)
+    misses = [idx for idx, result in enumerate(results) if result is None]
+    if not misses:
+        return iter(results)
+    pool = ThreadPoolExecutor(max_workers=min(workers, len(misses)))
+    run = Timing.carry(serve)
+    futures = {idx: pool.submit(run, service, tiles[idx]) for idx in misses}
+    return _collect(results, futures, pool)
+
+
+def cache_control(tiles, results):
+    """The Cache-Control of many tiles, set by the least cacheable one.
+
+    Failed or pending tiles must not be kept, None means the default.
+    """
+    if any(result is None or result[0] != 200 for result in results):
+        return "no-store"
+    for tile in tiles:
+        for name, value in tile.headers:
+            if name == "Cache-Control" and value != IMMUTABLE:
+                return value
+    if tiles and all(tile.layer.immutable for tile in tiles):
+        return IMMUTABLE
+    return None
+
+
+def serve(service, tile, cached=None):
+    """The (status, data) pair of one tile"""
+    try:
+        return (200, service.renderTile(tile, cached=cached)[1])
+    except Exception as exp:
+        return (status_of(exp), b"")
+
+
+def _collect(results, futures, pool):
+    try:
+        for idx, result in enumerate(results):
+            future = futures.get(idx)
+            if future is not None:
+                result = future.result()
+            yield result
+    finally:
+        pool.shutdown(wait=False, cancel_futures=True)
+
+
+def render_many(service, tiles, workers=8):
+    """Return a (status, data) pair for each tile, in order."""
+    return list(iter_many(service, tiles, workers))
+
+
+def as_bytes(data):
+    """Caches may hand out views of mapped files, WSGI wants bytes"""
+    if isinstance(data, memoryview):
+        return data.tobytes()
+    return data
+
+
+def encode_frames(entries, count):
+    """The framed body for count (z, x, y, status, data) entries"""
+    yield MAGIC + COUNT.pack(count)
+    for z, x, y, status, data in entries:
+        yield FRAME.pack(z, x, y, status, len(data))
+        if data:
+            yield as_bytes(data)
+
+
+def encode_multipart(entries, layer, boundary):
+    """The multipart/mixed body for (z, x, y, status, data) entries"""
+    for z, x, y, status, data in entries:
+        yield (
+            f"--{boundary}\r\n"
+            f"Content-Type: {layer.mime_type}\r\n"
+            f"Content-Location: /1.0.0/{layer.name}/{z}/{x}/{y}."
+            f"{layer.extension}\r\n"
+            f"X-Tile-Status: {status}\r\n"
+            f"Content-Length: {len(data)}\r\n\r\n"
+        ).encode("ascii")
+        yield as_bytes(data)
+        yield b"\r\n"
+    yield f"--{boundary}--\r\n".encode("ascii")
+
+
+def encode(fields, layer, entries):
+    """Pick the body encoding, returns the content type and the body"""
+    if fields.get("format") == "multipart":
+        boundary = os.urandom(12).hex()
+        return (
+            f"multipart/mixed; boundary={boundary}",
+            encode_multipart(entries, layer, boundary),
+        )
+    return CONTENT_TYPE, encode_frames(entries, len(entries))
+
+
+def dispatch(service, fields, path_info, headers=None, client=None):
+    """Handle a /bundle/ request, returns the content type and body"""
+    start = time.monotonic()
+    parts = [p for p in path_info.split("/") if p]
+    if len(parts) != 4:
+        raise MalformedRequestException(
+            "Bundle requests look like /bundle/1.0.0/<layer>/<z>"
+        )
+    try:
+        zoom = int(parts[3])
+    except ValueError as exp:
+        msg = f"Invalid, non-integer value provided: {exp}"
+        raise MalformedRequestException(msg) from exp
+    check_zoom(zoom)
+    pairs = parse_tiles(fields)
+    limit = int(service.tilecache_options.get("bundle_max_tiles", 64))
+    if len(pairs) > limit:
+        raise MalformedRequestException(f"At most {limit} tiles per bundle.")
+    tms = TMS(service)
+    layer = tms.getLayer(parts[2])
+    tiles = []
+    for x, y in pairs:
+        try:
+            tile = tms.makeTile(fields, layer, zoom, x, y)
+            tile.client = client
+            tiles.append(service.setDeadline(tile, "bundle_deadline", start))
+        except (OutOfBoundsTile, OutOfBoundsZoomLevel) as exp:
+            tiles.append(exp)
+    workers = int(service.tilecache_options.get("bundle_workers", 8))
+    results = render_many(service, tiles, workers)
+    entries = [
+        (zoom, x, y, status, data)
+        for (x, y), (status, data) in zip(pairs, results, strict=True)
+    ]
+    control = cache_control(tiles, results)
+    if headers is not None and control is not None:
+        headers.append(("Cache-Control", control))
+    (fmt, body) = encode(fields, layer, entries)
+    return fmt, b"".join(body)
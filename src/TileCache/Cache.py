@@ -1,6 +1,19 @@
 """BSD Licensed, Copyright (c) 2006-2010 TileCache Contributors"""
 
 YESVALS = ["yes", "y", "t", "true"]
+# Cache-Control for tiles that will never change
+IMMUTABLE = "public, max-age=31536000, immutable"
+
+
+def parse_size(value) -> int:
+    """Convert a size like ``256M`` into a number of bytes."""
+    if isinstance(value, int):
+        return value
+    value = value.strip().upper()
+    for suffix, factor in (("K", 1 << 10), ("M", 1 << 20), ("G", 1 << 30)):
+        if value.endswith(suffix):
+            return int(float(value[:-1]) * factor)
+    return int(value)
 
 
 class Cache:
@@ -12,21 +25,40 @@ class Cache:
         stale_interval=300.0,
         expire=False,
         sendfile=False,
+        immutable_timeout=0,
         **kwargs,
     ):
         """Constructor"""
         self.stale = float(stale_interval)
         self.timeout = float(timeout)
+        self.immutable_timeout = float(immutable_timeout)
         self.expire = expire
         self.sendfile = sendfile and sendfile.lower() in YESVALS
         if expire is not False:
             self.expire = float(expire)
 
+    def ttl(self, tile):
+        """Seconds to keep this tile, 0 meaning for as long as possible"""
+        if tile.layer.immutable:
+            return self.immutable_timeout
+        return self.timeout
+
     def getKey(self, tile):
-        raise NotImplementedError()
+        """Get the key for this tile, a variant gets a key of its own"""
+        key = "/".join(map(str, [tile.layer.name, tile.x, tile.y, tile.z]))
+        if tile.variant:
+            key += "." + tile.variant
+        return key
 
     def get(self, tile):
         raise NotImplementedError()
 
+    def get_many(self, tiles):
+        """Get the cache data for several tiles, in the order given"""
+        return [self.get(tile) for tile in tiles]
+
     def set(self, tile, data):
         raise NotImplementedError()
+
+    def delete(self, tile):
+        raise NotImplementedError()
@@ -1,40 +1,438 @@
 """Memcached Caching Provider
 BSD Licensed, Copyright (c) 2006-2010 TileCache Contributors
+
+Tiles larger than ``chunk_size`` are split over several chunk keys, written
+before a small manifest stored under the tile key.  The manifest carries a
+random nonce naming this write's chunks, their count, the tile length and
+a digest, so a reader never mixes chunks of two writes and treats missing
+or corrupt chunks as a miss.
+
+With ``persistent_path`` every write is also queued for a SQLite file, by
+a writer thread so the response never waits on the disk.  Writes are
+dropped when more than ``persistent_queue`` are waiting.  A memcached miss
+is looked up there, and a hit is copied back to memcached, which refills
+an emptied memcached from disk instead of from the backend.
 """
 
+import base64
+import bisect
+import hashlib
+import os
+import queue
+import random
+import struct
+import sys
+import threading
+import time
+
 # Important to use a thread-safe pool as mod_wsgi is running this in threads
 from pymemcache.client.hash import HashClient
+from pymemcache.client.rendezvous import RendezvousHash
+from pymemcache.exceptions import MemcacheError
+
+from TileCache.base import TileCacheException, parse_zooms
+from TileCache.Cache import YESVALS, Cache, parse_size
+from TileCache.Caches.SQLite import SQLite
+
+# magic, nonce, chunk count, tile length, tile digest
+MANIFEST = struct.Struct(">4s8sIQ16s")
+MANIFEST_MAGIC = b"TCCH"
+# returned by HashClient for a call it skipped on a failing server
+SKIPPED = object()
+
+
+class Rendezvous(RendezvousHash):
+    """Rendezvous (HRW) hashing that can also rank several nodes"""
+
+    def get_nodes(self, key, count):
+        """The count highest scoring nodes for key, best first"""
+        scored = sorted(
+            self.nodes,
+            key=lambda node: (self.hash_function(f"{node}-{key}"), str(node)),
+            reverse=True,
+        )
+        return scored[:count]
+
+
+class Ketama(object):
+    """Ketama style consistent hashing over a ring of virtual points"""
+
+    points_per_node = 160
+
+    def __init__(self, nodes=None):
+        """Constructor"""
+        self.nodes = []
+        self._ring = []
+        self._owners = {}
+        for node in nodes or []:
+            self.add_node(node)
 
-from TileCache.Cache import Cache
+    @staticmethod
+    def _points(value):
+        """The four ring points found in the md5 digest of value"""
+        digest = hashlib.md5(value.encode("utf-8")).digest()
+        return [
+            int.from_bytes(digest[i : i + 4], "little") for i in (0, 4, 8, 12)
+        ]
+
+    def add_node(self, node):
+        if node in self.nodes:
+            return
+        self.nodes.append(node)
+        for i in range(self.points_per_node // 4):
+            for point in self._points(f"{node}-{i}"):
+                self._owners[point] = node
+        self._ring = sorted(self._owners)
+
+    def remove_node(self, node):
+        if node not in self.nodes:
+            raise ValueError("No such node %s to remove" % (node))
+        self.nodes.remove(node)
+        self._owners = {p: n for p, n in self._owners.items() if n != node}
+        self._ring = sorted(self._owners)
+
+    def get_nodes(self, key, count):
+        """The first count distinct nodes found walking the ring from key"""
+        if not self._ring:
+            return []
+        found = []
+        start = bisect.bisect(self._ring, self._points(key)[0])
+        for i in range(len(self._ring)):
+            node = self._owners[self._ring[(start + i) % len(self._ring)]]
+            if node not in found:
+                found.append(node)
+                if len(found) == count:
+                    break
+        return found
+
+    def get_node(self, key):
+        nodes = self.get_nodes(key, 1)
+        return nodes[0] if nodes else None
+
+
+HASHERS = {"rendezvous": Rendezvous, "ketama": Ketama}
 
 
 class Memcached(Cache):
     """Implements a cache"""
 
-    def __init__(self, servers="127.0.0.1:11211", **kwargs):
+    def __init__(
+        self,
+        servers="127.0.0.1:11211",
+        hashing="rendezvous",
+        short_keys="",
+        hot_zooms="",
+        replicas=2,
+        connect_timeout=1,
+        socket_timeout=2,
+        chunk_size="1000K",
+        persistent_path=None,
+        persistent_queue=1000,
+        **kwargs,
+    ):
         """Constructor"""
         Cache.__init__(self, **kwargs)
         if isinstance(servers, str):
             servers = [s.strip() for s in servers.split(",")]
-        self.cache = HashClient(servers, use_pooling=True)
+        if hashing not in HASHERS:
+            raise TileCacheException(f"Unknown memcached hashing {hashing}")
+        # Without socket timeouts a dead node holds a request forever,
+        # these bound every call since pymemcache has no per call timeout.
+        self.cache = HashClient(
+            servers,
+            hasher=HASHERS[hashing],
+            use_pooling=True,
+            connect_timeout=float(connect_timeout),
+            timeout=float(socket_timeout),
+        )
         self.timeout = int(kwargs.get("timeout", 0))
+        self.short_keys = short_keys.lower() in YESVALS
+        self.hot_zooms = parse_zooms(hot_zooms)
+        self.replicas = min(int(replicas), len(self.cache.clients))
+        # memcached refuses items over 1M by default, key and flags included
+        self.chunk_size = parse_size(chunk_size)
+        # HashClient drops dead nodes from its own hasher, the replica
+        # placement needs to stay put, so it gets a hasher of its own.
+        self.hasher = HASHERS[hashing](list(self.cache.clients))
+        self.persistent = None
+        if persistent_path:
+            self.persistent = SQLite(path=persistent_path)
+        self.queue = queue.Queue(maxsize=int(persistent_queue))
+        self.dropped = 0
+        self._writer = None
+        self._writer_lock = threading.Lock()
 
     def getKey(self, tile):
         """Get the key for this tile"""
-        return "/".join(map(str, [tile.layer.name, tile.x, tile.y, tile.z]))
+        key = Cache.getKey(self, tile)
+        if self.short_keys:
+            digest = hashlib.blake2b(key.encode("utf-8"), digest_size=15)
+            key = base64.urlsafe_b64encode(digest.digest()).decode("ascii")
+        return key
+
+    def replicated(self, tile):
+        """Is this tile stored on several nodes?"""
+        return self.replicas > 1 and tile.z in self.hot_zooms
+
+    def _replica_clients(self, key):
+        """The clients of the replicas of key, less those HashClient holds
+        dead, which it brings back after its dead_timeout.
+        """
+        self.cache._retry_dead()
+        clients = [
+            self.cache.clients[node]
+            for node in self.hasher.get_nodes(key, self.replicas)
+        ]
+        return [c for c in clients if c.server not in self.cache._dead_clients]
+
+    def _replica_call(self, client, method, *args):
+        """Call a replica through the failure tracking of HashClient, a
+        node failing its socket is marked and then skipped until its
+        retry_timeout, instead of holding every call for socket_timeout.
+        """
+        result = self.cache._safely_run_func(
+            client, getattr(client, method), SKIPPED, *args
+        )
+        if result is SKIPPED:
+            raise MemcacheError(f"Skipping failed server {client.server}")
+        return result
+
+    def _replica_get(self, key):
+        """Read from the replicas in random order, failing over on errors"""
+        clients = self._replica_clients(key)
+        random.shuffle(clients)
+        for client in clients:
+            try:
+                data = self._replica_call(client, "get", key)
+            except Exception:
+                continue
+            if data is not None:
+                return data
+        return None
+
+    def _replica_set(self, key, data, ttl):
+        """Write to every replica, failing only if none took the write"""
+        error = MemcacheError("All replica servers seem to be down")
+        stored = False
+        for client in self._replica_clients(key):
+            try:
+                self._replica_call(client, "set", key, data, ttl)
+                stored = True
+            except Exception as exp:
+                error = exp
+        if not stored:
+            raise error
+
+    @staticmethod
+    def digest(data):
+        """The digest of a chunked tile"""
+        return hashlib.blake2b(data, digest_size=16).digest()
+
+    @staticmethod
+    def chunkKeys(key, nonce, count):
+        """The keys of the chunks of one write of key"""
+        return [f"{key}/{nonce.hex()}/{i}" for i in range(count)]
+
+    def unchunk(self, manifests, replicated=False):
+        """Reassemble the data of {key: manifest}, dropping broken ones
+
+        The chunks of replicated tiles are read with failover as well.
+        """
+        parsed = {}
+        wanted = []
+        for key, manifest in manifests.items():
+            (_magic, nonce, count, length, digest) = MANIFEST.unpack(manifest)
+            keys = self.chunkKeys(key, nonce, count)
+            parsed[key] = (keys, length, digest)
+            wanted.extend(keys)
+        try:
+            if replicated:
+                found = {k: self._replica_get(k) for k in wanted}
+            else:
+                found = self.cache.get_many(wanted)
+        except Exception:
+            # Yes, we are silently ignoring errors here.
+            found = {}
+        datas = {}
+        for key, (keys, length, digest) in parsed.items():
+            chunks = [found.get(k) for k in keys]
+            if any(chunk is None for chunk in chunks):
+                continue
+            data = b"".join(chunks)
+            if len(data) == length and self.digest(data) == digest:
+                datas[key] = data
+        return datas
+
+    @staticmethod
+    def isManifest(data):
+        """Is the value stored under a tile key a chunk manifest?"""
+        return (
+            data is not None
+            and len(data) == MANIFEST.size
+            and data[:4] == MANIFEST_MAGIC
+        )
 
     def get(self, tile):
         """Get the cache data"""
         key = self.getKey(tile)
         try:
-            tile.data = self.cache.get(key)
+            if self.replicated(tile):
+                tile.data = self._replica_get(key)
+            else:
+                tile.data = self.cache.get(key)
         except Exception:
             # Yes, we are silently ignoring errors here.
             tile.data = None
+        if self.isManifest(tile.data):
+            replicated = self.replicated(tile)
+            tile.data = self.unchunk({key: tile.data}, replicated).get(key)
+        if tile.data is None and self.persistent is not None:
+            tile.data = self.rehydrate({key: [tile]}).get(key)
         return tile.data
 
+    def get_many(self, tiles):
+        """Get the cache data for several tiles with one batched read"""
+        keys = {}
+        for tile in tiles:
+            if self.replicated(tile):
+                self.get(tile)
+            else:
+                keys.setdefault(self.getKey(tile), []).append(tile)
+        try:
+            found = self.cache.get_many(list(keys)) if keys else {}
+        except Exception:
+            # Yes, we are silently ignoring errors here.
+            found = {}
+        manifests = {k: v for k, v in found.items() if self.isManifest(v)}
+        if manifests:
+            found.update(dict.fromkeys(manifests))
+            found.update(self.unchunk(manifests))
+        if self.persistent is not None:
+            missing = {k: v for k, v in keys.items() if found.get(k) is None}
+            if missing:
+                found.update(self.rehydrate(missing))
+        for key, same in keys.items():
+            for tile in same:
+                tile.data = found.get(key)
+        return [tile.data for tile in tiles]
+
+    def rehydrate(self, missing):
+        """Read {key: [tiles]} missed by memcached from the persistent tier,
+        copying what is found back into memcached.
+        """
+        try:
+            found = self.persistent.getMany(list(missing))
+        except Exception as exp:
+            sys.stderr.write(f"TileCache persistent read failed: {exp}\n")
+            return {}
+        now = time.time()
+        datas = {}
+        for key, (data, expires) in found.items():
+            ttl = max(1, int(expires - now)) if expires else 0
+            try:
+                self.store(missing[key][0], key, data, ttl)
+            except Exception:
+                # Yes, we are silently ignoring errors here.
+                pass
+            datas[key] = data
+        return datas
+
+    def chunk(self, key, data, ttl, replicated=False):
+        """Store the chunks of data, returns the manifest or None
+
+        The chunks of a replicated tile go to every replica, so that it
+        survives the loss of a node like a small tile does.
+        """
+        nonce = os.urandom(8)
+        count = -(-len(data) // self.chunk_size)
+        chunks = {
+            ckey: data[i * self.chunk_size : (i + 1) * self.chunk_size]
+            for i, ckey in enumerate(self.chunkKeys(key, nonce, count))
+        }
+        if replicated:
+            for ckey, part in chunks.items():
+                self._replica_set(ckey, part, ttl)
+        elif self.cache.set_many(chunks, ttl, noreply=False):
+            return None
+        return MANIFEST.pack(
+            MANIFEST_MAGIC, nonce, count, len(data), self.digest(data)
+        )
+
+    def store(self, tile, key, data, ttl):
+        """Write data to memcached, chunked when it is large"""
+        value = data
+        if len(data) > self.chunk_size:
+            value = self.chunk(key, data, ttl, self.replicated(tile))
+            if value is None:
+                return
+        if self.replicated(tile):
+            self._replica_set(key, value, ttl)
+        else:
+            self.cache.set(key, value, ttl)
+
     def set(self, tile, data):
         """Set the cache data"""
         key = self.getKey(tile)
-        self.cache.set(key, data, self.timeout)
+        ttl = int(self.ttl(tile))
+        if self.persistent is not None:
+            expires = time.time() + ttl if ttl else 0.0
+            self.writeBehind((key, data, expires))
+        self.store(tile, key, data, ttl)
         return data
+
+    def writeBehind(self, item, block=False):
+        """Queue a (key, data, expires) write for the persistent tier"""
+        if self._writer is None:
+            with self._writer_lock:
+                if self._writer is None:
+                    self._writer = threading.Thread(
+                        target=self._drain,
+                        name="tilecache-write-behind",
+                        daemon=True,
+                    )
+                    self._writer.start()
+        try:
+            self.queue.put(item, block=block)
+        except queue.Full:
+            self.dropped += 1
+
+    def _drain(self):
+        while True:
+            items = [self.queue.get()]
+            while len(items) < 100:
+                try:
+                    items.append(self.queue.get_nowait())
+                except queue.Empty:
+                    break
+            try:
+                self.persistent.write(items)
+            except Exception as exp:
+                sys.stderr.write(f"TileCache persistent write failed: {exp}\n")
+            finally:
+                for _item in items:
+                    self.queue.task_done()
+
+    def flush(self):
+        """Wait for the queued persistent writes"""
+        if self._writer is not None:
+            self.queue.join()
+
+    def delete(self, tile):
+        """Remove the cache data"""
+        key = self.getKey(tile)
+        if self.persistent is not None:
+            # after any queued write of the same key
+            self.writeBehind((key, None, 0.0), block=True)
+        try:
+            if self.replicated(tile):
+                for client in self._replica_clients(key):
+                    try:
+                        self._replica_call(client, "delete", key)
+                    except Exception:
+                        # the replica left behind expires with its ttl
+                        continue
+            else:
+                self.cache.delete(key)
+        except Exception:
+            # Yes, we are silently ignoring errors here.
+            pass
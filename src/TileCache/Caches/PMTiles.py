@@ -0,0 +1,393 @@
+"""PMTiles Archive Caching Provider
+BSD Licensed, Copyright (c) 2006-2010 TileCache Contributors
+
+Serves frozen tile pyramids, one PMTiles version 3 archive per layer, found
+by substituting the layer name into ``path``, for example
+``/data/archives/{layer}.pmtiles``.  Archives are memory mapped, the
+directories are decoded once and kept in a small LRU, and a tile comes
+back as a ``memoryview`` slice of the mapping, so the tile bytes are only
+copied when handed to the WSGI server.  The cache is read-only, ``set``
+and ``delete`` do nothing and a tile missing from an archive is rendered
+as usual.  An archive is written from any configured cache with::
+
+    python -m TileCache.Caches.PMTiles --config tilecache.cfg \\
+        --layer ridge::USCOMP-N0R-202502232330 --zooms 0-8 out.pmtiles
+
+See https://github.com/protomaps/PMTiles/blob/main/spec/v3/spec.md
+"""
+
+import argparse
+import bisect
+import functools
+import gzip
+import hashlib
+import json
+import math
+import mmap
+import os
+import shutil
+import struct
+import sys
+import tempfile
+import threading
+
+from TileCache.base import Request, TileCacheException, parse_zooms
+from TileCache.Cache import Cache
+
+MAGIC = b"PMTiles"
+# magic, version, root dir, metadata, leaf dirs and tile data offset and
+# length, addressed tiles, tile entries, tile contents, clustered,
+# internal and tile compression, tile type, min and max zoom, bounds,
+# center zoom and position
+HEADER = struct.Struct("<7sBQQQQQQQQQQQBBBBBBiiiiBii")
+ROOT_SIZE = 16384
+COMPRESSION_NONE = 1
+COMPRESSION_GZIP = 2
+TILE_TYPES = {"png": 2, "jpg": 3, "jpeg": 3, "webp": 4, "avif": 5}
+
+
+def zxy_to_tileid(z, x, y):
+    """The position of an XYZ tile along the PMTiles Hilbert curve"""
+    n = 1 << z
+    tileid = (n * n - 1) // 3
+    s = n >> 1
+    while s > 0:
+        rx = 1 if x & s else 0
+        ry = 1 if y & s else 0
+        tileid += s * s * ((3 * rx) ^ ry)
+        if ry == 0:
+            if rx == 1:
+                (x, y) = (n - 1 - x, n - 1 - y)
+            (x, y) = (y, x)
+        s >>= 1
+    return tileid
+
+
+def read_varint(buf, pos):
+    """Decode the varint at pos, returns the value and the next position"""
+    value = 0
+    shift = 0
+    while True:
+        byte = buf[pos]
+        pos += 1
+        value |= (byte & 0x7F) << shift
+        if byte < 0x80:
+            return value, pos
+        shift += 7
+
+
+def write_varint(out, value):
+    """Append the varint encoding of value to the bytearray out"""
+    while value >= 0x80:
+        out.append((value & 0x7F) | 0x80)
+        value >>= 7
+    out.append(value)
+
+
+def decode_directory(buf):
+    """Decode a directory into tile id, run length, length, offset lists"""
+    (count, pos) = read_varint(buf, 0)
+    columns = []
+    for _column in range(4):
+        values = []
+        for _entry in range(count):
+            (value, pos) = read_varint(buf, pos)
+            values.append(value)
+        columns.append(values)
+    (tileids, runs, lengths, offsets) = columns
+    last = 0
+    for idx in range(count):
+        last += tileids[idx]
+        tileids[idx] = last
+        if idx > 0 and offsets[idx] == 0:
+            offsets[idx] = offsets[idx - 1] + lengths[idx - 1]
+        else:
+            offsets[idx] -= 1
+    return tileids, runs, lengths, offsets
+
+
+def encode_directory(entries):
+    """Encode (tile id, run length, length, offset) entries"""
+    out = bytearray()
+    write_varint(out, len(entries))
+    last = 0
+    for entry in entries:
+        write_varint(out, entry[0] - last)
+        last = entry[0]
+    for entry in entries:
+        write_varint(out, entry[1])
+    for entry in entries:
+        write_varint(out, entry[2])
+    for idx, entry in enumerate(entries):
+        previous = entries[idx - 1] if idx > 0 else None
+        if previous is not None and entry[3] == previous[3] + previous[2]:
+            write_varint(out, 0)
+        else:
+            write_varint(out, entry[3] + 1)
+    return bytes(out)
+
+
+class Archive(object):
+    """A memory mapped PMTiles archive"""
+
+    def __init__(self, filename, directories=64):
+        """Constructor"""
+        with open(filename, "rb") as fh:
+            self.mmap = mmap.mmap(fh.fileno(), 0, access=mmap.ACCESS_READ)
+        self.view = memoryview(self.mmap)
+        fields = HEADER.unpack_from(self.mmap, 0)
+        if fields[0] != MAGIC or fields[1] != 3:
+            raise TileCacheException(f"{filename} is not a PMTiles v3 file")
+        (self.root_offset, self.root_length) = fields[2:4]
+        self.leaf_offset = fields[6]
+        self.data_offset = fields[8]
+        self.internal_compression = fields[14]
+        self.tile_compression = fields[15]
+        (self.min_zoom, self.max_zoom) = fields[17:19]
+        if self.internal_compression not in (
+            COMPRESSION_NONE,
+            COMPRESSION_GZIP,
+        ):
+            raise TileCacheException(
+                f"{filename} has an unsupported directory compression"
+            )
+        if self.tile_compression not in (0, COMPRESSION_NONE):
+            raise TileCacheException(
+                f"{filename} has compressed tiles, which can not be served"
+            )
+        self.directory = functools.lru_cache(maxsize=directories)(
+            self._directory
+        )
+
+    def _directory(self, offset, length):
+        """Decode the directory stored at offset"""
+        buf = self.view[offset : offset + length]
+        if self.internal_compression == COMPRESSION_GZIP:
+            buf = gzip.decompress(buf)
+        return decode_directory(buf)
+
+    def find(self, tileid):
+        """The memoryview of the tile data, None if it is not stored"""
+        (offset, length) = (self.root_offset, self.root_length)
+        for _depth in range(4):
+            (tileids, runs, lengths, offsets) = self.directory(offset, length)
+            idx = bisect.bisect_right(tileids, tileid) - 1
+            if idx < 0:
+                return None
+            if runs[idx] == 0:
+                offset = self.leaf_offset + offsets[idx]
+                length = lengths[idx]
+                continue
+            if tileid >= tileids[idx] + runs[idx]:
+                return None
+            start = self.data_offset + offsets[idx]
+            return self.view[start : start + lengths[idx]]
+        return None
+
+    def get(self, z, x, y):
+        """The memoryview of an XYZ tile, None if it is not stored"""
+        if z < self.min_zoom or z > self.max_zoom:
+            return None
+        return self.find(zxy_to_tileid(z, x, y))
+
+
+class PMTiles(Cache):
+    """Implements a read-only cache of PMTiles archives"""
+
+    def __init__(self, path="{layer}.pmtiles", directories=64, **kwargs):
+        """Constructor"""
+        Cache.__init__(self, **kwargs)
+        self.path = path
+        self.directories = int(directories)
+        self._archives = {}
+        self._lock = threading.Lock()
+
+    def archive(self, layer):
+        """The archive of a layer, None if there is none"""
+        archive = self._archives.get(layer.name)
+        if archive is not None or layer.name in self._archives:
+            return archive
+        with self._lock:
+            if layer.name not in self._archives:
+                filename = self.path.replace("{layer}", layer.name)
+                archive = None
+                if os.path.isfile(filename):
+                    archive = Archive(filename, self.directories)
+                self._archives[layer.name] = archive
+            return self._archives[layer.name]
+
+    def get(self, tile):
+        """Get the cache data"""
+        archive = self.archive(tile.layer)
+        tile.data = None
+        if tile.variant:
+            # archives only hold the base format
+            archive = None
+        if archive is not None and 0 <= tile.z < len(tile.layer.max_y):
+            y = tile.layer.max_y[tile.z] - tile.y
+            tile.data = archive.get(tile.z, tile.x, y)
+        return tile.data
+
+    def set(self, tile, data):
+        """Archives are read-only, the data is not stored"""
+        return data
+
+    def delete(self, tile):
+        """Archives are read-only, nothing is removed"""
+
+
+def lonlat(layer, x, y):
+    """Longitude and latitude of a point in the layer SRS, times 1e7"""
+    if layer.srs in ("EPSG:3857", "EPSG:900913", "OSGEO:41001"):
+        lon = math.degrees(x / 6378137.0)
+        lat = math.degrees(math.atan(math.sinh(y / 6378137.0)))
+    elif layer.srs == "EPSG:4326":
+        (lon, lat) = (x, y)
+    else:
+        (lon, lat) = (180.0 if x > 0 else -180.0, 85.0 if y > 0 else -85.0)
+    lon = max(-180.0, min(180.0, lon))
+    lat = max(-85.0, min(85.0, lat))
+    return int(lon * 1e7), int(lat * 1e7)
+
+
+def build_directories(entries, compress):
+    """Encode the root and leaf directories for entries
+
+    Returns the root directory and the concatenated leaf directories.
+    """
+    root = compress(encode_directory(entries))
+    if HEADER.size + len(root) <= ROOT_SIZE:
+        return root, b""
+    leaf_size = 4096
+    while True:
+        leaves = bytearray()
+        pointers = []
+        for start in range(0, len(entries), leaf_size):
+            chunk = entries[start : start + leaf_size]
+            leaf = compress(encode_directory(chunk))
+            pointers.append((chunk[0][0], 0, len(leaf), len(leaves)))
+            leaves += leaf
+        root = compress(encode_directory(pointers))
+        if HEADER.size + len(root) <= ROOT_SIZE:
+            return root, bytes(leaves)
+        leaf_size *= 2
+
+
+def export(cache, layer, zooms, filename, bbox=None):
+    """Write the cached tiles of layer at zooms into a PMTiles archive
+
+    Identical tiles are stored once.  Returns the number of tiles written.
+    """
+    # Service imports Layer, which imports Pyramid
+    import TileCache.Pyramid as Pyramid
+
+    wanted = []
+    for z in zooms:
+        if z >= len(layer.resolutions):
+            continue
+        for tile in Pyramid.tiles(layer, z, bbox):
+            xyz = zxy_to_tileid(z, tile.x, layer.max_y[z] - tile.y)
+            wanted.append((xyz, tile))
+    wanted.sort(key=lambda item: item[0])
+
+    entries = []
+    contents = {}
+    with tempfile.TemporaryFile() as data:
+        for tileid, tile in wanted:
+            image = cache.get(tile)
+            if not image:
+                continue
+            digest = hashlib.blake2b(image, digest_size=16).digest()
+            if digest not in contents:
+                contents[digest] = (data.tell(), len(image))
+                data.write(image)
+            (offset, length) = contents[digest]
+            last = entries[-1] if entries else None
+            if (
+                last is not None
+                and last[3] == offset
+                and last[0] + last[1] == tileid
+            ):
+                entries[-1] = (last[0], last[1] + 1, length, offset)
+            else:
+                entries.append((tileid, 1, length, offset))
+        if not entries:
+            raise TileCacheException(f"No cached tiles found for {layer.name}")
+
+        def compress(buf):
+            return gzip.compress(buf, mtime=0)
+
+        (root, leaves) = build_directories(entries, compress)
+        metadata = compress(
+            json.dumps({"name": layer.name, "format": layer.extension}).encode(
+                "utf-8"
+            )
+        )
+        bounds = lonlat(layer, *layer.bbox[:2]) + lonlat(
+            layer, *layer.bbox[2:]
+        )
+        zoomed = [z for z in zooms if z < len(layer.resolutions)]
+        tile_data_length = data.tell()
+        header = HEADER.pack(
+            MAGIC,
+            3,
+            HEADER.size,
+            len(root),
+            HEADER.size + len(root),
+            len(metadata),
+            HEADER.size + len(root) + len(metadata),
+            len(leaves),
+            HEADER.size + len(root) + len(metadata) + len(leaves),
+            tile_data_length,
+            sum(entry[1] for entry in entries),
+            len(entries),
+            len(contents),
+            1,
+            COMPRESSION_GZIP,
+            COMPRESSION_NONE,
+            TILE_TYPES.get(layer.extension, 0),
+            min(zoomed),
+            max(zoomed),
+            *bounds,
+            min(zoomed),
+            (bounds[0] + bounds[2]) // 2,
+            (bounds[1] + bounds[3]) // 2,
+        )
+        data.seek(0)
+        with open(filename, "wb") as fh:
+            fh.write(header)
+            fh.write(root)
+            fh.write(metadata)
+            fh.write(leaves)
+            shutil.copyfileobj(data, fh)
+    return sum(entry[1] for entry in entries)
+
+
+def main(argv=None):
+    """Command line entry point"""
+    # Service imports this module by way of the cache configuration
+    from TileCache.Service import Service
+
+    parser = argparse.ArgumentParser(
+        description="Export cached tiles to a PMTiles archive"
+    )
+    parser.add_argument("--config", required=True)
+    parser.add_argument("--layer", required=True)
+    parser.add_argument("--zooms", required=True, help="like 0-6")
+    parser.add_argument("--bbox", help="minx,miny,maxx,maxy in layer SRS")
+    parser.add_argument("output")
+    args = parser.parse_args(argv)
+
+    service = Service.load(args.config)
+    layer = Request(service).getLayer(args.layer)
+    bbox = None
+    if args.bbox:
+        bbox = list(map(float, args.bbox.split(",")))
+    zooms = sorted(parse_zooms(args.zooms))
+    count = export(service.cache, layer, zooms, args.output, bbox)
+    sys.stdout.write(f"Wrote {count} tiles of {args.layer}\n")
+    return 0
+
+
+if __name__ == "__main__":
+    sys.exit(main())
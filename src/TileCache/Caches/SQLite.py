@@ -0,0 +1,126 @@
+"""SQLite Caching Provider
+BSD Licensed, Copyright (c) 2006-2010 TileCache Contributors
+
+Keeps tiles in one SQLite file, surviving restarts.  It is usable on its
+own, but is mostly meant as the persistent tier behind Memcached, see its
+``persistent_path`` option, which is why the key level methods are public.
+Expired rows are deleted by the first write every ``purge_interval``
+seconds.
+"""
+
+import sqlite3
+import threading
+import time
+
+from TileCache.Cache import Cache
+
+SCHEMA = (
+    "CREATE TABLE IF NOT EXISTS tiles "
+    "(key TEXT PRIMARY KEY, data BLOB NOT NULL, expires REAL NOT NULL)"
+)
+# SQLite limits the number of host parameters in a statement
+BATCH = 500
+
+
+class SQLite(Cache):
+    """Implements a cache in a SQLite database"""
+
+    def __init__(self, path="tilecache.sqlite", purge_interval=300, **kwargs):
+        """Constructor"""
+        Cache.__init__(self, **kwargs)
+        self.timeout = float(kwargs.get("timeout", 0))
+        self.path = path
+        self.purge_interval = float(purge_interval)
+        self.purged = time.monotonic()
+        self._local = threading.local()
+        with self.connection() as conn:
+            conn.execute(SCHEMA)
+
+    def connection(self):
+        """The connection of this thread, sqlite3 ones can not be shared"""
+        conn = getattr(self._local, "conn", None)
+        if conn is None:
+            conn = sqlite3.connect(self.path, timeout=5)
+            conn.execute("PRAGMA journal_mode=WAL")
+            conn.execute("PRAGMA synchronous=NORMAL")
+            self._local.conn = conn
+        return conn
+
+    def getData(self, key):
+        """The data stored for key and when it expires, 0 meaning never"""
+        return self.getMany([key]).get(key, (None, 0.0))
+
+    def getMany(self, keys):
+        """Map the found keys to their data and expiry time"""
+        found = {}
+        now = time.time()
+        conn = self.connection()
+        for start in range(0, len(keys), BATCH):
+            batch = keys[start : start + BATCH]
+            marks = ",".join("?" * len(batch))
+            rows = conn.execute(
+                f"SELECT key, data, expires FROM tiles WHERE key IN ({marks})",
+                batch,
+            )
+            for key, data, expires in rows:
+                if not expires or expires > now:
+                    found[key] = (data, expires)
+        return found
+
+    def write(self, items):
+        """Apply (key, data, expires) items in order, in one transaction.
+
+        Items without data remove their key.
+        """
+        now = time.monotonic()
+        purge = now - self.purged >= self.purge_interval
+        if purge:
+            self.purged = now
+        with self.connection() as conn:
+            if purge:
+                self.purge(conn)
+            for key, data, expires in items:
+                if data is None:
+                    conn.execute("DELETE FROM tiles WHERE key = ?", (key,))
+                else:
+                    conn.execute(
+                        "INSERT OR REPLACE INTO tiles (key, data, expires) "
+                        "VALUES (?, ?, ?)",
+                        (key, data, expires),
+                    )
+
+    def purge(self, conn=None):
+        """Delete the expired rows, returns how many there were"""
+        if conn is None:
+            with self.connection() as conn:
+                return self.purge(conn)
+        return conn.execute(
+            "DELETE FROM tiles WHERE expires > 0 AND expires < ?",
+            (time.time(),),
+        ).rowcount
+
+    def expires(self, tile):
+        """The expiry time of tile stored now, 0 meaning never"""
+        ttl = self.ttl(tile)
+        return time.time() + ttl if ttl else 0.0
+
+    def get(self, tile):
+        """Get the cache data"""
+        (tile.data, _expires) = self.getData(self.getKey(tile))
+        return tile.data
+
+    def get_many(self, tiles):
+        """Get the cache data for several tiles with one query"""
+        found = self.getMany([self.getKey(tile) for tile in tiles])
+        for tile in tiles:
+            tile.data = found.get(self.getKey(tile), (None, 0.0))[0]
+        return [tile.data for tile in tiles]
+
+    def set(self, tile, data):
+        """Set the cache data"""
+        self.write([(self.getKey(tile), data, self.expires(tile))])
+        return data
+
+    def delete(self, tile):
+        """Remove the cache data"""
+        self.write([(self.getKey(tile), None, 0.0)])
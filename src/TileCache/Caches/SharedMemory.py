@@ -0,0 +1,227 @@
+"""Shared Memory Caching Provider
+BSD Licensed, Copyright (c) 2006-2010 TileCache Contributors
+
+All worker processes on a host map the same fixed size file (by default
+found in /dev/shm) so that a hot tile is only ever stored once.  The arena
+is a set-associative hash table: a key digest picks a set and the tile is
+stored in one of the ``ways`` fixed size slots of that set.  Readers never
+lock, each slot carries a sequence number that is odd while a writer is
+busy with it and a reader simply retries if the number moved underneath
+it.  Writers lock only their set, using a byte range lock on the file for
+other processes and a striped thread lock for this one.  When a set is
+full a clock sweep over the slot reference bits picks the victim.
+
+With ``admission=tinylfu`` the lookups of each process are counted in a
+popularity sketch of ``admission_width`` counters per row, and a new tile
+only replaces the victim when it was looked up more often, so that tiles
+asked for once do not push out the hot ones.
+"""
+
+import fcntl
+import hashlib
+import mmap
+import os
+import struct
+import threading
+import time
+
+from TileCache.base import TileCacheException
+from TileCache.Cache import Cache, parse_size
+from TileCache.Popularity import Sketch
+
+MAGIC = b"TCSHM001"
+# magic, number of sets, ways per set, item size
+HEADER = struct.Struct("<8sIII")
+HEADER_SIZE = 64
+# clock hand of the set
+SET_HEADER = struct.Struct("<I")
+SET_HEADER_SIZE = 8
+# sequence, key digest, expires, length, referenced
+SLOT = struct.Struct("<Q16sdIB")
+SEQ = struct.Struct("<Q")
+REF_OFFSET = SLOT.size - 1
+EMPTY = bytes(16)
+LOCK_STRIPES = 64
+
+
+class SharedMemory(Cache):
+    """Implements a cache shared by all processes on a host"""
+
+    def __init__(
+        self,
+        path="/dev/shm/tilecache",
+        size="256M",
+        ways=8,
+        item_size="64K",
+        admission=None,
+        admission_width=65536,
+        **kwargs,
+    ):
+        """Constructor"""
+        Cache.__init__(self, **kwargs)
+        self.timeout = float(kwargs.get("timeout", 0))
+        self.path = path
+        self.ways = int(ways)
+        self.item_size = parse_size(item_size)
+        self.slot_size = SLOT.size + self.item_size
+        self.set_size = SET_HEADER_SIZE + self.ways * self.slot_size
+        self.sets = max(1, (parse_size(size) - HEADER_SIZE) // self.set_size)
+        self._locks = [threading.Lock() for _ in range(LOCK_STRIPES)]
+        self.sketch = None
+        if admission == "tinylfu":
+            self.sketch = Sketch(admission_width, top=0)
+        elif admission:
+            raise TileCacheException(f"Unknown admission policy {admission}")
+        self._fd = os.open(path, os.O_RDWR | os.O_CREAT, 0o600)
+        total = HEADER_SIZE + self.sets * self.set_size
+        self._init_arena(total)
+        self.arena = mmap.mmap(self._fd, total)
+
+    def _init_arena(self, total):
+        """Create the arena file, unless a compatible one exists."""
+        header = HEADER.pack(MAGIC, self.sets, self.ways, self.item_size)
+        fcntl.lockf(self._fd, fcntl.LOCK_EX, HEADER_SIZE, 0)
+        try:
+            current = os.pread(self._fd, HEADER.size, 0)
+            if current == header:
+                return
+            if current[:8] == MAGIC:
+                raise TileCacheException(
+                    f"Shared memory cache {self.path} has a different "
+                    "geometry, remove it or fix the [cache] settings."
+                )
+            os.ftruncate(self._fd, 0)
+            os.ftruncate(self._fd, total)
+            os.pwrite(self._fd, header, 0)
+        finally:
+            fcntl.lockf(self._fd, fcntl.LOCK_UN, HEADER_SIZE, 0)
+
+    def _locate(self, key):
+        """Return the key digest and the offset of its set."""
+        digest = hashlib.blake2b(key.encode("utf-8"), digest_size=16).digest()
+        index = int.from_bytes(digest[:8], "little") % self.sets
+        return digest, HEADER_SIZE + index * self.set_size
+
+    def _slots(self, base):
+        """Offsets of the slots in the set starting at base."""
+        first = base + SET_HEADER_SIZE
+        return range(first, first + self.ways * self.slot_size, self.slot_size)
+
+    def _read(self, digest, base):
+        """Copy the data stored for digest out of the arena, if any."""
+        arena = self.arena
+        for offset in self._slots(base):
+            for _attempt in range(3):
+                seq, kdigest, expires, length, ref = SLOT.unpack_from(
+                    arena, offset
+                )
+                if kdigest != digest:
+                    break
+                if seq & 1:
+                    continue
+                start = offset + SLOT.size
+                data = arena[start : start + length]
+                if SEQ.unpack_from(arena, offset)[0] != seq:
+                    continue
+                if expires and expires < time.time():
+                    return None
+                if not ref:
+                    arena[offset + REF_OFFSET] = 1
+                return data
+        return None
+
+    def get(self, tile):
+        """Get the cache data"""
+        digest, base = self._locate(self.getKey(tile))
+        if self.sketch is not None:
+            self.sketch.add(digest)
+        tile.data = self._read(digest, base)
+        return tile.data
+
+    def _lock(self, base):
+        """Lock the set at base against this and other processes."""
+        lock = self._locks[(base // self.set_size) % LOCK_STRIPES]
+        lock.acquire()
+        try:
+            fcntl.lockf(self._fd, fcntl.LOCK_EX, self.set_size, base)
+        except Exception:
+            lock.release()
+            raise
+        return lock
+
+    def _unlock(self, base, lock):
+        fcntl.lockf(self._fd, fcntl.LOCK_UN, self.set_size, base)
+        lock.release()
+
+    def _victim(self, digest, base):
+        """Pick the slot to write digest into, the set must be locked.
+
+        Returns its offset and the digest of the live tile evicted, if any.
+        """
+        arena = self.arena
+        now = time.time()
+        slots = self._slots(base)
+        for offset in slots:
+            _seq, kdigest, expires, _length, _ref = SLOT.unpack_from(
+                arena, offset
+            )
+            if kdigest in (digest, EMPTY) or (expires and expires < now):
+                return offset, None
+        (hand,) = SET_HEADER.unpack_from(arena, base)
+        for _sweep in range(2 * self.ways):
+            offset = slots[hand]
+            hand = (hand + 1) % self.ways
+            if arena[offset + REF_OFFSET]:
+                arena[offset + REF_OFFSET] = 0
+                continue
+            break
+        SET_HEADER.pack_into(arena, base, hand)
+        return offset, SLOT.unpack_from(arena, offset)[1]
+
+    def _write(self, digest, base, data, timeout):
+        """Store data for digest, this is a no-op when it does not fit."""
+        if len(data) > self.item_size:
+            return
+        arena = self.arena
+        expires = time.time() + timeout if timeout else 0.0
+        lock = self._lock(base)
+        try:
+            (offset, evicted) = self._victim(digest, base)
+            if (
+                evicted is not None
+                and self.sketch is not None
+                and not self.sketch.admit(digest, evicted)
+            ):
+                return
+            (seq,) = SEQ.unpack_from(arena, offset)
+            SEQ.pack_into(arena, offset, seq + 1)
+            SLOT.pack_into(
+                arena, offset, seq + 1, digest, expires, len(data), 0
+            )
+            start = offset + SLOT.size
+            arena[start : start + len(data)] = data
+            SEQ.pack_into(arena, offset, seq + 2)
+        finally:
+            self._unlock(base, lock)
+
+    def set(self, tile, data):
+        """Set the cache data"""
+        digest, base = self._locate(self.getKey(tile))
+        self._write(digest, base, data, self.ttl(tile))
+        return data
+
+    def delete(self, tile):
+        """Remove the cache data"""
+        digest, base = self._locate(self.getKey(tile))
+        arena = self.arena
+        lock = self._lock(base)
+        try:
+            for offset in self._slots(base):
+                if SLOT.unpack_from(arena, offset)[1] != digest:
+                    continue
+                (seq,) = SEQ.unpack_from(arena, offset)
+                SEQ.pack_into(arena, offset, seq + 1)
+                SLOT.pack_into(arena, offset, seq + 1, EMPTY, 0.0, 0, 0)
+                SEQ.pack_into(arena, offset, seq + 2)
+        finally:
+            self._unlock(base, lock)
@@ -3,30 +3,224 @@
 # BSD Licensed, Copyright (c) 2006-2010 TileCache Contributors
 
 try:
-    from urllib.parse import urlencode
+    from urllib.parse import urlencode, urlsplit, urlunsplit
 except ImportError:
     from urllib import urlencode
+
+    from urlparse import urlsplit, urlunsplit
+import concurrent.futures
+import random
+import threading
 import time
+from collections import deque
+from concurrent.futures import FIRST_COMPLETED, ThreadPoolExecutor, wait
 from typing import Optional
 
 # httpx leaks memory for me at least!!!
 import requests
 
-from TileCache import BackendWMSFailure
+import TileCache.Timing as Timing
+from TileCache import BackendWMSFailure, DeadlineExceeded, time_left
 
 # setting this to True will exchange more useful error messages
 # for privacy, hiding URLs and error messages.
 HIDE_ALL = False
+# a retry is not worth it with less time than this left before the deadline
+RETRY_BUDGET = 1.0
+
+
+def read_body(resp) -> bytes:
+    """Read a streamed response body into one buffer sized up front.
+
+    The body is read straight into a ``bytearray`` preallocated from the
+    Content-Length header, avoiding the chunk list and join done by
+    ``resp.content``.  The buffer is frozen once into the ``bytes`` object
+    that is then shared by the cache writer and the WSGI response, as both
+    pymemcache and PEP 3333 insist on ``bytes``.
+    """
+    length = resp.headers.get("content-length", "")
+    encoding = resp.headers.get("content-encoding", "identity")
+    if not length.isdigit() or encoding != "identity":
+        return resp.content
+    buf = bytearray(int(length))
+    view = memoryview(buf)
+    pos = 0
+    while pos < len(buf):
+        got = resp.raw.readinto(view[pos:])
+        if not got:
+            break
+        pos += got
+    view.release()
+    if pos != len(buf):
+        raise BackendWMSFailure(
+            f"Short read from backend, got {pos} of {len(buf)} bytes"
+        )
+    return bytes(buf)
+
+
+class BackendPool(object):
+    """Spread the requests of a layer over identical backend hosts.
+
+    Each request goes to the healthy host with the fewest requests in
+    flight.  A host failing ``failures`` times in a row is left alone for
+    ``cooldown`` seconds, and a request failing to connect is tried once
+    more on another host.  With hedging, a request still running after the
+    95th percentile of the recent successful fetches is duplicated to a
+    second host and the first answer wins.
+    """
+
+    def __init__(
+        self, hosts, hedge=False, failures=3, cooldown=30, workers=16
+    ):
+        """Constructor"""
+        self.hosts = list(hosts)
+        self.hedge = hedge
+        self.failures = int(failures)
+        self.cooldown = float(cooldown)
+        self.workers = int(workers)
+        self.outstanding = dict.fromkeys(self.hosts, 0)
+        self.errors = dict.fromkeys(self.hosts, 0)
+        self.down_until = dict.fromkeys(self.hosts, 0.0)
+        self.latencies = deque(maxlen=200)
+        self._lock = threading.Lock()
+        self._executor = None
+
+    def pick(self, exclude=()):
+        """Reserve the host to send a request to, None if there is none"""
+        with self._lock:
+            now = time.monotonic()
+            hosts = [h for h in self.hosts if h not in exclude]
+            healthy = [h for h in hosts if self.down_until[h] <= now]
+            if not healthy:
+                if exclude:
+                    return None
+                healthy = hosts
+            fewest = min(self.outstanding[h] for h in healthy)
+            host = random.choice(
+                [h for h in healthy if self.outstanding[h] == fewest]
+            )
+            self.outstanding[host] += 1
+            return host
+
+    def release(self, host, elapsed, ok):
+        """Account for the end of a request to host"""
+        with self._lock:
+            self.outstanding[host] -= 1
+            if ok:
+                self.errors[host] = 0
+                self.latencies.append(elapsed)
+                return
+            self.errors[host] += 1
+            if self.errors[host] >= self.failures:
+                self.down_until[host] = time.monotonic() + self.cooldown
+
+    def p95(self):
+        """The 95th percentile fetch time, None until there are samples"""
+        with self._lock:
+            if len(self.latencies) < 20:
+                return None
+            ordered = sorted(self.latencies)
+        return ordered[int(0.95 * (len(ordered) - 1))]
+
+    @staticmethod
+    def rewrite(url, host):
+        """Send url to host instead"""
+        parts = urlsplit(url)
+        return urlunsplit(parts._replace(netloc=host))
+
+    def call(self, host, url, func):
+        """Run func on url rewritten for the reserved host"""
+        start = time.perf_counter()
+        ok = False
+        try:
+            data = func(self.rewrite(url, host))
+            ok = True
+            return data
+        finally:
+            self.release(host, time.perf_counter() - start, ok)
+
+    def fetch(self, url, func, deadline=None):
+        """Fetch url with func(url) from the best host, by deadline"""
+        left = time_left(deadline)
+        host = self.pick()
+        delay = self.p95() if self.hedge else None
+        if delay is None:
+            try:
+                return self.call(host, url, func)
+            except (requests.ConnectionError, requests.Timeout):
+                left = time_left(deadline)
+                if left is not None and left < RETRY_BUDGET:
+                    raise
+                other = self.pick(exclude=(host,))
+                if other is None:
+                    raise
+                return self.call(other, url, func)
+        if left is not None:
+            delay = min(delay, left)
+        if self._executor is None:
+            with self._lock:
+                if self._executor is None:
+                    self._executor = ThreadPoolExecutor(
+                        max_workers=self.workers,
+                        thread_name_prefix="tilecache-hedge",
+                    )
+        first = self._executor.submit(self.call, host, url, func)
+        done, _pending = wait([first], timeout=delay)
+        other = None if done else self.pick(exclude=(host,))
+        if other is None:
+            return self.result(first, deadline)
+        second = self._executor.submit(self.call, other, url, func)
+        done, _pending = wait(
+            [first, second],
+            timeout=time_left(deadline),
+            return_when=FIRST_COMPLETED,
+        )
+        if not done:
+            raise DeadlineExceeded("Request deadline exceeded")
+        winner = done.pop()
+        if winner.exception() is None:
+            return winner.result()
+        # the other one is all that is left
+        return self.result(second if winner is first else first, deadline)
+
+    @staticmethod
+    def result(future, deadline):
+        """The result of future, waiting no longer than deadline"""
+        try:
+            return future.result(timeout=time_left(deadline))
+        except concurrent.futures.TimeoutError as exp:
+            raise DeadlineExceeded("Request deadline exceeded") from exp
 
 
 class WMS(object):
     fields = ("bbox", "srs", "width", "height", "format", "layers", "styles")
     defaultParams = {"version": "1.1.1", "request": "GetMap", "service": "WMS"}
-    __slots__ = ("base", "params", "client", "data", "response")
+    __slots__ = (
+        "base",
+        "params",
+        "client",
+        "data",
+        "response",
+        "stream",
+        "pool",
+        "deadline",
+    )
 
-    def __init__(self, base: str, params, user=None, password=None):
-        """Constructor"""
+    def __init__(
+        self,
+        base: str,
+        params,
+        user=None,
+        password=None,
+        stream=False,
+        pool=None,
+        deadline=None,
+    ):
+        """Constructor, deadline is a time.monotonic() value"""
         self.base = base
+        self.stream = stream
+        self.pool = pool
+        self.deadline = deadline
         if self.base[-1] not in "?&":
             if "?" in self.base:
                 self.base += "&"
@@ -49,34 +243,70 @@ class WMS(object):
         return self.base + urlencode(self.params)
 
     def fetch(self) -> Optional[bytes]:
-        """Fetch image from backend"""
+        """Fetch image from backend, a backend that can't be reached or
+        does not answer in time is a BackendWMSFailure."""
+        try:
+            if self.pool is None:
+                return self.fetchUrl(self.url())
+            return self.pool.fetch(self.url(), self.fetchUrl, self.deadline)
+        except (requests.ConnectionError, requests.Timeout) as exc:
+            raise BackendWMSFailure("WMS backend unreachable") from exc
+
+    def affords(self, seconds):
+        """Is there more than seconds left before the deadline?"""
+        return (
+            self.deadline is None or self.deadline - time.monotonic() > seconds
+        )
+
+    def fetchUrl(self, url) -> Optional[bytes]:
+        """Fetch image from the given backend URL"""
         data = None
         for attempt in range(1, 3):
+            timeout = 20
+            left = time_left(self.deadline)
+            if left is not None:
+                timeout = min(timeout, left)
+            Timing.count("backend_attempts")
             try:
-                resp = requests.get(self.url(), timeout=20)
-                # Error if we don't get a 200
-                resp.raise_for_status()
-                # Error if we don't get an image back
-                if resp.headers.get("content-type") != "image/png":
-                    # Account for an edge case of Mapserver failing due to
-                    # file getting replaced underneath its cached reference
-                    if (
-                        attempt == 1
-                        and resp.text.find("IReadBlock failed at") > -1
-                    ):
-                        time.sleep(1)
-                        continue
-                    msg = (
-                        "Did not get image data back. \n"
-                        f"URL: {self.url()}\nStatus: {resp.status_code}\n"
-                        f"Response: \n{resp.text}"
-                    )
-                    raise BackendWMSFailure(msg)
-                data = resp.content
+                with (
+                    Timing.stage("backend"),
+                    requests.get(
+                        url, timeout=timeout, stream=self.stream
+                    ) as resp,
+                ):
+                    # Error if we don't get a 200
+                    resp.raise_for_status()
+                    # Error if we don't get an image back, the headers are
+                    # enough to tell, so the body is only read on failure
+                    if resp.headers.get("content-type") != "image/png":
+                        # Account for an edge case of Mapserver failing due
+                        # to file getting replaced underneath its cached
+                        # reference
+                        if (
+                            attempt == 1
+                            and self.affords(1 + RETRY_BUDGET)
+                            and resp.content.find(b"IReadBlock failed at") > -1
+                        ):
+                            with Timing.stage("sleep"):
+                                time.sleep(1)
+                            continue
+                        msg = (
+                            "Did not get image data back. \n"
+                            f"URL: {url}\nStatus: {resp.status_code}\n"
+                            f"Response: \n{resp.text}"
+                        )
+                        raise BackendWMSFailure(msg)
+                    data = read_body(resp) if self.stream else resp.content
                 break
             except requests.HTTPError as exc:
-                if attempt == 2:
+                if attempt == 2 or not self.affords(RETRY_BUDGET):
                     raise BackendWMSFailure("WMS image failure") from exc
+            except requests.Timeout as exc:
+                if not self.affords(0):
+                    raise DeadlineExceeded(
+                        "Request deadline exceeded"
+                    ) from exc
+                raise
         return data
 
     def setBBox(self, box):
@@ -0,0 +1,105 @@
+"""Fetch one tile of many timestamped layers, for animations.
+
+BSD Licensed, Copyright (c) 2006-2010 TileCache Contributors
+
+Loop viewers request the same tile of a product for a run of valid times.
+``/frames/1.0.0/<pattern>/<z>/<x>/<y>.png?times=t1,t2,...`` substitutes
+each of the times for ``{t}`` in pattern, for example
+``ridge::USCOMP-N0Q-{t}``, and returns the tiles of the resulting layers
+in the order of times.  The layers are resolved up front, the tiles are
+looked up with one batched cache read and the missing frames are rendered
+by at most ``bundle_workers`` threads while the response is streamed, so
+the first frames go out before the last ones are rendered.  The body uses
+the framing of TileCache.Bundle, a frame whose layer can not be resolved
+has the status a single tile request for it would have had.
+``bundle_max_tiles`` limits the number of frames and ``bundle_deadline``
+the time spent on them.
+"""
+
+import time
+
+from TileCache import OutOfBoundsTile, OutOfBoundsZoomLevel
+from TileCache.base import (
+    MalformedRequestException,
+    TileCacheException,
+    TileCacheFutureException,
+    TileCacheLayerNotFoundException,
+)
+from TileCache.Bundle import (
+    CONTENT_TYPE,
+    cache_control,
+    check_index,
+    check_zoom,
+    encode_frames,
+    iter_many,
+    prefetch,
+)
+from TileCache.Services.TMS import TILEPATH, TMS
+
+
+def parse_times(fields):
+    """The list of valid times asked for"""
+    times = [t for t in fields.get("times", "").split(",") if t]
+    if not times:
+        raise MalformedRequestException("times is required.")
+    for valid in times:
+        if not valid.isdigit():
+            raise MalformedRequestException(f"Invalid time {valid}")
+    return times
+
+
+def frame_tiles(service, fields, pattern, zoom, x, y, times, client=None):
+    """Build the tile of each frame, or the exception preventing it"""
+    tms = TMS(service)
+    start = time.monotonic()
+    tiles = []
+    for valid in times:
+        try:
+            layer = tms.getLayer(pattern.replace("{t}", valid))
+            tile = tms.makeTile(fields, layer, zoom, x, y)
+            tile.client = client
+            tiles.append(service.setDeadline(tile, "bundle_deadline", start))
+        except (
+            OutOfBoundsTile,
+            OutOfBoundsZoomLevel,
+            TileCacheException,
+            TileCacheFutureException,
+            TileCacheLayerNotFoundException,
+        ) as exp:
+            tiles.append(exp)
+    return tiles
+
+
+def dispatch(service, fields, path_info, headers=None, client=None):
+    """Handle a /frames/ request, returns the content type and an iterator
+
+    All the work short of waiting on renders happens before this returns,
+    so that a bad request raises here and not while streaming.
+    """
+    match = TILEPATH.match(path_info[len("/frames") :])
+    if match is None:
+        raise MalformedRequestException(
+            "Frame requests look like /frames/1.0.0/<pattern>/<z>/<x>/<y>"
+        )
+    (pattern, zoom, x, y) = match.groups()
+    if "{t}" not in pattern:
+        raise MalformedRequestException("The layer pattern needs a {t}.")
+    times = parse_times(fields)
+    limit = int(service.tilecache_options.get("bundle_max_tiles", 64))
+    if len(times) > limit:
+        raise MalformedRequestException(f"At most {limit} frames.")
+    (zoom, x, y) = (int(zoom), int(x), int(y))
+    check_zoom(zoom)
+    check_index(x)
+    check_index(y)
+    tiles = frame_tiles(service, fields, pattern, zoom, x, y, times, client)
+    # the headers go out before the renders finish, so only frames all
+    # found in the cache can be marked immutable
+    results = prefetch(service, tiles)
+    control = cache_control(tiles, results)
+    if headers is not None and control is not None:
+        headers.append(("Cache-Control", control))
+    workers = int(service.tilecache_options.get("bundle_workers", 8))
+    results = iter_many(service, tiles, workers, results)
+    entries = ((zoom, x, y, status, data) for status, data in results)
+    return CONTENT_TYPE, encode_frames(entries, len(tiles))
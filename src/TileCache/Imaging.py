@@ -0,0 +1,169 @@
+"""Image manipulation helpers.
+
+BSD Licensed, Copyright (c) 2006-2010 TileCache Contributors
+
+These need Pillow, which is an optional dependency, callers should check
+``available()`` and fall back to the plain backend path without it.  Only
+``recompress_png`` works without it.  Pillow is imported on first use, so
+that workers serving no composed or transcoded tiles never load it.
+"""
+
+import io
+import struct
+import zlib
+
+Image = None
+features = None
+# set once importing Pillow failed
+_missing = False
+
+# formats a tile can be transcoded to, see the variants layer option
+VARIANTS = {"webp": "image/webp", "avif": "image/avif"}
+
+
+def available():
+    """Is Pillow installed?  Imports it on the first call."""
+    global Image, features, _missing
+    if Image is None and not _missing:
+        try:
+            from PIL import Image, features
+        except ImportError:
+            _missing = True
+    return Image is not None
+
+
+def encode(img, fmt="png"):
+    """Serialize a PIL image, dropping the alpha band JPEG can't hold"""
+    if fmt.lower() in ("jpeg", "jpg") and img.mode != "RGB":
+        img = img.convert("RGB")
+    buf = io.BytesIO()
+    img.save(buf, format=fmt.upper())
+    return buf.getvalue()
+
+
+def compose_children(children, size, fmt="png"):
+    """Build a parent tile from its four children.
+
+    children maps the (column, row) of a child, counted from the top left
+    corner, to its image data or None when it has nothing to show.
+    """
+    available()
+    (width, height) = size
+    canvas = Image.new("RGBA", (width * 2, height * 2), (0, 0, 0, 0))
+    for (col, row), data in children.items():
+        if data is None:
+            continue
+        with Image.open(io.BytesIO(data)) as img:
+            canvas.paste(img.convert("RGBA"), (col * width, row * height))
+    return encode(canvas.resize(size, Image.Resampling.BOX), fmt)
+
+
+def upsample_part(data, size, depth, col, row, fmt="png"):
+    """Crop one of the 2**depth by 2**depth parts of an ancestor tile and
+    scale it back up to a full tile.
+
+    col and row locate the part, counted from the top left corner.
+    """
+    available()
+    (width, height) = size
+    scale = 1 << depth
+    (part_w, part_h) = (width / scale, height / scale)
+    box = (
+        round(col * part_w),
+        round(row * part_h),
+        round((col + 1) * part_w),
+        round((row + 1) * part_h),
+    )
+    with Image.open(io.BytesIO(data)) as img:
+        part = img.convert("RGBA").crop(box)
+    return encode(part.resize(size, Image.Resampling.BILINEAR), fmt)
+
+
+PNG_SIGNATURE = b"\x89PNG\r\n\x1a\n"
+
+
+def png_chunks(data):
+    """Yield the (type, payload) chunks of a PNG"""
+    pos = len(PNG_SIGNATURE)
+    while pos + 8 <= len(data):
+        (length, ctype) = struct.unpack_from(">I4s", data, pos)
+        yield ctype, data[pos + 8 : pos + 8 + length]
+        pos += 12 + length
+
+
+def png_chunk(ctype, payload):
+    """Serialize one PNG chunk"""
+    crc = zlib.crc32(payload, zlib.crc32(ctype))
+    return (
+        struct.pack(">I4s", len(payload), ctype)
+        + payload
+        + (struct.pack(">I", crc))
+    )
+
+
+def recompress_png(data, level=9):
+    """Deflate the image data of a PNG again, merged into one IDAT.
+
+    The pixels and filters are left alone, so this is lossless and needs
+    no Pillow.  Data that is not a PNG is returned as is.
+    """
+    if not data.startswith(PNG_SIGNATURE):
+        return data
+    before = []
+    after = []
+    idat = []
+    for ctype, payload in png_chunks(data):
+        if ctype == b"IDAT":
+            idat.append(payload)
+        else:
+            (after if idat else before).append(png_chunk(ctype, payload))
+    if not idat:
+        return data
+    raw = zlib.decompress(b"".join(idat))
+    packed = png_chunk(b"IDAT", zlib.compress(raw, level))
+    return b"".join([PNG_SIGNATURE, *before, packed, *after])
+
+
+def quantize_png(data, colors=256):
+    """Reduce a PNG to an 8 bit palette, keeping its transparency"""
+    available()
+    with Image.open(io.BytesIO(data)) as img:
+        if img.mode == "P":
+            return data
+        if img.mode != "RGBA":
+            img = img.convert("RGB")
+        img = img.quantize(colors, method=Image.Quantize.FASTOCTREE)
+    buf = io.BytesIO()
+    img.save(buf, format="PNG", optimize=True)
+    return buf.getvalue()
+
+
+def optimize_png(data, quantize=False, recompress=True):
+    """The smallest of data and its quantized and/or recompressed forms"""
+    best = data
+    if quantize and available():
+        best = min(best, quantize_png(data), key=len)
+    if recompress:
+        best = min(best, recompress_png(best), key=len)
+    return best
+
+
+def can_transcode(fmt):
+    """Can tiles be transcoded to fmt, one of VARIANTS?"""
+    if not available() or fmt not in VARIANTS:
+        return False
+    try:
+        return bool(features.check(fmt))
+    except ValueError:
+        # Pillow too old to know about the format
+        return False
+
+
+def transcode(data, fmt):
+    """Re-encode a tile losslessly in another format"""
+    available()
+    with Image.open(io.BytesIO(data)) as img:
+        img.load()
+        buf = io.BytesIO()
+        img.save(buf, format=fmt.upper(), lossless=True)
+    return buf.getvalue()
@@ -1,15 +1,60 @@
 """BSD Licensed, Copyright (c) 2006-2010 TileCache Contributors"""
 
+import functools
+import math
+import struct
+import zlib
+
+import TileCache.Pyramid as Pyramid
+from TileCache.base import parse_zooms
+
 DEBUG = False
 
 
+@functools.lru_cache(maxsize=None)
+def blank_png(width, height):
+    """Build a fully transparent RGBA PNG of the given size.
+
+    >>> blank_png(1, 1)[:8]
+    b'\\x89PNG\\r\\n\\x1a\\n'
+    """
+
+    def chunk(ctype, body):
+        return (
+            struct.pack(">I", len(body))
+            + ctype
+            + body
+            + struct.pack(">I", zlib.crc32(ctype + body))
+        )
+
+    ihdr = struct.pack(">IIBBBBB", width, height, 8, 6, 0, 0, 0)
+    # each scanline is a zero filter byte followed by transparent pixels
+    raw = bytes((width * 4 + 1) * height)
+    return (
+        b"\x89PNG\r\n\x1a\n"
+        + chunk(b"IHDR", ihdr)
+        + chunk(b"IDAT", zlib.compress(raw, 9))
+        + chunk(b"IEND", b"")
+    )
+
+
 class Tile(object):
     """
     >>> l = Layer("name", maxresolution=0.019914, size="256,256")
     >>> t = Tile(l, 18, 20, 0)
     """
 
-    __slots__ = ("layer", "x", "y", "z", "data")
+    __slots__ = (
+        "layer",
+        "x",
+        "y",
+        "z",
+        "data",
+        "headers",
+        "deadline",
+        "variant",
+        "client",
+    )
 
     def __init__(self, layer, x, y, z):
         """
@@ -29,6 +74,11 @@ class Tile(object):
         self.y = y
         self.z = z
         self.data = None
+        self.headers = []
+        self.deadline = None
+        self.variant = None
+        # the client to charge for a backend render, see RateLimit
+        self.client = None
 
     def size(self):
         """
@@ -87,6 +137,18 @@ class Layer(object):
         "paletted",
         "spherical_mercator",
         "metadata",
+        "grid_limits",
+        "data_limits",
+        "max_y",
+        "overzoom",
+        "overzoom_budget",
+        "overzoom_ttl",
+        "immutable",
+        "immutable_after",
+        "deadline",
+        "optimize",
+        "quantize",
+        "variants",
     )
 
     config_properties = [
@@ -127,6 +189,74 @@ class Layer(object):
             "default": "",
             "type": "map",
         },
+        {
+            "name": "immutable",
+            "description": (
+                "The tiles of this layer never change.  Layers resolved "
+                "for an archive timestamp decide this for themselves."
+            ),
+            "default": "false",
+            "type": "boolean",
+        },
+        {
+            "name": "immutable_after",
+            "description": (
+                "Minutes after which an archive timestamp is settled and "
+                "its tiles are immutable."
+            ),
+            "default": "60",
+        },
+        {
+            "name": "overzoom",
+            "description": (
+                "When the backend fails or is slow, serve a tile upsampled "
+                "from an ancestor up to this many zoom levels above."
+            ),
+            "default": "0",
+        },
+        {
+            "name": "overzoom_budget",
+            "description": "Seconds to wait on the backend before that.",
+            "default": "5",
+        },
+        {
+            "name": "overzoom_ttl",
+            "description": "Cache-Control max-age of an upsampled tile.",
+            "default": "60",
+        },
+        {
+            "name": "deadline",
+            "description": (
+                "Seconds a request for a tile of this layer may take, "
+                "0 for no limit."
+            ),
+            "default": "0",
+        },
+        {
+            "name": "optimize",
+            "description": (
+                "Recompress the PNG tiles of immutable archive layers in a "
+                "background process, replacing the cached copy."
+            ),
+            "default": "false",
+            "type": "boolean",
+        },
+        {
+            "name": "quantize",
+            "description": (
+                "Reduce those tiles to an 8 bit palette, the default for "
+                "png256 layers.  Needs Pillow."
+            ),
+            "type": "boolean",
+        },
+        {
+            "name": "variants",
+            "description": (
+                "Comma separated formats, like webp, served instead to "
+                "clients that Accept them.  Needs Pillow."
+            ),
+            "default": "",
+        },
     ]
 
     def __init__(
@@ -151,6 +281,15 @@ class Layer(object):
         extent_type="strict",
         units="degrees",
         tms_type="",
+        overzoom=0,
+        overzoom_budget=5,
+        overzoom_ttl=60,
+        immutable="",
+        immutable_after=60,
+        deadline=0,
+        optimize="",
+        quantize=None,
+        variants="",
         **kwargs,
     ):
         """Take in parameters, usually from a config file, and create a Layer.
@@ -239,6 +378,30 @@ class Layer(object):
                 maxRes = float(maxresolution)
             self.resolutions = [maxRes / 2**i for i in range(int(levels))]
 
+        self.grid_limits = []
+        self.data_limits = []
+        self.max_y = []
+        for z in range(len(self.resolutions)):
+            self.grid_limits.append(self.gridLimit(z))
+            self.data_limits.append(self.dataLimit(z))
+            self.max_y.append(self.maxY(z))
+
+        self.immutable = immutable.lower() in ("true", "yes", "1")
+        self.immutable_after = float(immutable_after)
+
+        self.overzoom = int(overzoom)
+        self.overzoom_budget = float(overzoom_budget)
+        self.overzoom_ttl = int(overzoom_ttl)
+        self.deadline = float(deadline)
+        self.optimize = optimize.lower() in ("true", "yes", "1")
+        if quantize is None:
+            self.quantize = self.paletted
+        else:
+            self.quantize = quantize.lower() in ("true", "yes", "1")
+        self.variants = tuple(
+            v.strip().lower() for v in variants.split(",") if v.strip()
+        )
+
         self.watermarkimage = watermarkimage
 
         self.watermarkopacity = float(watermarkopacity)
@@ -298,6 +461,84 @@ class Layer(object):
         )
         return (width, height)
 
+    def gridLimit(self, z):
+        """
+        Number of tile columns and rows at a particular zoom level, a
+        partially covered column or row still counts.
+
+        >>> l = Layer("name")
+        >>> l.gridLimit(3)
+        (16, 8)
+        """
+        (width, height) = self.grid(z)
+        return (
+            max(1, int(math.ceil(width - 1e-6))),
+            max(1, int(math.ceil(height - 1e-6))),
+        )
+
+    def maxY(self, z):
+        """
+        Highest row at a zoom level, used to flip google style y values.
+
+        >>> l = Layer("name", spherical_mercator="yes")
+        >>> l.maxY(2)
+        3
+        """
+        res = self.resolutions[z]
+        return (
+            int(round((self.bbox[3] - self.bbox[1]) / (res * self.size[1])))
+            - 1
+        )
+
+    def tileRange(self, z, extent):
+        """
+        Inclusive (minx, miny, maxx, maxy) range of the tiles at a zoom
+        level that intersect extent, which is in the layer SRS.
+
+        >>> l = Layer("name")
+        >>> l.tileRange(3, (0, 0, 45, 45))
+        (8, 4, 9, 5)
+        """
+        (cols, rows) = self.gridLimit(z)
+        tile_w = self.resolutions[z] * self.size[0]
+        tile_h = self.resolutions[z] * self.size[1]
+        (minx, miny, maxx, maxy) = extent
+        return (
+            max(0, int(math.floor((minx - self.bbox[0]) / tile_w + 1e-6))),
+            max(0, int(math.floor((miny - self.bbox[1]) / tile_h + 1e-6))),
+            min(cols, int(math.ceil((maxx - self.bbox[0]) / tile_w - 1e-6)))
+            - 1,
+            min(rows, int(math.ceil((maxy - self.bbox[1]) / tile_h - 1e-6)))
+            - 1,
+        )
+
+    def dataLimit(self, z):
+        """
+        Inclusive (minx, miny, maxx, maxy) range of the tiles at a zoom
+        level that intersect the data extent.
+
+        >>> l = Layer("name", data_extent="0,0,45,45")
+        >>> l.dataLimit(3)
+        (8, 4, 9, 5)
+        """
+        return self.tileRange(z, self.data_extent)
+
+    def inGrid(self, tile):
+        """Does this tile exist in the layer grid?"""
+        (cols, rows) = self.grid_limits[tile.z]
+        return 0 <= tile.x < cols and 0 <= tile.y < rows
+
+    def inDataExtent(self, tile):
+        """Does this tile intersect the layer data extent?"""
+        (minx, miny, maxx, maxy) = self.data_limits[tile.z]
+        return minx <= tile.x <= maxx and miny <= tile.y <= maxy
+
+    def blankTile(self):
+        """The empty tile served outside the data extent, if any."""
+        if self.extension != "png":
+            return None
+        return blank_png(self.size[0], self.size[1])
+
     def fmt(self):
         """
         >>> l = Layer("name")
@@ -315,7 +556,7 @@ class Layer(object):
 
 
 class MetaLayer(Layer):
-    __slots__ = ("metaTile", "metaSize", "metaBuffer")
+    __slots__ = ("metaTile", "metaSize", "metaBuffer", "pyramid")
 
     config_properties = Layer.config_properties + [
         {"name": "name", "description": "Name of Layer"},
@@ -340,10 +581,31 @@ class MetaLayer(Layer):
                 "to include in the render request."
             ),
         },
+        {
+            "name": "pyramid",
+            "description": (
+                "Build the tiles at pyramid_zooms from their cached "
+                "children, only calling the backend when one is missing."
+            ),
+            "default": "false",
+            "type": "boolean",
+        },
+        {
+            "name": "pyramid_zooms",
+            "description": "Zoom levels built from their children",
+            "default": "0-5",
+        },
     ]
 
     def __init__(
-        self, name, metatile="", metasize=(5, 5), metabuffer=(10, 10), **kwargs
+        self,
+        name,
+        metatile="",
+        metasize=(5, 5),
+        metabuffer=(10, 10),
+        pyramid="",
+        pyramid_zooms="0-5",
+        **kwargs,
     ):
         Layer.__init__(self, name, **kwargs)
         self.metaTile = metatile.lower() in ("true", "yes", "1")
@@ -355,6 +617,17 @@ class MetaLayer(Layer):
                 metabuffer = (metabuffer[0], metabuffer[0])
         self.metaSize = metasize
         self.metaBuffer = metabuffer
+        self.pyramid = frozenset()
+        if pyramid.lower() in ("true", "yes", "1"):
+            self.pyramid = frozenset(
+                z
+                for z in parse_zooms(pyramid_zooms)
+                if Pyramid.composable(self, z)
+            )
 
     def render(self, tile, **kwargs):
+        if tile.z in self.pyramid:
+            data = Pyramid.from_children(self, tile)
+            if data:
+                return data
         return self.renderTile(tile)
@@ -24,14 +24,57 @@ class WMS(MetaLayer):
                 "protected backend WMS layers."
             ),
         },
+        {
+            "name": "stream",
+            "description": (
+                "Stream the backend response into a buffer sized from its "
+                "Content-Length, useful for large images."
+            ),
+            "default": "no",
+            "type": "boolean",
+        },
+        {
+            "name": "backends",
+            "description": (
+                "Comma separated host[:port] list of identical backends, "
+                "each request goes to the least busy healthy one in place "
+                "of the host found in url."
+            ),
+        },
+        {
+            "name": "hedge",
+            "description": (
+                "With backends, repeat a request to a second backend once "
+                "it takes longer than 95% of the recent ones."
+            ),
+            "default": "no",
+            "type": "boolean",
+        },
     ] + MetaLayer.config_properties
 
-    def __init__(self, name, url=None, user=None, password=None, **kwargs):
+    def __init__(
+        self,
+        name,
+        url=None,
+        user=None,
+        password=None,
+        stream="",
+        backends="",
+        hedge="",
+        **kwargs,
+    ):
         """Constructor"""
         MetaLayer.__init__(self, name, **kwargs)
         self.url = url
         self.user = user
         self.password = password
+        self.stream = stream.lower() in ("true", "yes", "1")
+        hosts = [h.strip() for h in backends.split(",") if h.strip()]
+        self.pool = None
+        if hosts:
+            self.pool = WMSClient.BackendPool(
+                hosts, hedge=hedge.lower() in ("true", "yes", "1")
+            )
 
     def renderTile(self, tile):
         wms = WMSClient.WMS(
@@ -46,6 +89,9 @@ class WMS(MetaLayer):
             },
             self.user,
             self.password,
+            self.stream,
+            self.pool,
+            tile.deadline,
         )
         tile.data = wms.fetch()
         return tile.data
@@ -0,0 +1,169 @@
+"""Which tiles are hot.
+
+BSD Licensed, Copyright (c) 2006-2010 TileCache Contributors
+
+With ``popularity=yes`` in ``[tilecache_options]`` every tile served by
+``Service.renderTile`` is counted in a count-min sketch, a fixed
+``popularity_width`` x 4 table of counters, so the memory does not grow
+with the number of tiles.  Every ``10 * popularity_width`` counts all
+counters are halved, letting yesterday's hot tiles cool off.  The
+``popularity_top`` most counted tiles are kept on the side, they are
+listed by a GET of ``/admin/popular`` and a POST there renders them again
+in the background.  From the command line::
+
+    python -m TileCache.Admin --url http://host/tilecache --token x \\
+        popular
+
+The sketch is kept by each process and starts empty with it.  Under a
+server running several worker processes each one counts only the
+requests it served, and ``/admin/popular`` answers with the counts of
+whichever worker took that request, a sample of the traffic rather than
+all of it.  A top list meant to cover every request needs a server
+running a single process, with threads.
+
+A ``SharedMemory`` cache with ``admission=tinylfu`` keeps a sketch of its
+own, of the lookups it sees, and only evicts a tile for one looked up
+more often, so a crawler walking many tiles once does not push out
+the hot ones.
+"""
+
+import hashlib
+import threading
+from array import array
+
+import TileCache.Layer as Layer
+from TileCache.base import (
+    Request,
+    TileCacheException,
+    TileCacheLayerNotFoundException,
+)
+from TileCache.Cache import YESVALS
+
+DEPTH = 4
+
+
+def tile_key(tile):
+    """The name of a tile in the sketch, like its TMS path"""
+    return f"{tile.layer.name}/{tile.z}/{tile.x}/{tile.y}"
+
+
+class Sketch(object):
+    """A count-min sketch with periodic halving and a top-K list"""
+
+    def __init__(self, width=4096, top=100, sample=None):
+        """Constructor, width counters per row and top keys kept aside"""
+        self.width = int(width)
+        self.top_size = int(top)
+        self.sample = int(sample) if sample else 10 * self.width
+        self.counters = array("I", bytes(4 * DEPTH * self.width))
+        self.additions = 0
+        self.top = {}
+        self.floor = 0
+        self._lock = threading.Lock()
+
+    def _indexes(self, key):
+        """The counter of key in each row"""
+        if isinstance(key, str):
+            key = key.encode("utf-8")
+        value = int.from_bytes(
+            hashlib.blake2b(key, digest_size=8).digest(), "little"
+        )
+        (h1, h2) = (value & 0xFFFFFFFF, (value >> 32) | 1)
+        return [
+            row * self.width + (h1 + row * h2) % self.width
+            for row in range(DEPTH)
+        ]
+
+    def estimate(self, key):
+        """How often key was counted, never too low"""
+        counters = self.counters
+        return min(counters[idx] for idx in self._indexes(key))
+
+    def add(self, key):
+        """Count key once, returns its new estimate"""
+        indexes = self._indexes(key)
+        with self._lock:
+            counters = self.counters
+            # conservative update, only the smallest counters grow
+            count = min(counters[idx] for idx in indexes) + 1
+            for idx in indexes:
+                if counters[idx] < count:
+                    counters[idx] = count
+            if self.top_size:
+                self._track(key, count)
+            self.additions += 1
+            if self.additions >= self.sample:
+                self._halve()
+        return count
+
+    def _track(self, key, count):
+        """Keep key aside when it is among the top counted ones"""
+        top = self.top
+        if key in top or len(top) < self.top_size:
+            top[key] = count
+        elif count > self.floor:
+            del top[min(top, key=top.get)]
+            top[key] = count
+        else:
+            return
+        if len(top) >= self.top_size:
+            self.floor = min(top.values())
+
+    def _halve(self):
+        counters = self.counters
+        for idx in range(len(counters)):
+            counters[idx] >>= 1
+        self.top = {
+            key: count >> 1 for key, count in self.top.items() if count > 1
+        }
+        self.floor >>= 1
+        self.additions = 0
+
+    def topk(self, limit=None):
+        """The top counted keys and their counts, most counted first"""
+        with self._lock:
+            ranked = sorted(self.top.items(), key=lambda kv: (-kv[1], kv[0]))
+        return ranked[:limit] if limit else ranked
+
+    def admit(self, candidate, victim):
+        """TinyLFU, should candidate replace victim in a full cache?"""
+        return self.estimate(candidate) > self.estimate(victim)
+
+
+def from_options(options):
+    """The sketch configured in [tilecache_options], if any, counting
+    the requests of this process only.
+    """
+    if options.get("popularity", "").lower() not in YESVALS:
+        return None
+    return Sketch(
+        options.get("popularity_width", 4096),
+        options.get("popularity_top", 100),
+    )
+
+
+def tiles(service, entries):
+    """The tiles named by (key, count) entries, skipping unknown layers"""
+    req = Request(service)
+    found = []
+    for key, _count in entries:
+        (name, z, x, y) = key.rsplit("/", 3)
+        try:
+            layer = req.getLayer(name)
+        except (
+            ValueError,
+            TileCacheException,
+            TileCacheLayerNotFoundException,
+        ):
+            continue
+        found.append(Layer.Tile(layer, int(x), int(y), int(z)))
+    return found
+
+
+def warm(service, entries):
+    """Render the tiles of (key, count) entries again, returns how many"""
+    rendered = 0
+    for tile in tiles(service, entries):
+        service.renderTile(tile, force=True)
+        rendered += 1
+    return rendered
@@ -0,0 +1,151 @@
+"""Build low zoom tiles from their cached children.
+
+BSD Licensed, Copyright (c) 2006-2010 TileCache Contributors
+
+A layer with ``pyramid=yes`` composes tiles at its ``pyramid_zooms`` from
+the four z+1 children found in the cache, downsampling them in-process,
+and only calls the backend when a child is missing.  Seeding walks the
+zoom levels bottom-up so every parent finds its children cached::
+
+    python -m TileCache.Pyramid --config tilecache.cfg --layer usstates \\
+        --zooms 0-6
+"""
+
+import argparse
+import sys
+
+import TileCache.Imaging as Imaging
+import TileCache.Layer as Layer
+from TileCache.base import Request, parse_zooms
+
+
+def composable(layer, z):
+    """Can the tiles of a zoom level be built from the level below?"""
+    if z + 1 >= len(layer.resolutions):
+        return False
+    ratio = layer.resolutions[z] / layer.resolutions[z + 1]
+    return abs(ratio - 2.0) < 1e-6
+
+
+def children(tile):
+    """The (column, row) placement and the z+1 children of a tile.
+
+    Rows are counted from the top, while TMS y grows to the north.
+    """
+    found = []
+    for dy in (0, 1):
+        for dx in (0, 1):
+            child = Layer.Tile(
+                tile.layer, tile.x * 2 + dx, tile.y * 2 + dy, tile.z + 1
+            )
+            found.append(((dx, 1 - dy), child))
+    return found
+
+
+def from_children(layer, tile):
+    """Compose tile from cached children, None if any of them is missing."""
+    if not Imaging.available() or layer.cache is None:
+        return None
+    placed = {}
+    wanted = []
+    for position, child in children(tile):
+        if not layer.inGrid(child):
+            placed[position] = None
+        elif not layer.inDataExtent(child) and layer.blankTile():
+            placed[position] = None
+        else:
+            wanted.append((position, child))
+    datas = layer.cache.get_many([child for _pos, child in wanted])
+    for (position, _child), data in zip(wanted, datas, strict=True):
+        if not data:
+            return None
+        placed[position] = data
+    return Imaging.compose_children(placed, tuple(layer.size), layer.extension)
+
+
+def from_ancestor(layer, tile, levels):
+    """Upsample the nearest cached ancestor within levels zooms of tile.
+
+    Returns the image and how many zoom levels up it came from, or
+    (None, 0) when no ancestor is cached.
+    """
+    if not Imaging.available() or layer.cache is None:
+        return (None, 0)
+    ancestors = [
+        Layer.Tile(layer, tile.x >> depth, tile.y >> depth, tile.z - depth)
+        for depth in range(1, min(levels, tile.z) + 1)
+    ]
+    datas = layer.cache.get_many(ancestors)
+    for depth, (ancestor, data) in enumerate(
+        zip(ancestors, datas, strict=True), start=1
+    ):
+        if not data:
+            continue
+        col = tile.x - (ancestor.x << depth)
+        row = (1 << depth) - 1 - (tile.y - (ancestor.y << depth))
+        image = Imaging.upsample_part(
+            data, tuple(layer.size), depth, col, row, layer.extension
+        )
+        return (image, depth)
+    return (None, 0)
+
+
+def tile_range(layer, z, bbox=None):
+    """Inclusive (minx, miny, maxx, maxy) range of the tiles at zoom z
+    within bbox, limited to the data extent.
+    """
+    (minx, miny, maxx, maxy) = layer.dataLimit(z)
+    if bbox is not None:
+        (bminx, bminy, bmaxx, bmaxy) = layer.tileRange(z, bbox)
+        (minx, miny) = (max(minx, bminx), max(miny, bminy))
+        (maxx, maxy) = (min(maxx, bmaxx), min(maxy, bmaxy))
+    return (minx, miny, maxx, maxy)
+
+
+def tiles(layer, z, bbox=None):
+    """The tiles at zoom z within bbox, limited to the data extent"""
+    (minx, miny, maxx, maxy) = tile_range(layer, z, bbox)
+    for y in range(miny, maxy + 1):
+        for x in range(minx, maxx + 1):
+            yield Layer.Tile(layer, x, y, z)
+
+
+def seed(service, layer, zooms, bbox=None, force=False):
+    """Render zooms bottom-up, returns the number of tiles rendered.
+
+    The deepest level comes from the backend and, for a pyramid layer,
+    every level above it is composed from the one just rendered.
+    """
+    count = 0
+    for z in sorted(zooms, reverse=True):
+        for tile in tiles(layer, z, bbox):
+            service.renderTile(tile, force)
+            count += 1
+    return count
+
+
+def main(argv=None):
+    """Command line entry point"""
+    # Service imports this module by way of Layer
+    from TileCache.Service import Service
+
+    parser = argparse.ArgumentParser(description="Seed a tile pyramid")
+    parser.add_argument("--config", required=True)
+    parser.add_argument("--layer", required=True)
+    parser.add_argument("--zooms", required=True, help="like 0-6")
+    parser.add_argument("--bbox", help="minx,miny,maxx,maxy in layer SRS")
+    parser.add_argument("--force", action="store_true")
+    args = parser.parse_args(argv)
+
+    service = Service.load(args.config)
+    layer = Request(service).getLayer(args.layer)
+    bbox = None
+    if args.bbox:
+        bbox = list(map(float, args.bbox.split(",")))
+    count = seed(service, layer, parse_zooms(args.zooms), bbox, args.force)
+    sys.stdout.write(f"Rendered {count} tiles of {args.layer}\n")
+    return 0
+
+
+if __name__ == "__main__":
+    sys.exit(main())
@@ -0,0 +1,177 @@
+"""Per-client limits on backend renders.
+
+BSD Licensed, Copyright (c) 2006-2010 TileCache Contributors
+
+With ``ratelimit_rate`` in ``[tilecache_options]`` each client may cause
+that many backend renders per second, in bursts of up to
+``ratelimit_burst`` (by default four seconds worth).  Cache hits are free,
+only the render of a miss takes a token.  ``FORCE`` re-renders take theirs
+from a stricter bucket of their own, ``ratelimit_force_rate`` (by default
+a tenth of the rate) and ``ratelimit_force_burst`` (by default 1).  A
+request finding its bucket empty gets a 429 with a Retry-After header
+before anything is asked of the backend.
+
+Clients are told apart by ``ratelimit_key``: ``address``, the default, is
+the REMOTE_ADDR, ``forwarded`` the X-Forwarded-For address appended by the
+outermost of ``ratelimit_proxies`` trusted proxies (by default 1, the
+right-most address, as the ones before it are whatever the client sent)
+and ``referrer`` the host of the Referer, each falling back to the
+address.
+The buckets are kept by each process, unless ``ratelimit_shared=yes`` and
+the cache is Memcached, then they are kept there and updated with
+gets/cas, so that all workers draw from the same bucket.
+"""
+
+import hashlib
+import math
+import sys
+import threading
+import time
+from urllib.parse import urlsplit
+
+from TileCache import RateLimited
+from TileCache.Cache import YESVALS
+
+# buckets kept per process, the least recently used is forgotten first
+MAX_CLIENTS = 10000
+CAS_ATTEMPTS = 3
+
+
+def refill(state, rate, burst, now):
+    """The tokens of a bucket last seen as (tokens, stamp), or new"""
+    if state is None:
+        return float(burst)
+    (tokens, stamp) = state
+    return min(float(burst), tokens + max(0.0, now - stamp) * rate)
+
+
+def take(tokens, rate):
+    """Take a token, returns the tokens left and the seconds to wait,
+    zero when the token was there.
+    """
+    if tokens >= 1.0:
+        return tokens - 1.0, 0.0
+    return tokens, (1.0 - tokens) / rate
+
+
+class Limiter(object):
+    """Token buckets for the backend renders of each client"""
+
+    def __init__(
+        self,
+        rate,
+        burst=None,
+        force_rate=None,
+        force_burst=None,
+        key="address",
+        shared=None,
+        proxies=1,
+    ):
+        """Constructor, shared is a memcached client to keep buckets in"""
+        rate = float(rate)
+        force_rate = float(force_rate or rate / 10.0)
+        self.limits = {
+            False: (rate, float(burst or 4.0 * rate)),
+            True: (force_rate, float(force_burst or 1.0)),
+        }
+        self.key = key
+        self.shared = shared
+        self.proxies = max(1, int(proxies))
+        self.buckets = {}
+        self._lock = threading.Lock()
+
+    def client(self, environ):
+        """The name of the client making a request"""
+        address = environ.get("REMOTE_ADDR", "")
+        if self.key == "forwarded":
+            forwarded = [
+                hop.strip()
+                for hop in environ.get("HTTP_X_FORWARDED_FOR", "").split(",")
+                if hop.strip()
+            ]
+            if not forwarded:
+                return address
+            return forwarded[-min(self.proxies, len(forwarded))]
+        if self.key == "referrer":
+            referrer = environ.get("HTTP_REFERER", "")
+            return urlsplit(referrer).hostname or address
+        return address
+
+    def charge(self, client, force=False):
+        """Take a token for a backend render, raises RateLimited"""
+        (rate, burst) = self.limits[force]
+        name = f"{'force' if force else 'render'}/{client}"
+        if self.shared is not None:
+            wait = self._takeShared(name, rate, burst)
+        else:
+            wait = self._take(name, rate, burst)
+        if wait:
+            raise RateLimited(
+                f"Too many {'FORCE ' if force else ''}renders, "
+                f"retry in {math.ceil(wait)}s",
+                wait,
+            )
+
+    def _take(self, name, rate, burst):
+        with self._lock:
+            now = time.monotonic()
+            # popped and put back, the dict stays in least recent order
+            tokens = refill(self.buckets.pop(name, None), rate, burst, now)
+            (tokens, wait) = take(tokens, rate)
+            self.buckets[name] = (tokens, now)
+            if len(self.buckets) > MAX_CLIENTS:
+                del self.buckets[next(iter(self.buckets))]
+        return wait
+
+    def _takeShared(self, name, rate, burst):
+        """Take a token from a memcached bucket, failing open on errors"""
+        digest = hashlib.blake2b(name.encode("utf-8"), digest_size=16)
+        key = f"ratelimit/{digest.hexdigest()}"
+        # a bucket untouched this long is full again
+        ttl = int(burst / rate) + 1
+        try:
+            for _attempt in range(CAS_ATTEMPTS):
+                now = time.time()
+                (value, cas) = self.shared.gets(key)
+                state = None
+                if value:
+                    state = tuple(map(float, value.split(b" ")))
+                (tokens, wait) = take(refill(state, rate, burst, now), rate)
+                if wait:
+                    return wait
+                value = f"{tokens:.3f} {now:.3f}".encode("ascii")
+                if cas is None:
+                    stored = self.shared.add(key, value, ttl, noreply=False)
+                else:
+                    stored = self.shared.cas(key, value, cas, ttl)
+                if stored:
+                    return 0.0
+        except Exception:
+            # Yes, we are silently ignoring errors here.
+            pass
+        return 0.0
+
+
+def from_options(options, cache):
+    """The limiter configured in [tilecache_options], if any"""
+    rate = float(options.get("ratelimit_rate", 0))
+    if not rate:
+        return None
+    shared = None
+    if options.get("ratelimit_shared", "").lower() in YESVALS:
+        shared = getattr(cache, "cache", None)
+        if not hasattr(shared, "gets"):
+            sys.stderr.write(
+                "TileCache ratelimit_shared needs a Memcached cache, "
+                "keeping the buckets per process\n"
+            )
+            shared = None
+    return Limiter(
+        rate,
+        options.get("ratelimit_burst"),
+        options.get("ratelimit_force_rate"),
+        options.get("ratelimit_force_burst"),
+        options.get("ratelimit_key", "address"),
+        shared,
+        options.get("ratelimit_proxies", 1),
+    )
@@ -0,0 +1,300 @@
+"""Replay recorded tile requests to help size a deployment.
+
+Requests are read from Apache/nginx access logs or from a plain list of
+TMS paths or URLs, and replayed either in-process against ``wsgiHandler``
+with a stub WMS backend, or against a running server::
+
+    python -m TileCache.Replay --config tilecache.cfg access.log
+    python -m TileCache.Replay --url http://localhost/c/tile.py urls.txt
+
+A summary of hit ratio, latency and backend calls per layer family is
+written to stdout.
+"""
+
+import argparse
+import io
+import re
+import sys
+import threading
+import time
+from concurrent.futures import ThreadPoolExecutor
+from datetime import datetime
+from urllib.parse import unquote, urlsplit
+
+import requests
+
+import TileCache.Client as Client
+from TileCache.base import layer_family
+from TileCache.Layer import blank_png
+from TileCache.Service import Service, wsgiHandler
+
+# Common and combined log format, as written by Apache and nginx
+LOGLINE = re.compile(
+    r'^\S+ \S+ \S+ \[(?P<ts>[^\]]+)\] "(?:GET|HEAD) (?P<uri>\S+)[^"]*" '
+    r"(?P<status>\d{3})"
+)
+LOGTIME = "%d/%b/%Y:%H:%M:%S %z"
+
+
+class Entry(object):
+    """A request to be replayed"""
+
+    __slots__ = ("timestamp", "path", "query", "family")
+
+    def __init__(self, timestamp, path, query=""):
+        """Constructor"""
+        self.timestamp = timestamp
+        self.path = path
+        self.query = query
+        parts = [p for p in path.split("/") if p]
+        self.family = layer_family(parts[1]) if len(parts) > 1 else "-"
+
+
+class Result(object):
+    """The outcome of one replayed request"""
+
+    __slots__ = ("family", "status", "latency", "backend_calls")
+
+    def __init__(self, family, status, latency, backend_calls=None):
+        """Constructor"""
+        self.family = family
+        self.status = status
+        self.latency = latency
+        self.backend_calls = backend_calls
+
+
+def parse_line(line):
+    """Turn a log line, URL or path into an Entry, or None to skip it."""
+    line = line.strip()
+    if not line or line.startswith("#"):
+        return None
+    timestamp = None
+    match = LOGLINE.match(line)
+    if match:
+        timestamp = datetime.strptime(match["ts"], LOGTIME).timestamp()
+        line = match["uri"]
+    parts = urlsplit(line)
+    start = parts.path.find("/1.0.0/")
+    if start == -1:
+        return None
+    return Entry(timestamp, unquote(parts.path[start:]), parts.query)
+
+
+def read_entries(files):
+    """Yield the entries found in the given files, "-" being stdin."""
+    for fn in files:
+        fh = sys.stdin if fn == "-" else open(fn, encoding="utf-8")
+        with fh:
+            for line in fh:
+                entry = parse_line(line)
+                if entry is not None:
+                    yield entry
+
+
+class StubBackend(object):
+    """Stand in for the WMS backend, counting the calls made to it."""
+
+    def __init__(self, latency=0.0, size=(256, 256)):
+        """Constructor"""
+        self.latency = latency
+        self.image = blank_png(*size)
+        self.calls = 0
+        self._local = threading.local()
+        self._lock = threading.Lock()
+        self._original = None
+
+    def reset(self):
+        """Start counting calls for a new request on this thread."""
+        self._local.calls = 0
+
+    def thread_calls(self):
+        """Backend calls made by the current request on this thread."""
+        return getattr(self._local, "calls", 0)
+
+    def fetch(self, _wms):
+        """Replacement for Client.WMS.fetch"""
+        self._local.calls = self.thread_calls() + 1
+        with self._lock:
+            self.calls += 1
+        if self.latency:
+            time.sleep(self.latency)
+        return self.image
+
+    def __enter__(self):
+        self._original = Client.WMS.fetch
+        stub = self
+
+        def fetch(wms):
+            return stub.fetch(wms)
+
+        Client.WMS.fetch = fetch
+        return self
+
+    def __exit__(self, *args):
+        Client.WMS.fetch = self._original
+
+
+def local_runner(service, stub):
+    """Build a function replaying one entry through wsgiHandler."""
+
+    def run(entry):
+        status = []
+        environ = {
+            "PATH_INFO": entry.path,
+            "QUERY_STRING": entry.query,
+            "REQUEST_METHOD": "GET",
+            "SCRIPT_NAME": "",
+            "HTTP_HOST": "localhost",
+            "wsgi.input": io.BytesIO(),
+        }
+        stub.reset()
+        start = time.perf_counter()
+        try:
+            wsgiHandler(
+                environ, lambda s, h: status.append(int(s[:3])), service
+            )
+        except Exception:
+            status.append(400)
+        latency = time.perf_counter() - start
+        return Result(entry.family, status[0], latency, stub.thread_calls())
+
+    return run
+
+
+def remote_runner(base):
+    """Build a function replaying one entry against a tilecache URL."""
+    session = requests.Session()
+    base = base.rstrip("/")
+
+    def run(entry):
+        url = base + entry.path
+        if entry.query:
+            url += "?" + entry.query
+        start = time.perf_counter()
+        try:
+            status = session.get(url, timeout=60).status_code
+        except requests.RequestException:
+            status = 599
+        return Result(entry.family, status, time.perf_counter() - start)
+
+    return run
+
+
+def replay(entries, run, concurrency=8, speedup=0.0):
+    """Replay entries with run, pacing them by their timestamps / speedup.
+
+    A speedup of 0 replays the entries as fast as concurrency allows.
+    """
+    futures = []
+    first = None
+    start = time.monotonic()
+    with ThreadPoolExecutor(max_workers=concurrency) as pool:
+        for entry in entries:
+            if speedup > 0 and entry.timestamp is not None:
+                if first is None:
+                    first = entry.timestamp
+                delay = (entry.timestamp - first) / speedup
+                wait = start + delay - time.monotonic()
+                if wait > 0:
+                    time.sleep(wait)
+            futures.append(pool.submit(run, entry))
+    return [f.result() for f in futures]
+
+
+def percentile(values, pct):
+    """Nearest rank percentile of an already sorted list."""
+    if not values:
+        return 0.0
+    idx = min(len(values) - 1, int(round(pct / 100.0 * (len(values) - 1))))
+    return values[idx]
+
+
+def summarize(results):
+    """Aggregate results into per family rows plus an overall row."""
+    families = {}
+    for res in results:
+        families.setdefault(res.family, []).append(res)
+    rows = []
+    for family, items in sorted(families.items()) + [("TOTAL", results)]:
+        latencies = sorted(r.latency * 1000.0 for r in items)
+        served = [r for r in items if r.status == 200]
+        calls = [r.backend_calls for r in items if r.backend_calls is not None]
+        hits = None
+        if served and len(calls) == len(items):
+            hits = 100.0 * sum(1 for r in served if not r.backend_calls)
+            hits /= len(served)
+        rows.append(
+            {
+                "family": family,
+                "requests": len(items),
+                "ok": len(served),
+                "hit": hits,
+                "p50": percentile(latencies, 50),
+                "p90": percentile(latencies, 90),
+                "p99": percentile(latencies, 99),
+                "max": latencies[-1] if latencies else 0.0,
+                "backend": sum(calls) if len(calls) == len(items) else None,
+            }
+        )
+    return rows
+
+
+def format_report(rows):
+    """Render summarize() rows as a text table."""
+    lines = [
+        f"{'family':<24} {'reqs':>7} {'ok':>7} {'hit%':>6} {'p50ms':>8} "
+        f"{'p90ms':>8} {'p99ms':>8} {'maxms':>8} {'backend':>8}"
+    ]
+    for row in rows:
+        hit = "-" if row["hit"] is None else f"{row['hit']:.1f}"
+        backend = "-" if row["backend"] is None else str(row["backend"])
+        lines.append(
+            f"{row['family']:<24} {row['requests']:>7} {row['ok']:>7} "
+            f"{hit:>6} {row['p50']:>8.1f} {row['p90']:>8.1f} "
+            f"{row['p99']:>8.1f} {row['max']:>8.1f} {backend:>8}"
+        )
+    return "\n".join(lines) + "\n"
+
+
+def main(argv=None):
+    """Command line entry point"""
+    parser = argparse.ArgumentParser(description=__doc__.split("\n")[0])
+    parser.add_argument("files", nargs="+", help="access logs or URL lists")
+    target = parser.add_mutually_exclusive_group(required=True)
+    target.add_argument("--config", help="replay in-process with this cfg")
+    target.add_argument("--url", help="replay against this tilecache URL")
+    parser.add_argument("--concurrency", type=int, default=8)
+    parser.add_argument(
+        "--speedup",
+        type=float,
+        default=0.0,
+        help="replay log timestamps this much faster, 0 for no pacing",
+    )
+    parser.add_argument(
+        "--backend-latency",
+        type=float,
+        default=0.0,
+        help="seconds the stub WMS backend takes per render",
+    )
+    args = parser.parse_args(argv)
+
+    entries = read_entries(args.files)
+    if args.url:
+        results = replay(
+            entries, remote_runner(args.url), args.concurrency, args.speedup
+        )
+    else:
+        service = Service.load(args.config)
+        with StubBackend(args.backend_latency) as stub:
+            results = replay(
+                entries,
+                local_runner(service, stub),
+                args.concurrency,
+                args.speedup,
+            )
+    sys.stdout.write(format_report(summarize(results)))
+    return 0
+
+
+if __name__ == "__main__":
+    sys.exit(main())
@@ -0,0 +1,310 @@
+"""Seed a layer from several workers at once.
+
+BSD Licensed, Copyright (c) 2006-2010 TileCache Contributors
+
+A seeding job, a layer, zoom levels and optionally a bbox, is split into
+work units of ``metaSize`` tiles, aligned on the metatile grid of the
+layer so that no two workers render the same metatile.  Any number of
+workers, on any number of hosts, run the same command::
+
+    python -m TileCache.Seed --config tilecache.cfg --layer usstates \\
+        --zooms 0-8 --leases sqlite:/shared/seed.sqlite
+
+and claim units through a lease, which is renewed while the unit renders.
+A unit is marked done once all its tiles are cached, and that mark is the
+checkpoint: running the command again resumes the job, skipping the done
+units, and the unit of a worker that died is claimed by another once its
+lease runs out.  Zoom levels are seeded bottom-up, all units of a level
+are done before any of the level above starts, so that a pyramid layer
+finds the children it composes from.
+
+The leases are kept in a SQLite file, which should be on storage all the
+workers can lock, or in memcached with ``--leases memcached`` (the cache
+of the service) or ``--leases memcached:host:port,...``.  Memcached may
+evict the done marks of a long job, so SQLite is the better checkpoint.
+"""
+
+import argparse
+import hashlib
+import os
+import socket
+import sqlite3
+import sys
+import time
+
+import TileCache.Layer as Layer
+from TileCache.base import Request, TileCacheException, parse_zooms
+from TileCache.Pyramid import tile_range
+
+SCHEMA = (
+    "CREATE TABLE IF NOT EXISTS leases (job TEXT NOT NULL, "
+    "z INTEGER NOT NULL, x INTEGER NOT NULL, y INTEGER NOT NULL, "
+    "owner TEXT, expires REAL NOT NULL DEFAULT 0, "
+    "done INTEGER NOT NULL DEFAULT 0, PRIMARY KEY (job, z, x, y))"
+)
+
+
+def job_id(layer, zooms, bbox=None, force=False):
+    """Name a job, the same for every worker running the same command"""
+    spec = f"{layer.name}|{sorted(zooms)}|{bbox}|{force}"
+    return hashlib.blake2b(spec.encode("utf-8"), digest_size=8).hexdigest()
+
+
+def unit_size(layer):
+    """The (columns, rows) of tiles in a work unit"""
+    return tuple(getattr(layer, "metaSize", None) or (5, 5))
+
+
+def units(layer, z, bbox=None, size=(5, 5)):
+    """The (z, x, y) origins of the units covering zoom z, metatile
+    aligned, bottom left first.
+    """
+    (minx, miny, maxx, maxy) = tile_range(layer, z, bbox)
+    (cols, rows) = size
+    for y in range(miny - miny % rows, maxy + 1, rows):
+        for x in range(minx - minx % cols, maxx + 1, cols):
+            yield (z, x, y)
+
+
+def unit_tiles(layer, unit, bbox=None, size=(5, 5)):
+    """The tiles of a unit, limited to the job"""
+    (z, ux, uy) = unit
+    (minx, miny, maxx, maxy) = tile_range(layer, z, bbox)
+    for y in range(max(uy, miny), min(uy + size[1] - 1, maxy) + 1):
+        for x in range(max(ux, minx), min(ux + size[0] - 1, maxx) + 1):
+            yield Layer.Tile(layer, x, y, z)
+
+
+def owner_id():
+    """Name this worker"""
+    return f"{socket.gethostname()}:{os.getpid()}"
+
+
+class SQLiteLeases(object):
+    """Leases and done marks kept in a SQLite file"""
+
+    def __init__(self, path, job, ttl=300, owner=None):
+        """Constructor"""
+        self.job = job
+        self.ttl = float(ttl)
+        self.owner = owner or owner_id()
+        # no WAL, it needs shared memory that network storage lacks
+        self.conn = sqlite3.connect(path, timeout=60)
+        with self.conn:
+            self.conn.execute(SCHEMA)
+
+    def isDone(self, unit):
+        """Was the unit seeded?"""
+        row = self.conn.execute(
+            "SELECT done FROM leases WHERE job = ? AND z = ? AND x = ? "
+            "AND y = ?",
+            (self.job, *unit),
+        ).fetchone()
+        return bool(row and row[0])
+
+    def claim(self, unit):
+        """Take the lease of a unit, unless done or leased to another"""
+        now = time.time()
+        with self.conn:
+            cursor = self.conn.execute(
+                "INSERT INTO leases (job, z, x, y, owner, expires) "
+                "VALUES (?, ?, ?, ?, ?, ?) "
+                "ON CONFLICT (job, z, x, y) DO UPDATE SET "
+                "owner = excluded.owner, expires = excluded.expires "
+                "WHERE done = 0 AND (expires < ? OR owner = excluded.owner)",
+                (self.job, *unit, self.owner, now + self.ttl, now),
+            )
+        return cursor.rowcount == 1
+
+    def renew(self, unit):
+        """Extend the lease of a unit held by this worker"""
+        with self.conn:
+            self.conn.execute(
+                "UPDATE leases SET expires = ? WHERE job = ? AND z = ? "
+                "AND x = ? AND y = ? AND owner = ?",
+                (time.time() + self.ttl, self.job, *unit, self.owner),
+            )
+
+    def finish(self, unit):
+        """Mark a unit done"""
+        with self.conn:
+            self.conn.execute(
+                "INSERT INTO leases (job, z, x, y, done) "
+                "VALUES (?, ?, ?, ?, 1) "
+                "ON CONFLICT (job, z, x, y) DO UPDATE SET "
+                "done = 1, owner = NULL",
+                (self.job, *unit),
+            )
+
+    def release(self, unit):
+        """Give up the lease of a unit, for another worker to take"""
+        with self.conn:
+            self.conn.execute(
+                "UPDATE leases SET expires = 0 WHERE job = ? AND z = ? "
+                "AND x = ? AND y = ? AND owner = ?",
+                (self.job, *unit, self.owner),
+            )
+
+
+class MemcachedLeases(object):
+    """Leases and done marks kept in memcached"""
+
+    def __init__(self, client, job, ttl=300, owner=None):
+        """Constructor, client is a pymemcache client"""
+        self.client = client
+        self.job = job
+        self.ttl = int(ttl)
+        self.owner = (owner or owner_id()).encode("utf-8")
+
+    def key(self, unit):
+        """The key of the lease of a unit"""
+        return "seed/%s/%s/%s/%s" % (self.job, *unit)
+
+    def isDone(self, unit):
+        """Was the unit seeded?"""
+        return self.client.get(self.key(unit) + "/done") is not None
+
+    def claim(self, unit):
+        """Take the lease of a unit, unless done or leased to another"""
+        if self.isDone(unit):
+            return False
+        return bool(
+            self.client.add(
+                self.key(unit), self.owner, self.ttl, noreply=False
+            )
+        )
+
+    def renew(self, unit):
+        """Extend the lease of a unit held by this worker, a lease that
+        expired and was claimed by another worker is left to them.
+        """
+        key = self.key(unit)
+        (owner, cas) = self.client.gets(key)
+        if owner == self.owner:
+            self.client.cas(key, self.owner, cas, self.ttl)
+
+    def finish(self, unit):
+        """Mark a unit done"""
+        self.client.set(self.key(unit) + "/done", b"1", 0, noreply=False)
+        self.client.delete(self.key(unit))
+
+    def release(self, unit):
+        """Give up the lease of a unit, for another worker to take"""
+        if self.client.get(self.key(unit)) == self.owner:
+            self.client.delete(self.key(unit))
+
+
+def render_unit(service, layer, unit, leases, bbox=None, force=False):
+    """Render the tiles of a leased unit, returns how many"""
+    count = 0
+    renewed = time.monotonic()
+    for tile in unit_tiles(layer, unit, bbox, unit_size(layer)):
+        service.renderTile(tile, force)
+        count += 1
+        if time.monotonic() - renewed > leases.ttl / 3.0:
+            leases.renew(unit)
+            renewed = time.monotonic()
+    return count
+
+
+def run(service, layer, zooms, leases, bbox=None, force=False, poll=5.0):
+    """Work on a job next to the other workers, returns the number of
+    tiles this worker rendered once the whole job is done.
+    """
+    size = unit_size(layer)
+    rendered = 0
+    for z in sorted(zooms, reverse=True):
+        pending = list(units(layer, z, bbox, size))
+        while pending:
+            waiting = []
+            for unit in pending:
+                if leases.isDone(unit):
+                    continue
+                if not leases.claim(unit):
+                    waiting.append(unit)
+                    continue
+                try:
+                    rendered += render_unit(
+                        service, layer, unit, leases, bbox, force
+                    )
+                except Exception:
+                    leases.release(unit)
+                    raise
+                leases.finish(unit)
+            pending = waiting
+            if pending:
+                # leased to others, wait for them or for the leases to end
+                time.sleep(poll)
+    return rendered
+
+
+def progress(layer, zooms, leases, bbox=None):
+    """The number of done units and of all units of a job"""
+    size = unit_size(layer)
+    done = total = 0
+    for z in zooms:
+        for unit in units(layer, z, bbox, size):
+            total += 1
+            done += leases.isDone(unit)
+    return done, total
+
+
+def make_leases(service, spec, job, ttl):
+    """The lease store described by --leases"""
+    # pymemcache is only needed for memcached leases
+    from TileCache.Caches.Memcached import Memcached
+
+    if spec.startswith("sqlite:"):
+        return SQLiteLeases(spec[len("sqlite:") :], job, ttl)
+    if spec == "memcached":
+        if not isinstance(service.cache, Memcached):
+            raise TileCacheException(
+                "The cache of the service is not memcached"
+            )
+        return MemcachedLeases(service.cache.cache, job, ttl)
+    if spec.startswith("memcached:"):
+        client = Memcached(servers=spec[len("memcached:") :]).cache
+        return MemcachedLeases(client, job, ttl)
+    raise TileCacheException(f"Unknown lease store {spec}")
+
+
+def main(argv=None):
+    """Command line entry point"""
+    from TileCache.Service import Service
+
+    parser = argparse.ArgumentParser(description="Seed a layer, distributed")
+    parser.add_argument("--config", required=True)
+    parser.add_argument("--layer", required=True)
+    parser.add_argument("--zooms", required=True, help="like 0-6")
+    parser.add_argument("--bbox", help="minx,miny,maxx,maxy in layer SRS")
+    parser.add_argument("--force", action="store_true")
+    parser.add_argument(
+        "--leases",
+        required=True,
+        help="sqlite:PATH, memcached or memcached:host:port,...",
+    )
+    parser.add_argument("--lease-ttl", type=float, default=300, help="seconds")
+    parser.add_argument(
+        "--status", action="store_true", help="report progress and exit"
+    )
+    args = parser.parse_args(argv)
+
+    service = Service.load(args.config)
+    layer = Request(service).getLayer(args.layer)
+    zooms = parse_zooms(args.zooms)
+    bbox = None
+    if args.bbox:
+        bbox = list(map(float, args.bbox.split(",")))
+    job = job_id(layer, zooms, bbox, args.force)
+    leases = make_leases(service, args.leases, job, args.lease_ttl)
+    if args.status:
+        done, total = progress(layer, zooms, leases, bbox)
+        sys.stdout.write(f"Job {job}: {done} of {total} units done\n")
+        return 0
+    count = run(service, layer, zooms, leases, bbox, args.force)
+    sys.stdout.write(f"Job {job} done, rendered {count} tiles here\n")
+    return 0
+
+
+if __name__ == "__main__":
+    sys.exit(main())
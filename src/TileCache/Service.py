@@ -1,22 +1,38 @@
 """BSD Licensed, Copyright (c) 2006-2010 TileCache Contributors"""
 
+import concurrent.futures
 import configparser
 import email
+import math
 import os
 import sys
+import threading
 import time
 import traceback
+from collections.abc import Mapping
+from urllib.parse import parse_qsl
 
-from paste.request import parse_formvars
-
+import TileCache.Bundle as Bundle
 import TileCache.Cache as Cache
+import TileCache.Frames as Frames
+import TileCache.Imaging as Imaging
 import TileCache.Layer as Layer
+import TileCache.Popularity as Popularity
+import TileCache.Pyramid as Pyramid
+import TileCache.RateLimit as RateLimit
+import TileCache.Timing as Timing
 from TileCache import (
     BackendWMSFailure,
+    DeadlineExceeded,
     InvalidTMSRequest,
+    OutOfBoundsTile,
     OutOfBoundsZoomLevel,
+    RateLimited,
+    time_left,
 )
+from TileCache.Background import Background, Processes, log_failure
 from TileCache.base import (
+    Capabilities,
     MalformedRequestException,
     TileCacheException,
     TileCacheFutureException,
@@ -31,6 +47,30 @@ cfgfiles = (
 )
 
 
+def negotiate(accept, variants):
+    """The first of the variants the Accept header explicitly asks for"""
+    if not variants or not accept:
+        return None
+    accepted = set()
+    for item in accept.split(","):
+        (media, _sep, params) = item.partition(";")
+        quality = 1.0
+        for param in params.split(";"):
+            (name, _sep, value) = param.strip().partition("=")
+            if name == "q":
+                try:
+                    quality = float(value)
+                except ValueError:
+                    quality = 0.0
+        if quality > 0:
+            accepted.add(media.strip().lower())
+    for variant in variants:
+        if Imaging.VARIANTS.get(variant) in accepted:
+            if Imaging.can_transcode(variant):
+                return variant
+    return None
+
+
 def import_module(name):
     """Helper module to import any module based on a name"""
     mod = __import__(name)
@@ -40,6 +80,112 @@ def import_module(name):
     return mod
 
 
+class QueryParams(Mapping):
+    """Request parameters, parsed from QUERY_STRING on first access.
+
+    The request body is only read for a form POST, as used by the admin
+    requests, tile requests never pay for it.
+    """
+
+    __slots__ = ("environ", "_params")
+
+    def __init__(self, environ):
+        """Constructor"""
+        self.environ = environ
+        self._params = None
+
+    def _parse(self):
+        if self._params is not None:
+            return self._params
+        params = {}
+        environ = self.environ
+        for key, value in parse_qsl(
+            environ.get("QUERY_STRING", ""), keep_blank_values=True
+        ):
+            params[key] = value
+        if environ.get("REQUEST_METHOD") == "POST" and environ.get(
+            "CONTENT_TYPE", ""
+        ).startswith("application/x-www-form-urlencoded"):
+            length = int(environ.get("CONTENT_LENGTH") or 0)
+            body = environ["wsgi.input"].read(length).decode("utf-8")
+            for key, value in parse_qsl(body, keep_blank_values=True):
+                params[key] = value
+        self._params = params
+        return params
+
+    def __getitem__(self, key):
+        return self._parse()[key]
+
+    def __contains__(self, key):
+        return key in self._parse()
+
+    def __iter__(self):
+        return iter(self._parse())
+
+    def __len__(self):
+        return len(self._parse())
+
+
+class SectionSpec(object):
+    """A config section parsed into what is needed to build its object."""
+
+    __slots__ = ("section", "stype", "module_name", "is_layer", "objargs")
+
+    def __init__(self, section, stype, module_name, is_layer, objargs):
+        """Constructor"""
+        self.section = section
+        self.stype = stype
+        self.module_name = module_name
+        self.is_layer = is_layer
+        self.objargs = objargs
+
+    def build(self):
+        """Import the implementing module and construct the object."""
+        object_module = import_module(self.module_name)
+        if object_module is None:
+            raise TileCacheException("Attempt to load %s failed." % self.stype)
+
+        section_object = getattr(object_module, self.stype)
+
+        if self.is_layer:
+            return section_object(self.section, **self.objargs)
+        return section_object(**self.objargs)
+
+
+class LazyLayers(Mapping):
+    """Layers keyed by name, each one constructed on first use."""
+
+    def __init__(self, specs, timings=None):
+        """Constructor"""
+        self.specs = specs
+        self.timings = {} if timings is None else timings
+        self._layers = {}
+        self._lock = threading.Lock()
+
+    def __getitem__(self, name):
+        layer = self._layers.get(name)
+        if layer is not None:
+            return layer
+        spec = self.specs[name]
+        with self._lock:
+            layer = self._layers.get(name)
+            if layer is None:
+                start = time.perf_counter()
+                layer = spec.build()
+                self.timings[f"layer:{name}"] = time.perf_counter() - start
+                self._layers[name] = layer
+        return layer
+
+    def __contains__(self, name):
+        return name in self.specs
+
+    def __iter__(self):
+        return iter(self.specs)
+
+    def __len__(self):
+        return len(self.specs)
+
+
 class Service(object):
     """Our Service Object"""
 
@@ -50,6 +196,11 @@ class Service(object):
         "tilecache_options",
         "config",
         "files",
+        "timings",
+        "background",
+        "processes",
+        "popularity",
+        "limiter",
     )
 
     def __init__(self, cache, layers, metadata=None):
@@ -59,43 +210,50 @@ class Service(object):
         self.metadata = {} if metadata is None else metadata
         self.files = None
         self.config = None
+        self.tilecache_options = {}
+        self.timings = getattr(layers, "timings", {})
+        self.background = Background()
+        self.processes = Processes()
+        self.popularity = None
+        self.limiter = None
 
     @classmethod
-    def loadFromSection(cls, config, section, module, **objargs):
-        """Unsure"""
+    def specFromSection(cls, config, section, module, **objargs):
+        """Parse a config section without importing or building anything"""
         stype = config.get(section, "type")
         for opt in config.options(section):
             if opt not in ["type", "module"]:
                 objargs[opt] = config.get(section, opt)
 
-        object_module = None
-
         if config.has_option(section, "module"):
-            object_module = import_module(config.get(section, "module"))
+            module_name = config.get(section, "module")
+        elif module is Layer:
+            stype = stype.replace("Layer", "")
+            module_name = "TileCache.Layers.%s" % stype
         else:
-            if module is Layer:
-                stype = stype.replace("Layer", "")
-                object_module = import_module("TileCache.Layers.%s" % stype)
-            else:
-                stype = stype.replace("Cache", "")
-                object_module = import_module("TileCache.Caches.%s" % stype)
-        if object_module is None:
-            raise TileCacheException("Attempt to load %s failed." % stype)
+            stype = stype.replace("Cache", "")
+            module_name = "TileCache.Caches.%s" % stype
 
-        section_object = getattr(object_module, stype)
+        return SectionSpec(
+            section, stype, module_name, module is Layer, objargs
+        )
 
-        if module is Layer:
-            return section_object(section, **objargs)
-        return section_object(**objargs)
+    @classmethod
+    def loadFromSection(cls, config, section, module, **objargs):
+        """Build the object described by a config section"""
+        return cls.specFromSection(config, section, module, **objargs).build()
 
     @classmethod
     def load(cls, *files):
         """unsure"""
         cache = None
         metadata = {}
-        layers = {}
+        options = {}
+        timings = {}
+        layers = LazyLayers({}, timings)
         config = None
         try:
+            start = time.perf_counter()
             config = configparser.ConfigParser()
             config.read(files)
 
@@ -104,29 +262,59 @@ class Service(object):
                     metadata[key] = config.get("metadata", key)
 
             if config.has_section("tilecache_options"):
-                if "path" in config.options("tilecache_options"):
-                    for path in config.get("tilecache_options", "path").split(
-                        ","
-                    ):
+                for key in config.options("tilecache_options"):
+                    options[key] = config.get("tilecache_options", key)
+                if "path" in options:
+                    for path in options["path"].split(","):
                         sys.path.insert(0, path)
+            timings["config"] = time.perf_counter() - start
 
+            start = time.perf_counter()
             cache = cls.loadFromSection(config, "cache", Cache)
+            timings["cache"] = time.perf_counter() - start
 
-            layers = {}
+            # Layers are only parsed here, building them is deferred until
+            # they are first requested.
+            start = time.perf_counter()
             for section in config.sections():
                 if section in cls.__slots__:
                     continue
-                layers[section] = cls.loadFromSection(
+                layers.specs[section] = cls.specFromSection(
                     config, section, Layer, cache=cache
                 )
+            timings["specs"] = time.perf_counter() - start
         except Exception as exp:
             metadata["exception"] = exp
             metadata["traceback"] = str(exp)
         service = cls(cache, layers, metadata)
         service.files = files
         service.config = config
+        service.tilecache_options = options
+        service.background = Background(
+            options.get("background_workers", 4),
+            options.get("background_queue", 256),
+        )
+        service.processes = Processes(options.get("optimize_workers", 2))
+        service.popularity = Popularity.from_options(options)
+        service.limiter = RateLimit.from_options(options, cache)
+        if options.get("startup_report", "").lower() in Cache.YESVALS:
+            sys.stderr.write(service.startup_report() + "\n")
         return service
 
+    def startup_report(self):
+        """Summarize the time spent loading this service."""
+        built = [k for k in self.timings if k.startswith("layer:")]
+        stages = " ".join(
+            f"{k}={v:.4f}s"
+            for k, v in self.timings.items()
+            if not k.startswith("layer:")
+        )
+        return (
+            f"TileCache startup pid={os.getpid()} {stages} "
+            f"layers={len(self.layers)} built={len(built)} "
+            f"build={sum(self.timings[k] for k in built):.4f}s"
+        )
+
     def generate_crossdomain_xml(self):
         """Helper method for generating the XML content for a crossdomain.xml
         file, to be used to allow remote sites to access this content."""
@@ -144,23 +332,202 @@ class Service(object):
         xml.append("</cross-domain-policy>")
         return ("text/xml", "\n".join(xml))
 
-    def renderTile(self, tile, force=False):
-        """render a Tile please"""
+    def setDeadline(self, tile, option="deadline", start=None):
+        """Give tile the tighter of its layer and endpoint time budgets.
+
+        The endpoint budget is the option of [tilecache_options], counted
+        from start, by default now.
+        """
+        budgets = [
+            budget
+            for budget in (
+                tile.layer.deadline,
+                float(self.tilecache_options.get(option, 0)),
+            )
+            if budget > 0
+        ]
+        if budgets:
+            if start is None:
+                start = time.monotonic()
+            tile.deadline = start + min(budgets)
+        return tile
+
+    def renderTile(self, tile, force=False, variant=None, cached=None):
+        """render a Tile please
+
+        A variant format is served from the cache when it is there,
+        otherwise the base tile is served and the variant is made in the
+        background for the next request.  cached is the tile data already
+        found by a batched cache read, the cache is not asked for it again.
+        """
         layer = tile.layer
+        # renders forced by the admin or seeding are not demand
+        if self.popularity is not None and not force:
+            self.popularity.add(Popularity.tile_key(tile))
+        if layer.variants:
+            tile.headers.append(("Vary", "Accept"))
+
+        # Nothing to render outside of the data, skip cache and backend
+        if not layer.inDataExtent(tile):
+            blank = layer.blankTile()
+            if blank is not None:
+                return (layer.mime_type, blank)
 
         # do more cache checking here: SRS, width, height, layers
 
+        mime_type = layer.mime_type
         image = None
-        if not force:
-            image = self.cache.get(tile)
+        if variant is not None and not force:
+            time_left(tile.deadline)
+            with Timing.stage("cache"):
+                image = self.cache.get(self.variantTile(tile, variant))
+            if image:
+                mime_type = Imaging.VARIANTS[variant]
+        if not image and cached is not None:
+            image = cached
+        elif not image and not force:
+            time_left(tile.deadline)
+            with Timing.stage("cache"):
+                image = self.cache.get(tile)
+        Timing.note("cache", "hit" if image else "miss")
         if not image:
-            data = layer.render(tile, force=force)
-            if data:
-                image = self.cache.set(tile, data)
-            else:
-                raise Exception("Zero length data returned from layer.")
+            time_left(tile.deadline)
+            with Timing.stage("render"):
+                image = self.renderMiss(tile, force)
+        if variant is not None and mime_type == layer.mime_type:
+            self.transcodeLater(tile, variant, image)
+
+        if layer.immutable and not any(
+            name == "Cache-Control" for name, _value in tile.headers
+        ):
+            tile.headers.append(("Cache-Control", Cache.IMMUTABLE))
+        return (mime_type, image)
+
+    @staticmethod
+    def variantTile(tile, variant):
+        """The tile standing for the variant format of tile in the cache"""
+        vtile = Layer.Tile(tile.layer, tile.x, tile.y, tile.z)
+        vtile.variant = variant
+        return vtile
+
+    def transcodeLater(self, tile, variant, image):
+        """Cache the variant of a freshly served base tile, off the request
+
+        Upsampled stand-ins are not worth keeping.
+        """
+        if any(name == "X-TileCache-Overzoom" for name, _v in tile.headers):
+            return
+        vtile = self.variantTile(tile, variant)
+        future = self.background.submit(
+            ("variant", self.cache.getKey(vtile)),
+            self.transcodeTile,
+            vtile,
+            bytes(image),
+        )
+        if future is not None:
+            future.add_done_callback(log_failure)
+
+    def transcodeTile(self, vtile, image):
+        """Transcode image in a worker process and cache it as vtile"""
+        data = self.processes.run(Imaging.transcode, image, vtile.variant)
+        return self.cache.set(vtile, data)
+
+    def renderMiss(self, tile, force=False):
+        """Produce a tile that is not cached"""
+        if self.limiter is not None and tile.client is not None:
+            self.limiter.charge(tile.client, force)
+        # forced renders come from the admin, warming and seeding, often on
+        # the background pool the overzoom render would wait on, and want
+        # the real tile rather than a stand-in anyway
+        if tile.layer.overzoom > 0 and not force:
+            return self.renderOrOverzoom(tile, force)
+        return self.renderAndStore(tile, force)
+
+    def renderAndStore(self, tile, force=False):
+        """Render the tile on the backend and cache the result"""
+        layer = tile.layer
+        data = layer.render(tile, force=force)
+        if not data:
+            raise Exception("Zero length data returned from layer.")
+        with Timing.stage("store"):
+            data = self.cache.set(tile, data)
+        if (
+            layer.immutable
+            and layer.extension == "png"
+            and (layer.optimize or layer.quantize)
+        ):
+            future = self.background.submit(
+                ("optimize", self.cache.getKey(tile)),
+                self.optimizeTile,
+                Layer.Tile(layer, tile.x, tile.y, tile.z),
+                data,
+            )
+            if future is not None:
+                future.add_done_callback(log_failure)
+        return data
 
-        return (layer.mime_type, image)
+    def optimizeTile(self, tile, data):
+        """Shrink a cached PNG in a worker process and store it in place,
+        unless the cached copy changed meanwhile.
+        """
+        layer = tile.layer
+        smaller = self.processes.run(
+            Imaging.optimize_png, bytes(data), layer.quantize, layer.optimize
+        )
+        if len(smaller) >= len(data):
+            return data
+        if self.cache.get(tile) != data:
+            return data
+        return self.cache.set(tile, smaller)
+
+    def renderOrOverzoom(self, tile, force=False):
+        """Render the tile, but if the backend fails or does not answer
+        within the layer overzoom_budget, serve an upsampled ancestor.
+
+        The render keeps going in the background and caches its result,
+        without the deadline of the request.
+        """
+        layer = tile.layer
+        future = self.background.submit(
+            self.cache.getKey(tile),
+            self.renderAndStore,
+            Layer.Tile(layer, tile.x, tile.y, tile.z),
+            force,
+        )
+        if future is None:
+            # the queue fills up during backend trouble, which is when a
+            # stand-in beats waiting on a render
+            (image, depth) = Pyramid.from_ancestor(layer, tile, layer.overzoom)
+            if image is None:
+                return self.renderAndStore(tile, force)
+            return self.standIn(tile, image, depth)
+        budget = layer.overzoom_budget
+        left = time_left(tile.deadline)
+        if left is not None:
+            budget = min(budget, left)
+        try:
+            return future.result(timeout=budget)
+        except (BackendWMSFailure, concurrent.futures.TimeoutError) as exp:
+            (image, depth) = Pyramid.from_ancestor(layer, tile, layer.overzoom)
+            if image is None:
+                if isinstance(exp, BackendWMSFailure):
+                    raise
+                try:
+                    return future.result(timeout=time_left(tile.deadline))
+                except concurrent.futures.TimeoutError as exp2:
+                    raise DeadlineExceeded(
+                        "Request deadline exceeded"
+                    ) from exp2
+        return self.standIn(tile, image, depth)
+
+    @staticmethod
+    def standIn(tile, image, depth):
+        """Serve image upsampled from depth zooms up in place of tile"""
+        tile.headers.append(("X-TileCache-Overzoom", str(depth)))
+        tile.headers.append(
+            ("Cache-Control", f"max-age={tile.layer.overzoom_ttl}")
+        )
+        return image
 
     def dispatchRequest(
         self,
@@ -168,8 +535,16 @@ class Service(object):
         path_info="/",
         req_method="GET",
         host="http://example.com/",
+        headers=None,
+        accept="",
+        client=None,
     ):
-        """dispatch the request!"""
+        """dispatch the request!
+
+        Response headers specific to the tile are appended to headers,
+        accept is the Accept request header and client names the client
+        to charge for a backend render.
+        """
         if "exception" in self.metadata:
             raise TileCacheException(
                 "%s\n%s"
@@ -178,14 +553,69 @@ class Service(object):
         if path_info.find("crossdomain.xml") != -1:
             return self.generate_crossdomain_xml()
 
-        tile = TMS(self).parse(params, path_info, host)
-        if not hasattr(tile, "layer"):
+        with Timing.stage("parse"):
+            tile = TMS(self).parse(params, path_info, host)
+        if isinstance(tile, Capabilities):
             return "text/xml", tile.data.encode("utf-8")
-        return self.renderTile(tile, "FORCE" in params)
+        Timing.note("layer", tile.layer.name)
+        Timing.note("tile", f"{tile.z}/{tile.x}/{tile.y}")
+        self.setDeadline(tile)
+        tile.client = client
+        variant = negotiate(accept, tile.layer.variants)
+        response = self.renderTile(tile, "FORCE" in params, variant)
+        if headers is not None:
+            headers.extend(tile.headers)
+        return response
+
+    def dispatchAdmin(self, params, path_info, environ):
+        """dispatch an /admin/ request, see TileCache.Admin"""
+        # imported on first use, most workers never see one
+        import TileCache.Admin as Admin
+
+        return Admin.dispatch(self, params, path_info, environ)
+
+    def dispatchBundle(self, params, path_info, headers=None, client=None):
+        """dispatch a /bundle/ request, see TileCache.Bundle"""
+        if "exception" in self.metadata:
+            raise TileCacheException(
+                "%s\n%s"
+                % (self.metadata["exception"], self.metadata["traceback"])
+            )
+        return Bundle.dispatch(self, params, path_info, headers, client)
+
+    def dispatchFrames(self, params, path_info, headers=None, client=None):
+        """dispatch a /frames/ request, see TileCache.Frames"""
+        if "exception" in self.metadata:
+            raise TileCacheException(
+                "%s\n%s"
+                % (self.metadata["exception"], self.metadata["traceback"])
+            )
+        return Frames.dispatch(self, params, path_info, headers, client)
 
 
 def wsgiHandler(environ, start_response, service):
-    """This is the WSGI handler"""
+    """This is the WSGI handler, timing the request when asked to"""
+    recorder = Timing.begin(
+        service.tilecache_options, environ.get("PATH_INFO", "")
+    )
+    if recorder is None:
+        return handleRequest(environ, start_response, service)
+    statuses = []
+
+    def timed_start_response(status, headers, *args):
+        statuses.append(status)
+        if recorder.server_timing:
+            headers.append(("Server-Timing", recorder.header()))
+        return start_response(status, headers, *args)
+
+    try:
+        return handleRequest(environ, timed_start_response, service)
+    finally:
+        Timing.end(recorder, statuses[0][:3] if statuses else None)
+
+
+def handleRequest(environ, start_response, service):
+    """Answer one request"""
 
     host = ""
     path_info = environ.get("PATH_INFO", "")
@@ -197,17 +627,47 @@ def wsgiHandler(environ, start_response, service):
 
     host += environ["SCRIPT_NAME"]
     req_method = environ["REQUEST_METHOD"]
+    error_headers = []
 
     try:
-        fields = parse_formvars(environ)
-        fmt, image = service.dispatchRequest(
-            fields, path_info, req_method, host
-        )
+        fields = QueryParams(environ)
+        if path_info.startswith("/admin/"):
+            status, fmt, body = service.dispatchAdmin(
+                fields, path_info, environ
+            )
+            start_response(status, [("Content-Type", fmt)])
+            return [body]
+        extra = []
+        client = None
+        if service.limiter is not None:
+            client = service.limiter.client(environ)
+        if path_info.startswith("/frames/"):
+            fmt, body = service.dispatchFrames(
+                fields, path_info, extra, client
+            )
+            start_response("200 OK", [("Content-Type", fmt)] + extra)
+            return body
+        if path_info.startswith("/bundle/"):
+            fmt, image = service.dispatchBundle(
+                fields, path_info, extra, client
+            )
+        else:
+            fmt, image = service.dispatchRequest(
+                fields,
+                path_info,
+                req_method,
+                host,
+                extra,
+                environ.get("HTTP_ACCEPT", ""),
+                client,
+            )
         headers = [("Content-Type", fmt)]
         if fmt.startswith("image/"):
             if service.cache.sendfile:
                 headers.append(("X-SendFile", image))
-            if service.cache.expire:
+            if service.cache.expire and not any(
+                name == "Cache-Control" for name, _value in extra
+            ):
                 headers.append(
                     (
                         "Expires",
@@ -216,10 +676,14 @@ def wsgiHandler(environ, start_response, service):
                         ),
                     )
                 )
+        headers.extend(extra)
 
         start_response("200 OK", headers)
         if service.cache.sendfile and fmt.startswith("image/"):
             return []
+        if isinstance(image, memoryview):
+            # caches may hand out views of mapped files, WSGI wants bytes
+            image = image.tobytes()
         return [image]
     except MalformedRequestException as exp:
         # reraise for others to handle
@@ -227,6 +691,16 @@ def wsgiHandler(environ, start_response, service):
     except OutOfBoundsZoomLevel as exp:
         status = "422 Unprocessable Entity"
         msg = f"OutOfBoundsZoomLevel: {exp}"
+    except OutOfBoundsTile as exp:
+        status = "422 Unprocessable Entity"
+        msg = f"OutOfBoundsTile: {exp}"
+    except DeadlineExceeded as exp:
+        status = "504 Gateway Timeout"
+        msg = f"{exp}"
+    except RateLimited as exp:
+        status = "429 Too Many Requests"
+        msg = f"{exp}"
+        error_headers.append(("Retry-After", str(math.ceil(exp.retry_after))))
     except TileCacheException as exp:
         status = "404 File Not Found"
         msg = f"An error occurred: {exp}"
@@ -250,7 +724,7 @@ def wsgiHandler(environ, start_response, service):
             traceback.print_exc()
         msg = f"An error occurred: {exp}\n"
 
-    start_response(status, [("Content-Type", "text/plain")])
+    start_response(status, [("Content-Type", "text/plain")] + error_headers)
     if isinstance(msg, str):
         msg = msg.encode("utf-8")
     return [msg]
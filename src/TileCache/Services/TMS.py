@@ -1,7 +1,9 @@
 # BSD Licensed, Copyright (c) 2006-2010 TileCache Contributors
 
+import re
+
 import TileCache.Layer as Layer
-from TileCache import OutOfBoundsZoomLevel
+from TileCache import OutOfBoundsTile, OutOfBoundsZoomLevel
 from TileCache.base import (
     Capabilities,
     MalformedRequestException,
@@ -9,15 +11,26 @@ from TileCache.base import (
     TileCacheException,
 )
 
+# The /1.0.0/<layer>/<z>/<x>/<y>.<ext> shape of nearly every request, with
+# plain integers.  Anything else takes the general path in TMS.parse.
+TILEPATH = re.compile(
+    r"^/*[^/]+/+([^/]+)/+(\d+)/+(\d+)/+(\d+)(?:\.[^/]*)?/*$", re.ASCII
+)
+
 
 class TMS(Request):
     """request"""
 
     def parse(self, fields, path, host):
         # /1.0.0/global_mosaic/0/0/0.jpg
-        parts = list(filter(lambda x: x != "", path.split("/")))
         if not host[-1] == "/":
             host = host + "/"
+        match = TILEPATH.match(path)
+        if match is not None:
+            (layername, zoom, x, y) = match.groups()
+            layer = self.getLayer(layername)
+            return self.makeTile(fields, layer, int(zoom), int(x), int(y))
+        parts = list(filter(lambda x: x != "", path.split("/")))
         if len(parts) < 1:
             return self.serverCapabilities(host)
         if len(parts) < 2:
@@ -30,7 +43,6 @@ class TMS(Request):
         if parts[2] == "{z}":
             raise TileCacheException("{z} was provided instead of value.")
         parts[4] = parts[4].split(".")[0]
-        tile = None
         try:
             zoom = round(float(parts[2]))
             x = int(parts[3])
@@ -38,21 +50,18 @@ class TMS(Request):
         except ValueError as exp:
             msg = f"Invalid, non-integer value provided: {exp}"
             raise MalformedRequestException(msg) from exp
+        return self.makeTile(fields, layer, zoom, x, y)
+
+    def makeTile(self, fields, layer, zoom, x, y):
+        """Build the tile, flipping y for google style requests"""
         if layer.tms_type == "google" or fields.get("type") == "google":
             if zoom < 0 or zoom >= len(layer.resolutions):
                 raise OutOfBoundsZoomLevel(zoom)
-            res = layer.resolutions[zoom]
-            maxY = (
-                int(
-                    round(
-                        (layer.bbox[3] - layer.bbox[1]) / (res * layer.size[1])
-                    )
-                )
-                - 1
-            )
-            tile = Layer.Tile(layer, x, maxY - y, zoom)
+            tile = Layer.Tile(layer, x, layer.max_y[zoom] - y, zoom)
         else:
             tile = Layer.Tile(layer, x, y, zoom)
+        if 0 <= zoom < len(layer.grid_limits) and not layer.inGrid(tile):
+            raise OutOfBoundsTile(f"{zoom}/{x}/{y}")
         return tile
 
     def serverCapabilities(self, host):
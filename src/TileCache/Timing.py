@@ -0,0 +1,204 @@
+"""Per-request stage timings.
+
+BSD Licensed, Copyright (c) 2006-2010 TileCache Contributors
+
+When ``server_timing`` or ``slow_request_ms`` is set in
+``[tilecache_options]`` every request gets a recorder, kept in a thread
+local so that the cache, layer and backend code can add to it without it
+being passed around.  ``server_timing=yes`` sends the stages back in a
+``Server-Timing`` header.  A request taking longer than
+``slow_request_ms`` is written to stderr as one JSON line, with its layer,
+tile, cache hit or miss, backend attempts and stages.  With
+``slow_request_stacks=yes`` a watchdog thread also samples the stack of
+requests running past that threshold, to show where the time went.
+"""
+
+import json
+import sys
+import threading
+import time
+import traceback
+from contextlib import contextmanager
+
+from TileCache.Cache import YESVALS
+
+_local = threading.local()
+# thread ident -> recorder of the requests running now, for the watchdog
+_active = {}
+_lock = threading.Lock()
+_watchdog = None
+
+MAX_SAMPLES = 5
+MAX_FRAMES = 12
+
+
+class Recorder(object):
+    """The timings of one request"""
+
+    __slots__ = (
+        "path",
+        "start",
+        "stages",
+        "notes",
+        "stacks",
+        "server_timing",
+        "slow",
+    )
+
+    def __init__(self, path, server_timing=False, slow=None):
+        """Constructor, slow is the threshold in seconds, if any"""
+        self.path = path
+        self.start = time.perf_counter()
+        self.stages = {}
+        self.notes = {}
+        self.stacks = []
+        self.server_timing = server_timing
+        self.slow = slow
+
+    def add(self, name, seconds):
+        """Account seconds to a stage, a stage may run several times"""
+        self.stages[name] = self.stages.get(name, 0.0) + seconds
+
+    def elapsed(self):
+        """Seconds since the request started"""
+        return time.perf_counter() - self.start
+
+    def header(self):
+        """The Server-Timing header value"""
+        parts = [
+            f"{name};dur={seconds * 1000.0:.1f}"
+            for name, seconds in self.stages.items()
+        ]
+        parts.append(f"total;dur={self.elapsed() * 1000.0:.1f}")
+        return ", ".join(parts)
+
+    def report(self, status):
+        """The slow request log entry"""
+        entry = {
+            "slow_request": self.path,
+            "status": status,
+            "ms": round(self.elapsed() * 1000.0, 1),
+            "stages": {
+                name: round(seconds * 1000.0, 1)
+                for name, seconds in self.stages.items()
+            },
+        }
+        entry.update(self.notes)
+        if self.stacks:
+            entry["stacks"] = self.stacks
+        return json.dumps(entry)
+
+
+def current():
+    """The recorder of the request running on this thread, if any"""
+    return getattr(_local, "recorder", None)
+
+
+def begin(options, path):
+    """Start recording a request, None when timings are off"""
+    server_timing = options.get("server_timing", "").lower() in YESVALS
+    slow = float(options.get("slow_request_ms", 0)) / 1000.0 or None
+    if not server_timing and slow is None:
+        return None
+    recorder = Recorder(path, server_timing, slow)
+    _local.recorder = recorder
+    if slow is not None:
+        stacks = options.get("slow_request_stacks", "").lower() in YESVALS
+        with _lock:
+            _active[threading.get_ident()] = recorder
+        if stacks:
+            start_watchdog(slow)
+    return recorder
+
+
+def end(recorder, status=None):
+    """Stop recording, logging the request when it was slow"""
+    _local.recorder = None
+    with _lock:
+        _active.pop(threading.get_ident(), None)
+    if recorder.slow is not None and recorder.elapsed() >= recorder.slow:
+        sys.stderr.write(recorder.report(status) + "\n")
+
+
+def carry(func):
+    """Wrap func to record into the current request from another thread"""
+    recorder = current()
+    if recorder is None:
+        return func
+
+    def run(*args, **kwargs):
+        _local.recorder = recorder
+        try:
+            return func(*args, **kwargs)
+        finally:
+            _local.recorder = None
+
+    return run
+
+
+@contextmanager
+def stage(name):
+    """Time the enclosed block as a stage of the current request"""
+    recorder = current()
+    if recorder is None:
+        yield
+        return
+    start = time.perf_counter()
+    try:
+        yield
+    finally:
+        recorder.add(name, time.perf_counter() - start)
+
+
+def note(key, value):
+    """Attach a detail to the slow request log of the current request"""
+    recorder = current()
+    if recorder is not None:
+        recorder.notes[key] = value
+
+
+def count(key):
+    """Count an event, like a backend attempt, of the current request"""
+    recorder = current()
+    if recorder is not None:
+        recorder.notes[key] = recorder.notes.get(key, 0) + 1
+
+
+def sample():
+    """Capture the stacks of the requests running past their threshold"""
+    with _lock:
+        running = [
+            (ident, rec)
+            for ident, rec in _active.items()
+            if rec.elapsed() >= rec.slow and len(rec.stacks) < MAX_SAMPLES
+        ]
+    if not running:
+        return
+    frames = sys._current_frames()
+    for ident, recorder in running:
+        frame = frames.get(ident)
+        if frame is None:
+            continue
+        stack = traceback.extract_stack(frame)[-MAX_FRAMES:]
+        recorder.stacks.append(
+            [f"{fs.filename}:{fs.lineno} {fs.name}" for fs in stack]
+        )
+
+
+def start_watchdog(slow):
+    """Start the stack sampling thread, once"""
+    global _watchdog
+    with _lock:
+        if _watchdog is not None:
+            return
+        interval = min(0.1, slow / 4.0)
+
+        def run():
+            while True:
+                time.sleep(interval)
+                sample()
+
+        _watchdog = threading.Thread(
+            target=run, name="tilecache-watchdog", daemon=True
+        )
+        _watchdog.start()
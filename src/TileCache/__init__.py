@@ -1,5 +1,7 @@
 """BSD Licensed, Copyright (c) 2006-2010 TileCache Contributors"""
 
+import time
+
 
 class BackendWMSFailure(Exception):
     """Raised when the backend WMS fails."""
@@ -11,3 +13,32 @@ class InvalidTMSRequest(Exception):
 
 class OutOfBoundsZoomLevel(Exception):
     """Raised when the zoom level is out of bounds."""
+
+
+class OutOfBoundsTile(Exception):
+    """Raised when the tile is outside of the layer grid."""
+
+
+class DeadlineExceeded(Exception):
+    """Raised when a request runs out of its time budget."""
+
+
+class RateLimited(Exception):
+    """Raised when a client is over its backend render limit."""
+
+    def __init__(self, message, retry_after=1.0):
+        Exception.__init__(self, message)
+        self.retry_after = retry_after
+
+
+def time_left(deadline):
+    """Seconds left until a time.monotonic() deadline, None if unbounded.
+
+    Raises DeadlineExceeded once the deadline has passed.
+    """
+    if deadline is None:
+        return None
+    left = deadline - time.monotonic()
+    if left <= 0:
+        raise DeadlineExceeded("Request deadline exceeded")
+    return left
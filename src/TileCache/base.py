@@ -58,6 +58,51 @@ def _normalize_layername(layername: str):
     return layername
 
 
+def parse_zooms(value) -> frozenset:
+    """Parse zoom levels given like ``0-5`` or ``0,2,4`` or ``0-3,8``."""
+    zooms = set()
+    for token in str(value).split(","):
+        token = token.strip()
+        if not token:
+            continue
+        if "-" in token:
+            (start, end) = token.split("-", 1)
+            zooms.update(range(int(start), int(end) + 1))
+        else:
+            zooms.add(int(token))
+    return frozenset(zooms)
+
+
+def layer_family(layername: str) -> str:
+    """Group a requested layername by the getLayer branch that serves it."""
+    if layername.startswith("idep"):
+        return "idep"
+    if layername.startswith(("goes_", "goes::")):
+        return "goes"
+    if layername.startswith("mrms::"):
+        return "mrms"
+    if layername.startswith("hrrr::"):
+        return "hrrr"
+    if "::" in layername:
+        return "ridge"
+    return layername
+
+
+def _classify(layer, tstring: str):
+    """Mark a layer resolved for an archive timestamp as immutable once the
+    timestamp is old enough for its data to be settled, all other
+    resolutions of a family are volatile."""
+    layer.immutable = False
+    if len(tstring) != 12:
+        return
+    try:
+        valid = datetime.strptime(tstring, "%Y%m%d%H%M")
+    except ValueError:
+        return
+    age = datetime.now(timezone.utc) - valid.replace(tzinfo=timezone.utc)
+    layer.immutable = age > timedelta(minutes=layer.immutable_after)
+
+
 def _ridge_handler(service, layername: str):
     """Handle Ridge requests."""
     tokens = layername.split("::")[1].split("-")
@@ -106,6 +151,7 @@ def _ridge_handler(service, layername: str):
         uri = ""
     layer = _get_layer(service, mylayername)
     layer.name = layername
+    _classify(layer, tstring)
     layer.url = "%ssector=%s&prod=%s&%s" % (
         layer.metadata["baseurl"],
         sector,
@@ -176,6 +222,7 @@ class Request(object):
                 uri = ""
             layer = _get_layer(self.service, mylayername)
             layer.name = layername
+            _classify(layer, tstring)
             layer.url = f"{layer.metadata['baseurl']}prod={prod.lower()}&{uri}"
         elif layername.startswith("goes::"):
             (bird, channel, tstring) = (layername.split("::")[1]).split("-")
@@ -196,6 +243,7 @@ class Request(object):
                 uri = ""
             layer = _get_layer(self.service, mylayername)
             layer.name = layername
+            _classify(layer, tstring)
             layer.url = "%sbird=%s&channel=%s&%s" % (
                 layer.metadata["baseurl"],
                 bird,
@@ -230,6 +278,7 @@ class Request(object):
                 uri = ""
             layer = _get_layer(self.service, mylayername)
             layer.name = layername
+            _classify(layer, tstring)
             layer.layers = mslayer
             layer.url = "%s%s" % (layer.metadata["baseurl"], uri)
         elif "::" in layername:
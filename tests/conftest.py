@@ -0,0 +1,47 @@
+"""Shared test fixtures."""
+
+import pytest
+
+from TileCache.Service import Service
+
+
+@pytest.fixture
+def make_service(tmp_path):
+    """Return a function building a service over an in-memory cache.
+
+    The service gets a usstates WMS layer, options go to
+    [tilecache_options], layer and cache are added to or override the
+    usstates and [cache] sections.  base is a cfg file to load first, in
+    place of the usstates layer.
+    """
+
+    def make(layer=None, options=None, cache=None, base=None):
+        sections = {
+            "tilecache_options": options or {},
+            "cache": {
+                "type": "SharedMemory",
+                "path": str(tmp_path / "arena"),
+                "size": "1M",
+                **(cache or {}),
+            },
+        }
+        if base is None:
+            sections["usstates"] = {
+                "type": "WMS",
+                "spherical_mercator": "true",
+                "url": "http://localhost/wms",
+                **(layer or {}),
+            }
+        cfg = tmp_path / "tilecache.cfg"
+        cfg.write_text(
+            "".join(
+                f"[{name}]\n"
+                + "".join(f"{key}={value}\n" for key, value in items.items())
+                for name, items in sections.items()
+            )
+        )
+        if base is None:
+            return Service.load(str(cfg))
+        return Service.load(base, str(cfg))
+
+    return make
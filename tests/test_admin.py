@@ -0,0 +1,111 @@
+"""Test the admin endpoint."""
+
+import time
+
+import pytest
+from werkzeug.test import Client
+
+from TileCache.Admin import product_layers, refresh
+from TileCache.Layer import Tile
+from TileCache.Replay import StubBackend
+from TileCache.Service import wsgiHandler
+
+TOKEN = {"Authorization": "Bearer sekrit"}
+
+
+@pytest.fixture
+def service(make_service):
+    """A service with an admin token and an in-memory cache."""
+    return make_service(
+        layer={"tms_type": "google"},
+        options={
+            "admin_token": "sekrit",
+            "warm_zooms": "0-1",
+            "invalidate_zooms": "0-2",
+        },
+    )
+
+
+@pytest.fixture
+def client(service):
+    """A client for the service."""
+
+    def app(environ, start_response):
+        return wsgiHandler(environ, start_response, service)
+
+    return Client(app)
+
+
+def test_product_layers():
+    """Test the mapping of products onto layer names."""
+    assert product_layers("usstates") == ["usstates"]
+    assert product_layers("ridge::USCOMP-N0Q", "202510191200") == [
+        "ridge::USCOMP-N0Q-0",
+        "ridge::USCOMP-N0Q-202510191200",
+    ]
+
+
+def test_auth(client):
+    """Test that the token is required."""
+    res = client.post("/admin/updated", data={"product": "usstates"})
+    assert res.status_code == 403
+    res = client.post(
+        "/admin/updated",
+        data={"product": "usstates"},
+        headers={"Authorization": "Bearer nope"},
+    )
+    assert res.status_code == 403
+
+
+def test_bad_product(client):
+    """Test that an unknown product is a client error."""
+    res = client.post(
+        "/admin/updated", data={"product": "doesntexst"}, headers=TOKEN
+    )
+    assert res.status_code == 400
+
+
+def test_updated(client, service):
+    """Test that an update drops and warms the tiles."""
+    layer = service.layers["usstates"]
+    stale = Tile(layer, 1, 1, 2)
+    service.cache.set(stale, b"stale")
+    with StubBackend() as stub:
+        res = client.post(
+            "/admin/updated", data={"product": "usstates"}, headers=TOKEN
+        )
+        assert res.status_code == 202
+        assert res.json == {"layers": ["usstates"]}
+        while service.background.pending():
+            time.sleep(0.01)
+    assert stub.calls == 5
+    assert service.cache.get(stale) is None
+    assert service.cache.get(Tile(layer, 0, 0, 0)) is not None
+
+
+def test_updated_overzoom(make_service):
+    """Test that warming an overzoom layer does not starve the pool."""
+    service = make_service(
+        layer={"overzoom": 2}, options={"background_workers": 1}
+    )
+    layer = service.layers["usstates"]
+    with StubBackend() as stub:
+        future = service.background.submit(
+            ("updated", "usstates"), refresh, service, layer, {0, 1}, set()
+        )
+        assert future.result(timeout=5) == (5, 0)
+    assert stub.calls == 5
+
+
+def test_updated_variants(make_service):
+    """Test that an update drops the variant formats of a tile too."""
+    service = make_service(layer={"variants": "webp"})
+    layer = service.layers["usstates"]
+    for z in (0, 1):
+        webp = service.variantTile(Tile(layer, 0, 0, z), "webp")
+        service.cache.set(webp, b"stale")
+    with StubBackend():
+        assert refresh(service, layer, {0}, {1}) == (1, 4)
+    for z in (0, 1):
+        webp = service.variantTile(Tile(layer, 0, 0, z), "webp")
+        assert service.cache.get(webp) is None
@@ -0,0 +1,170 @@
+"""Test fetching many tiles in one request."""
+
+import io
+import os
+import struct
+
+import pytest
+from requests_mock import ANY
+
+from TileCache import InvalidTMSRequest
+from TileCache.base import MalformedRequestException
+from TileCache.Bundle import FRAME, MAGIC, encode_frames, parse_tiles
+from TileCache.Cache import IMMUTABLE
+from TileCache.Replay import StubBackend
+from TileCache.Service import wsgiHandler
+
+
+@pytest.fixture
+def service(make_service):
+    """A service with an in-memory cache."""
+    return make_service(
+        options={"bundle_max_tiles": 8},
+        cache={"size": "4M", "item_size": "16K"},
+    )
+
+
+@pytest.fixture
+def ridge_service(make_service):
+    """The test configuration with an in-memory cache."""
+    cfg_fn = os.path.join(os.path.dirname(__file__), "tilecache.cfg")
+    return make_service(cache={"size": "4M", "item_size": "16K"}, base=cfg_fn)
+
+
+def call(service, path, query):
+    """Run a request through wsgiHandler"""
+    status = []
+    environ = {
+        "PATH_INFO": path,
+        "QUERY_STRING": query,
+        "REQUEST_METHOD": "GET",
+        "SCRIPT_NAME": "",
+        "wsgi.input": io.BytesIO(),
+    }
+    body = wsgiHandler(environ, lambda s, h: status.append((s, h)), service)
+    return status[0], b"".join(body)
+
+
+def frames(body):
+    """Decode a framed bundle"""
+    assert body[:4] == MAGIC
+    (count,) = struct.unpack(">I", body[4:8])
+    pos = 8
+    result = []
+    for _ in range(count):
+        z, x, y, status, length = FRAME.unpack_from(body, pos)
+        pos += FRAME.size
+        result.append((z, x, y, status, body[pos : pos + length]))
+        pos += length
+    assert pos == len(body)
+    return result
+
+
+def test_parse_tiles():
+    """Test the tile list forms."""
+    assert parse_tiles({"tiles": "1,2;3,4;"}) == [(1, 2), (3, 4)]
+    assert parse_tiles({"range": "0,0,1,1"}) == [
+        (0, 0),
+        (1, 0),
+        (0, 1),
+        (1, 1),
+    ]
+
+
+def test_bundle(service):
+    """Test that misses are rendered once and hits come from the cache."""
+    with StubBackend() as stub:
+        (status, _headers), body = call(
+            service, "/bundle/1.0.0/usstates/1", "range=0,0,1,1"
+        )
+        assert status == "200 OK"
+        tiles = frames(body)
+        assert [t[:4] for t in tiles] == [
+            (1, 0, 0, 200),
+            (1, 1, 0, 200),
+            (1, 0, 1, 200),
+            (1, 1, 1, 200),
+        ]
+        assert stub.calls == 4
+        (_status, _headers), body = call(
+            service, "/bundle/1.0.0/usstates/1", "tiles=1,1;9,9"
+        )
+        assert stub.calls == 4
+    tiles = frames(body)
+    assert tiles[0][3] == 200
+    assert tiles[0][4] == stub.image
+    assert tiles[1][3:] == (422, b"")
+
+
+def test_multipart(service):
+    """Test the multipart encoding."""
+    with StubBackend():
+        (status, headers), body = call(
+            service, "/bundle/1.0.0/usstates/0", "tiles=0,0&format=multipart"
+        )
+    assert status == "200 OK"
+    ctype = dict(headers)["Content-Type"]
+    assert ctype.startswith("multipart/mixed; boundary=")
+    assert b"Content-Location: /1.0.0/usstates/0/0/0.png" in body
+
+
+def test_negative(service):
+    """Test that coordinates a frame can't hold are rejected."""
+    with pytest.raises(MalformedRequestException):
+        parse_tiles({"tiles": "-1,2"})
+    with pytest.raises(InvalidTMSRequest):
+        call(service, "/bundle/1.0.0/usstates/3", "tiles=1,-2")
+    with pytest.raises(InvalidTMSRequest):
+        call(service, "/bundle/1.0.0/usstates/256", "tiles=1,2")
+
+
+def test_frames_bytes():
+    """Test that views handed out by a cache are streamed as bytes."""
+    body = list(encode_frames([(1, 0, 0, 200, memoryview(b"data"))], 1))
+    assert all(isinstance(chunk, bytes) for chunk in body)
+    assert frames(b"".join(body)) == [(1, 0, 0, 200, b"data")]
+
+
+def test_too_many(service):
+    """Test the tile limit."""
+    with pytest.raises(InvalidTMSRequest):
+        call(service, "/bundle/1.0.0/usstates/3", "range=0,0,3,3")
+
+
+def test_frames(ridge_service):
+    """Test that frames come back in the order of times."""
+    path = "/frames/1.0.0/ridge::USCOMP-N0R-{t}/5/7/11.png"
+    times = "202502232330,202502232335,bogus"
+    with pytest.raises(InvalidTMSRequest):
+        call(ridge_service, path, f"times={times}")
+    times = "202502232330,202502232335,0,999999999999"
+    with StubBackend() as stub:
+        (status, headers), body = call(ridge_service, path, f"times={times}")
+    assert status == "200 OK"
+    assert dict(headers)["Cache-Control"] == "no-store"
+    tiles = frames(body)
+    assert [t[3] for t in tiles] == [200, 200, 200, 503]
+    assert all(t[:3] == (5, 7, 11) for t in tiles)
+    assert stub.calls == 3
+
+
+def test_bundle_failures(requests_mock, ridge_service):
+    """Test that a bundle with failed tiles is not cached for a year."""
+    requests_mock.get(ANY, status_code=500)
+    path = "/bundle/1.0.0/ridge::USCOMP-N0R-202001010000/3"
+    (status, headers), body = call(ridge_service, path, "tiles=1,2;2,2")
+    assert status == "200 OK"
+    assert [t[3] for t in frames(body)] == [503, 503]
+    assert dict(headers)["Cache-Control"] == "no-store"
+
+
+def test_frames_immutable(ridge_service):
+    """Test that only frames all found in the cache are immutable."""
+    path = "/frames/1.0.0/ridge::USCOMP-N0R-{t}/3/1/2.png"
+    query = "times=202001010000,202001010005"
+    with StubBackend():
+        (_status, headers), _body = call(ridge_service, path, query)
+        assert dict(headers)["Cache-Control"] == "no-store"
+        (_status, headers), body = call(ridge_service, path, query)
+    assert [t[3] for t in frames(body)] == [200, 200]
+    assert dict(headers)["Cache-Control"] == IMMUTABLE
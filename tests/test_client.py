@@ -0,0 +1,137 @@
+"""Test the WMS Client."""
+
+import time
+
+import pytest
+import requests
+from requests_mock import ANY
+
+from TileCache import BackendWMSFailure, DeadlineExceeded
+from TileCache.Client import WMS, BackendPool
+
+PNG = b"\x89PNG\r\n\x1a\n" + b"\x00" * 1024
+
+
+def test_stream_fetch(requests_mock):
+    """Test that a streamed fetch returns the full body."""
+    requests_mock.get(
+        ANY,
+        content=PNG,
+        headers={"content-type": "image/png", "content-length": "1032"},
+    )
+    wms = WMS("http://localhost/wms", {"layers": "a"}, stream=True)
+    assert wms.fetch() == PNG
+
+
+def test_stream_short_read(requests_mock):
+    """Test that a truncated body is a backend failure."""
+    requests_mock.get(
+        ANY,
+        content=PNG,
+        headers={"content-type": "image/png", "content-length": "2048"},
+    )
+    wms = WMS("http://localhost/wms", {"layers": "a"}, stream=True)
+    with pytest.raises(BackendWMSFailure):
+        wms.fetch()
+
+
+def test_stream_not_image(requests_mock):
+    """Test that non image content is still reported."""
+    requests_mock.get(
+        ANY, content=b"mapserver error", headers={"content-type": "text/html"}
+    )
+    wms = WMS("http://localhost/wms", {"layers": "a"}, stream=True)
+    with pytest.raises(BackendWMSFailure, match="mapserver error"):
+        wms.fetch()
+
+
+def test_pool_balance(requests_mock):
+    """Test that requests go to the least busy host and skip dead ones."""
+    requests_mock.get(
+        "http://a/wms", content=PNG, headers={"content-type": "image/png"}
+    )
+    requests_mock.get("http://b/wms", status_code=500)
+    pool = BackendPool(["a", "b"], failures=2)
+    pool.outstanding["a"] = 1
+    assert pool.pick() == "b"
+    assert pool.outstanding == {"a": 1, "b": 1}
+    pool.release("b", 0.1, True)
+    pool.outstanding["a"] = 0
+    wms = WMS("http://origin/wms", {"layers": "a"}, pool=pool)
+    for _ in range(50):
+        try:
+            assert wms.fetch() == PNG
+        except BackendWMSFailure:
+            pass
+    assert pool.down_until["b"] > 0
+    assert all(wms.fetch() == PNG for _ in range(5)), (
+        "a dead host should be skipped"
+    )
+    assert pool.outstanding == {"a": 0, "b": 0}
+
+
+def test_pool_failover(requests_mock):
+    """Test that a connection failure is tried on another host."""
+    requests_mock.get("http://a/wms", exc=requests.ConnectionError)
+    requests_mock.get(
+        "http://b/wms", content=PNG, headers={"content-type": "image/png"}
+    )
+    pool = BackendPool(["a", "b"])
+    wms = WMS("http://origin/wms", {"layers": "a"}, pool=pool)
+    for _ in range(4):
+        assert wms.fetch() == PNG
+
+
+def test_pool_hedge():
+    """Test that a slow request is hedged to the other host."""
+
+    def fetch(url):
+        if url.startswith("http://a/"):
+            time.sleep(0.5)
+            return b"slow"
+        return b"fast"
+
+    pool = BackendPool(["a", "b"], hedge=True)
+    pool.latencies.extend([0.01] * 20)
+    pool.outstanding["b"] = 1
+    start = time.perf_counter()
+    assert pool.fetch("http://origin/wms?x=1", fetch) == b"fast"
+    assert time.perf_counter() - start < 0.4
+
+
+def test_deadline(requests_mock):
+    """Test that retries are skipped when the deadline can't cover them."""
+    requests_mock.get(ANY, status_code=500)
+    wms = WMS(
+        "http://localhost/wms",
+        {"layers": "a"},
+        deadline=time.monotonic() + 0.5,
+    )
+    with pytest.raises(BackendWMSFailure):
+        wms.fetch()
+    assert requests_mock.call_count == 1
+    wms.deadline = time.monotonic() - 1
+    with pytest.raises(DeadlineExceeded):
+        wms.fetch()
+    assert requests_mock.call_count == 1
+
+
+def test_connection_refused(requests_mock):
+    """Test that an unreachable backend is a BackendWMSFailure."""
+    requests_mock.get(ANY, exc=requests.ConnectionError)
+    wms = WMS("http://localhost/wms", {"layers": "a"})
+    with pytest.raises(BackendWMSFailure):
+        wms.fetch()
+
+
+def test_pool_hedge_deadline():
+    """Test that a hedged fetch outlasting its deadline times out."""
+
+    def fetch(_url):
+        time.sleep(0.5)
+        return b"slow"
+
+    pool = BackendPool(["a"], hedge=True)
+    pool.latencies.extend([0.01] * 20)
+    with pytest.raises(DeadlineExceeded):
+        pool.fetch("http://origin/wms", fetch, time.monotonic() + 0.1)
@@ -1,9 +1,152 @@
 """Test Memcached."""
 
-from TileCache.Caches.Memcached import Memcached
+import os
+import time
+
+from pymemcache.test.utils import MockMemcacheClient
+
+from TileCache.Caches.Memcached import MANIFEST, Memcached
+from TileCache.Layer import Layer, Tile
 
 
 def test_api():
     """Can we import?"""
     c = Memcached()
     assert c.cache.get("blah") is None
+
+
+def test_short_keys():
+    """Test that short keys are compact and memcached safe."""
+    c = Memcached(short_keys="yes")
+    key = c.getKey(Tile(Layer("ridge::USCOMP-N0Q-0"), 1, 2, 3))
+    assert len(key) == 20
+    assert key.isascii() and " " not in key
+
+
+def test_ketama_replicas():
+    """Test the replica placement over several servers."""
+    c = Memcached(
+        servers="10.0.0.1:11211,10.0.0.2:11211,10.0.0.3:11211",
+        hashing="ketama",
+        hot_zooms="0-2",
+        replicas="2",
+    )
+    assert c.replicated(Tile(Layer("a"), 0, 0, 2))
+    assert not c.replicated(Tile(Layer("a"), 0, 0, 3))
+    nodes = c.hasher.get_nodes("a/0/0/2", 2)
+    assert len(set(nodes)) == 2
+    assert nodes == c.hasher.get_nodes("a/0/0/2", 2)
+    assert nodes[0] == c.hasher.get_node("a/0/0/2")
+
+
+def test_chunks():
+    """Test that large tiles are chunked and checked on the way back."""
+    c = Memcached(chunk_size="1K")
+    c.cache = MockMemcacheClient()
+    layer = Layer("a")
+    tile = Tile(layer, 0, 0, 1)
+    data = os.urandom(3000)
+    assert c.set(tile, data) == data
+    manifest = c.cache.get(c.getKey(tile))
+    assert len(manifest) < 100
+    assert c.get(Tile(layer, 0, 0, 1)) == data
+    c.set(Tile(layer, 1, 0, 1), b"small")
+    assert c.get_many(
+        [Tile(layer, 0, 0, 1), Tile(layer, 1, 0, 1), Tile(layer, 1, 1, 1)]
+    ) == [data, b"small", None]
+    # a lost chunk is a miss
+    (_magic, nonce, count, _length, _digest) = MANIFEST.unpack(manifest)
+    keys = c.chunkKeys(c.getKey(tile), nonce, count)
+    assert len(keys) == 3
+    c.cache.set(keys[1], b"x" * 1024)
+    assert c.get(Tile(layer, 0, 0, 1)) is None
+    c.cache.delete(keys[2])
+    assert c.get_many([Tile(layer, 0, 0, 1)]) == [None]
+
+
+def test_persistent(tmp_path):
+    """Test the write-behind tier refills an emptied memcached."""
+    c = Memcached(persistent_path=str(tmp_path / "tiles.sqlite"))
+    c.cache = MockMemcacheClient()
+    layer = Layer("a")
+    c.set(Tile(layer, 0, 0, 1), b"one")
+    c.set(Tile(layer, 1, 0, 1), b"two")
+    c.flush()
+    assert c.persistent.get(Tile(layer, 0, 0, 1)) == b"one"
+    # a restarted memcached
+    c.cache = MockMemcacheClient()
+    assert c.get(Tile(layer, 0, 0, 1)) == b"one"
+    assert c.cache.get(c.getKey(Tile(layer, 0, 0, 1))) == b"one"
+    assert c.get_many([Tile(layer, 1, 0, 1), Tile(layer, 1, 1, 1)]) == [
+        b"two",
+        None,
+    ]
+    assert c.cache.get(c.getKey(Tile(layer, 1, 0, 1))) == b"two"
+    c.delete(Tile(layer, 0, 0, 1))
+    c.flush()
+    c.cache = MockMemcacheClient()
+    assert c.get(Tile(layer, 0, 0, 1)) is None
+
+
+def test_persistent_purge(tmp_path):
+    """Test that expired rows are deleted from the persistent tier."""
+    c = Memcached(persistent_path=str(tmp_path / "tiles.sqlite"))
+    c.persistent.write([("old", b"x", time.time() - 1), ("new", b"y", 0.0)])
+    c.persistent.purge_interval = 0
+    c.persistent.write([("other", b"z", time.time() + 60)])
+    rows = c.persistent.connection().execute("SELECT key FROM tiles")
+    assert sorted(row[0] for row in rows) == ["new", "other"]
+
+
+def test_replicated_chunks():
+    """Test that a large hot tile survives the loss of any node."""
+    c = Memcached(
+        servers="10.0.0.1:11211,10.0.0.2:11211,10.0.0.3:11211",
+        hashing="ketama",
+        hot_zooms="0-2",
+        replicas="2",
+        chunk_size="1K",
+    )
+    for node in list(c.cache.clients):
+        c.cache.clients[node] = MockMemcacheClient()
+    tile = Tile(Layer("a"), 0, 0, 1)
+    data = os.urandom(3000)
+    c.set(tile, data)
+    for node in list(c.cache.clients):
+        kept = c.cache.clients[node]
+        c.cache.clients[node] = MockMemcacheClient()
+        assert c.get(Tile(Layer("a"), 0, 0, 1)) == data
+        c.cache.clients[node] = kept
+
+
+class DownClient(MockMemcacheClient):
+    """A memcached node refusing connections, counting the attempts."""
+
+    calls = 0
+
+    def _refuse(self, *args, **kwargs):
+        self.calls += 1
+        raise ConnectionRefusedError("down")
+
+    get = set = delete = _refuse
+
+
+def test_replicas_skip_failed():
+    """Test that a failing replica is skipped, and deletes carry on."""
+    c = Memcached(
+        servers="10.0.0.1:11211,10.0.0.2:11211",
+        hot_zooms="0-2",
+        replicas="2",
+    )
+    for node in list(c.cache.clients):
+        server = c.cache.clients[node].server
+        c.cache.clients[node] = MockMemcacheClient(server=server)
+    down = DownClient(server=("10.0.0.1", 11211))
+    c.cache.clients["10.0.0.1:11211"] = down
+    tile = Tile(Layer("a"), 0, 0, 1)
+    c.set(tile, b"data")
+    assert c.get(Tile(Layer("a"), 0, 0, 1)) == b"data"
+    c.delete(tile)
+    assert c.get(Tile(Layer("a"), 0, 0, 1)) is None
+    # the first failure marks the node, it is not tried again for a while
+    assert down.calls == 1
@@ -0,0 +1,67 @@
+"""Test the PNG optimization stage."""
+
+import io
+import time
+
+import pytest
+
+from TileCache.Imaging import optimize_png, recompress_png
+from TileCache.Layer import Tile
+from TileCache.Replay import StubBackend
+
+Image = pytest.importorskip("PIL.Image")
+
+
+def gradient():
+    """A tile that compresses poorly at the lowest zlib level"""
+    img = Image.new("RGBA", (256, 256))
+    img.putdata(
+        [(x, y, (x * y) % 256, 255) for y in range(256) for x in range(256)]
+    )
+    buf = io.BytesIO()
+    img.save(buf, format="PNG", compress_level=1)
+    return buf.getvalue()
+
+
+def pixels(data):
+    """The RGBA pixels of a PNG"""
+    return Image.open(io.BytesIO(data)).convert("RGBA").tobytes()
+
+
+def test_recompress():
+    """Test that recompression is lossless and smaller."""
+    data = gradient()
+    smaller = recompress_png(data)
+    assert len(smaller) < len(data)
+    assert pixels(smaller) == pixels(data)
+    assert recompress_png(b"not a png") == b"not a png"
+    assert smaller[-12:] == data[-12:]
+
+
+def test_quantize():
+    """Test that quantizing gives a palette image."""
+    data = gradient()
+    smaller = optimize_png(data, quantize=True)
+    assert len(smaller) < len(data)
+    assert Image.open(io.BytesIO(smaller)).mode == "P"
+
+
+def test_upgrade(make_service):
+    """Test that an immutable tile is replaced by its optimized form."""
+    service = make_service(
+        layer={"immutable": "yes", "optimize": "yes"},
+        options={"optimize_workers": 1},
+        cache={"size": "4M", "item_size": "256K"},
+    )
+    layer = service.layers["usstates"]
+    data = gradient()
+    with StubBackend() as stub:
+        stub.image = data
+        service.renderTile(Tile(layer, 0, 0, 0))
+    for _ in range(100):
+        if not service.background.pending():
+            break
+        time.sleep(0.1)
+    cached = service.cache.get(Tile(layer, 0, 0, 0))
+    assert len(cached) < len(data)
+    assert pixels(cached) == pixels(data)
@@ -0,0 +1,76 @@
+"""Test the PMTiles archive cache."""
+
+import pytest
+
+from TileCache.Caches.PMTiles import (
+    PMTiles,
+    decode_directory,
+    encode_directory,
+    export,
+    main,
+    zxy_to_tileid,
+)
+from TileCache.Layer import Tile
+
+
+@pytest.fixture
+def service(make_service):
+    """A service with an in-memory cache."""
+    return make_service(cache={"size": "4M", "item_size": "16K"})
+
+
+def test_tileid():
+    """Test the Hilbert curve against the specification examples."""
+    assert zxy_to_tileid(0, 0, 0) == 0
+    assert [zxy_to_tileid(1, x, y) for x, y in ((0, 0), (0, 1), (1, 1))] == [
+        1,
+        2,
+        3,
+    ]
+    assert zxy_to_tileid(1, 1, 0) == 4
+    assert zxy_to_tileid(2, 0, 0) == 5
+    assert zxy_to_tileid(12, 3423, 1763) == 19078479
+
+
+def test_directory():
+    """Test that a directory survives encoding."""
+    entries = [(0, 1, 10, 0), (1, 3, 20, 10), (9, 1, 5, 100), (12, 0, 7, 3)]
+    decoded = decode_directory(encode_directory(entries))
+    assert list(zip(*decoded, strict=True)) == entries
+
+
+def test_export(service, tmp_path):
+    """Test that exported tiles are served from the archive."""
+    layer = service.layers["usstates"]
+    for z, x, y in ((0, 0, 0), (1, 0, 0), (1, 1, 1), (2, 3, 1)):
+        service.cache.set(Tile(layer, x, y, z), f"{z}/{x}/{y}".encode())
+    service.cache.set(Tile(layer, 1, 0, 1), b"0/0/0")
+    count = export(service.cache, layer, [0, 1, 2], tmp_path / "usstates")
+    assert count == 5
+    cache = PMTiles(path=str(tmp_path / "{layer}"))
+    assert cache.get(Tile(layer, 0, 0, 0)) == b"0/0/0"
+    assert cache.get(Tile(layer, 1, 0, 1)) == b"0/0/0"
+    assert cache.get(Tile(layer, 1, 1, 1)) == b"1/1/1"
+    data = cache.get(Tile(layer, 3, 1, 2))
+    assert isinstance(data, memoryview)
+    assert data == b"2/3/1"
+    assert cache.get(Tile(layer, 0, 1, 1)) is None
+    assert cache.get(Tile(layer, 0, 0, 5)) is None
+    cache.set(Tile(layer, 0, 1, 1), b"nope")
+    assert cache.get(Tile(layer, 0, 1, 1)) is None
+    layer.name = "other"
+    assert cache.get(Tile(layer, 0, 0, 0)) is None
+
+
+def test_main(service, tmp_path):
+    """Test the export command line."""
+    layer = service.layers["usstates"]
+    service.cache.set(Tile(layer, 0, 0, 0), b"tile")
+    cfg = str(tmp_path / "tilecache.cfg")
+    out = str(tmp_path / "out.pmtiles")
+    assert (
+        main(["--config", cfg, "--layer", "usstates", "--zooms", "0"] + [out])
+        == 0
+    )
+    cache = PMTiles(path=out)
+    assert cache.get(Tile(layer, 0, 0, 0)) == b"tile"
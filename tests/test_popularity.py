@@ -0,0 +1,92 @@
+"""Test the tile popularity sketch."""
+
+import time
+
+from werkzeug.test import Client
+
+from TileCache.Caches.SharedMemory import SharedMemory
+from TileCache.Layer import Layer, Tile
+from TileCache.Popularity import Sketch
+from TileCache.Replay import StubBackend
+from TileCache.Service import wsgiHandler
+
+TOKEN = {"Authorization": "Bearer sekrit"}
+
+
+def test_sketch():
+    """Test the estimates, the top list and the halving."""
+    sketch = Sketch(width=256, top=3, sample=1000)
+    for i in range(50):
+        for _ in range(i % 5 + 1):
+            sketch.add(f"a/1/{i}/0")
+    assert sketch.estimate("a/1/4/0") >= 5
+    assert sketch.estimate("nothere") <= 5
+    assert [count for _key, count in sketch.topk()] == [5, 5, 5]
+    assert sketch.topk(1) == [("a/1/14/0", 5)]
+    for _ in range(1000):
+        sketch.add("b/0/0/0")
+    assert sketch.topk(1)[0][0] == "b/0/0/0"
+    assert sketch.estimate("a/1/4/0") <= 2
+    assert sketch.admit("b/0/0/0", "a/1/4/0")
+    assert not sketch.admit("a/1/4/0", "b/0/0/0")
+
+
+def test_admission(tmp_path):
+    """Test that a tile seen once does not evict a hot one."""
+    cache = SharedMemory(
+        path=str(tmp_path / "arena"),
+        size="300",
+        ways=2,
+        item_size="64",
+        admission="tinylfu",
+    )
+    layer = Layer("test")
+    for x in range(2):
+        for _ in range(3):
+            cache.get(Tile(layer, x, 0, 0))
+        cache.set(Tile(layer, x, 0, 0), b"%d" % x)
+    for x in range(2, 10):
+        cache.get(Tile(layer, x, 0, 0))
+        cache.set(Tile(layer, x, 0, 0), b"%d" % x)
+    assert cache.get(Tile(layer, 0, 0, 0)) == b"0"
+    assert cache.get(Tile(layer, 1, 0, 0)) == b"1"
+    for _ in range(10):
+        cache.get(Tile(layer, 9, 0, 0))
+    cache.set(Tile(layer, 9, 0, 0), b"9")
+    assert cache.get(Tile(layer, 9, 0, 0)) == b"9"
+
+
+def test_admin_popular(make_service):
+    """Test that served tiles are listed and warmed by the admin."""
+    service = make_service(
+        layer={"tms_type": "google"},
+        options={"admin_token": "sekrit", "popularity": "yes"},
+    )
+
+    def app(environ, start_response):
+        return wsgiHandler(environ, start_response, service)
+
+    client = Client(app)
+    with StubBackend() as stub:
+        for _ in range(3):
+            client.get("/1.0.0/usstates/1/1/1.png")
+        client.get("/1.0.0/usstates/1/0/1.png")
+        assert stub.calls == 2
+        res = client.get("/admin/popular?limit=1", headers=TOKEN)
+        assert res.json == {"tiles": [{"tile": "usstates/1/1/0", "count": 3}]}
+        res = client.post("/admin/popular", headers=TOKEN)
+        assert res.status_code == 202
+        while service.background.pending():
+            time.sleep(0.01)
+        assert stub.calls == 4
+    assert client.get("/admin/popular").status_code == 403
+
+
+def test_bundle_popular(make_service):
+    """Test that tiles served in a bundle are counted too."""
+    service = make_service(options={"popularity": "yes"})
+    client = Client(lambda e, s: wsgiHandler(e, s, service))
+    with StubBackend():
+        for _ in range(2):
+            client.get("/bundle/1.0.0/usstates/1?tiles=1,1;0,1")
+    assert service.popularity.estimate("usstates/1/1/1") >= 2
@@ -0,0 +1,73 @@
+"""Test building tiles from their children."""
+
+import io
+
+import pytest
+
+import TileCache.Imaging as Imaging
+from TileCache.base import Request
+from TileCache.Layer import Tile
+from TileCache.Pyramid import seed
+from TileCache.Replay import StubBackend
+
+Image = pytest.importorskip("PIL.Image")
+
+
+@pytest.fixture
+def service(make_service):
+    """A service with a pyramid layer and an in-memory cache."""
+    return make_service(
+        layer={"tms_type": "google", "pyramid": "yes", "pyramid_zooms": "0-1"},
+        cache={"size": "4M", "item_size": "16K"},
+    )
+
+
+def png(color):
+    """A solid 256x256 tile"""
+    buf = io.BytesIO()
+    Image.new("RGBA", (256, 256), color).save(buf, format="PNG")
+    return buf.getvalue()
+
+
+def test_compose(service):
+    """Test that a parent is built from cached children."""
+    layer = service.layers["usstates"]
+    assert layer.pyramid == {0, 1}
+    # top left child is red, the rest blue
+    for x, y in ((0, 0), (1, 0), (0, 1), (1, 1)):
+        color = "red" if (x, y) == (0, 1) else "blue"
+        service.cache.set(Tile(layer, x, y, 1), png(color))
+    with StubBackend() as stub:
+        data = layer.render(Tile(layer, 0, 0, 0))
+    assert stub.calls == 0
+    img = Image.open(io.BytesIO(data)).convert("RGBA")
+    assert img.size == (256, 256)
+    assert img.getpixel((10, 10)) == (255, 0, 0, 255)
+    assert img.getpixel((200, 200)) == (0, 0, 255, 255)
+
+
+def test_missing_child(service):
+    """Test that a missing child means a backend render."""
+    layer = service.layers["usstates"]
+    with StubBackend() as stub:
+        layer.render(Tile(layer, 0, 0, 0))
+    assert stub.calls == 1
+
+
+def test_seed(service):
+    """Test that seeding only hits the backend for the deepest level."""
+    layer = Request(service).getLayer("usstates")
+    with StubBackend() as stub:
+        assert seed(service, layer, {0, 1, 2}) == 21
+    assert stub.calls == 16
+
+
+def test_jpeg():
+    """Test that composed and upsampled jpeg tiles can be written."""
+    children = {(col, row): png("blue") for col in (0, 1) for row in (0, 1)}
+    data = Imaging.compose_children(children, (256, 256), "jpeg")
+    assert Image.open(io.BytesIO(data)).format == "JPEG"
+    data = Imaging.upsample_part(png("red"), (256, 256), 1, 0, 0, "jpeg")
+    img = Image.open(io.BytesIO(data))
+    assert img.format == "JPEG"
+    assert img.mode == "RGB"
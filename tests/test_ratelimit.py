@@ -0,0 +1,92 @@
+"""Test the per-client render limits."""
+
+import pytest
+from werkzeug.test import Client
+
+from TileCache import RateLimited
+from TileCache.RateLimit import Limiter
+from TileCache.Replay import StubBackend
+from TileCache.Service import wsgiHandler
+
+
+class FakeMemcache(object):
+    """Just enough of a memcached client for the shared buckets."""
+
+    def __init__(self):
+        self.data = {}
+
+    def gets(self, key):
+        return self.data.get(key, (None, None))
+
+    def add(self, key, value, expire=0, noreply=None):
+        if key in self.data:
+            return False
+        self.data[key] = (value, 1)
+        return True
+
+    def cas(self, key, value, cas, expire=0, noreply=False):
+        if self.data.get(key, (None, None))[1] != cas:
+            return False
+        self.data[key] = (value, cas + 1)
+        return True
+
+
+@pytest.mark.parametrize("shared", [None, FakeMemcache()])
+def test_buckets(shared):
+    """Test the burst, the separate FORCE bucket and the clients."""
+    limiter = Limiter(0.01, burst=2, force_burst=1, shared=shared)
+    limiter.charge("a")
+    limiter.charge("a")
+    with pytest.raises(RateLimited) as exp:
+        limiter.charge("a")
+    assert exp.value.retry_after > 60
+    limiter.charge("b")
+    limiter.charge("a", force=True)
+    with pytest.raises(RateLimited):
+        limiter.charge("a", force=True)
+
+
+def test_client():
+    """Test how clients are told apart."""
+    environ = {
+        "REMOTE_ADDR": "10.0.0.1",
+        "HTTP_X_FORWARDED_FOR": "198.51.100.9, 192.0.2.7",
+        "HTTP_REFERER": "https://maps.example.com/page",
+    }
+    assert Limiter(1).client(environ) == "10.0.0.1"
+    # the first address is whatever the client sent
+    assert Limiter(1, key="forwarded").client(environ) == "192.0.2.7"
+    limiter = Limiter(1, key="forwarded", proxies=2)
+    assert limiter.client(environ) == "198.51.100.9"
+    limiter = Limiter(1, key="forwarded", proxies=3)
+    assert limiter.client(environ) == "198.51.100.9"
+    assert limiter.client({"REMOTE_ADDR": "x"}) == "x"
+    assert Limiter(1, key="referrer").client(environ) == "maps.example.com"
+    assert Limiter(1, key="referrer").client({"REMOTE_ADDR": "x"}) == "x"
+
+
+def test_wsgi(make_service):
+    """Test that only misses are charged and over the limit is a 429."""
+    service = make_service(
+        layer={"tms_type": "google"},
+        options={"ratelimit_rate": 0.01, "ratelimit_burst": 1},
+    )
+
+    def app(environ, start_response):
+        return wsgiHandler(environ, start_response, service)
+
+    client = Client(app)
+    with StubBackend() as stub:
+        assert client.get("/1.0.0/usstates/1/1/1.png").status_code == 200
+        assert client.get("/1.0.0/usstates/1/1/1.png").status_code == 200
+        res = client.get("/1.0.0/usstates/1/0/1.png")
+        assert res.status_code == 429
+        assert int(res.headers["Retry-After"]) > 60
+        res = client.get("/1.0.0/usstates/1/1/1.png?FORCE=1")
+        assert res.status_code == 200
+        res = client.get("/1.0.0/usstates/1/1/1.png?FORCE=1")
+        assert res.status_code == 429
+        other = {"REMOTE_ADDR": "192.0.2.1"}
+        res = client.get("/1.0.0/usstates/1/0/1.png", environ_base=other)
+        assert res.status_code == 200
+    assert stub.calls == 3
@@ -0,0 +1,39 @@
+"""Test the replay tool."""
+
+from TileCache.Replay import (
+    StubBackend,
+    local_runner,
+    parse_line,
+    replay,
+    summarize,
+)
+
+LOGLINE = (
+    '10.0.0.1 - - [19/Oct/2025:12:00:00 +0000] "GET '
+    '/c/tile.py/1.0.0/ridge::USCOMP-N0Q-0/5/7/11.png HTTP/1.1" 200 512 '
+    '"-" "Mozilla/5.0"'
+)
+
+
+def test_parse_line():
+    """Test the parsing of the supported line formats."""
+    entry = parse_line(LOGLINE)
+    assert entry.path == "/1.0.0/ridge::USCOMP-N0Q-0/5/7/11.png"
+    assert entry.family == "ridge"
+    assert entry.timestamp is not None
+    entry = parse_line("http://localhost/c/tile.py/1.0.0/goes_a_b_c/1/1/1.png")
+    assert entry.family == "goes"
+    assert entry.timestamp is None
+    assert parse_line("/robots.txt") is None
+
+
+def test_local_replay(make_service):
+    """Test an in-process replay against a stub backend."""
+    service = make_service(layer={"tms_type": "google"})
+    entries = [parse_line("/c/tile.py/1.0.0/usstates/5/7/11.png")] * 2
+    with StubBackend() as stub:
+        results = replay(entries, local_runner(service, stub), concurrency=1)
+    assert stub.calls == 1
+    total = summarize(results)[-1]
+    assert total["requests"] == 2
+    assert total["hit"] == 50.0
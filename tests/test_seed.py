@@ -0,0 +1,128 @@
+"""Test the distributed seeding."""
+
+import pytest
+from pymemcache.test.utils import MockMemcacheClient
+
+from TileCache.Replay import StubBackend
+from TileCache.Seed import (
+    MemcachedLeases,
+    SQLiteLeases,
+    job_id,
+    progress,
+    run,
+    unit_tiles,
+    units,
+)
+
+
+@pytest.fixture
+def service(make_service):
+    """A service seeding a small layer into an in-memory cache."""
+    return make_service(layer={"tms_type": "google", "metasize": "2,2"})
+
+
+def test_units(service):
+    """Test that units are metatile aligned and cover the job once."""
+    layer = service.layers["usstates"]
+    assert list(units(layer, 2, size=(3, 3))) == [
+        (2, 0, 0),
+        (2, 3, 0),
+        (2, 0, 3),
+        (2, 3, 3),
+    ]
+    covered = [
+        (tile.x, tile.y)
+        for unit in units(layer, 2, size=(3, 3))
+        for tile in unit_tiles(layer, unit, size=(3, 3))
+    ]
+    assert sorted(covered) == [(x, y) for x in range(4) for y in range(4)]
+
+
+def test_sqlite_leases(tmp_path):
+    """Test claiming, expiry and resuming with two workers."""
+    path = str(tmp_path / "seed.sqlite")
+    one = SQLiteLeases(path, "job", ttl=300, owner="one")
+    two = SQLiteLeases(path, "job", ttl=300, owner="two")
+    assert one.claim((1, 0, 0))
+    assert not two.claim((1, 0, 0))
+    # the lease of a dead worker runs out
+    one.conn.execute("UPDATE leases SET expires = 0")
+    one.conn.commit()
+    assert two.claim((1, 0, 0))
+    two.finish((1, 0, 0))
+    assert one.isDone((1, 0, 0))
+    assert not one.claim((1, 0, 0))
+    assert not SQLiteLeases(path, "other").isDone((1, 0, 0))
+
+
+class CasClient(MockMemcacheClient):
+    """A mock memcached client that also does gets and cas."""
+
+    def __init__(self, *args, **kwargs):
+        super().__init__(*args, **kwargs)
+        self.versions = {}
+
+    def set(self, key, value, *args, **kwargs):
+        self.versions[key] = self.versions.get(key, 0) + 1
+        return super().set(key, value, *args, **kwargs)
+
+    def gets(self, key):
+        value = self.get(key)
+        return value, None if value is None else self.versions[key]
+
+    def cas(self, key, value, cas, expire=0, noreply=False):
+        if self.gets(key)[1] != cas:
+            return False
+        return self.set(key, value, expire)
+
+
+def test_memcached_leases():
+    """Test the leases kept in memcached."""
+    client = CasClient()
+    one = MemcachedLeases(client, "job", owner="one")
+    two = MemcachedLeases(client, "job", owner="two")
+    assert one.claim((1, 0, 0))
+    assert not two.claim((1, 0, 0))
+    two.release((1, 0, 0))
+    assert not two.claim((1, 0, 0))
+    one.release((1, 0, 0))
+    assert two.claim((1, 0, 0))
+    two.finish((1, 0, 0))
+    assert one.isDone((1, 0, 0))
+    assert not one.claim((1, 0, 0))
+
+
+def test_memcached_renew():
+    """Test that a lease is only renewed by the worker holding it."""
+    client = CasClient()
+    one = MemcachedLeases(client, "job", ttl=60, owner="one")
+    two = MemcachedLeases(client, "job", ttl=600, owner="two")
+    key = one.key((1, 0, 0))
+    assert one.claim((1, 0, 0))
+    one.renew((1, 0, 0))
+    assert client.get(key) == b"one"
+    # the lease of one expires and two takes the unit over
+    client.delete(key)
+    assert two.claim((1, 0, 0))
+    expires = client._contents[client.check_key(key)][0]
+    one.renew((1, 0, 0))
+    assert client.get(key) == b"two"
+    assert client._contents[client.check_key(key)][0] == expires
+
+
+def test_run(service, tmp_path):
+    """Test that a job is seeded once and resumes where it stopped."""
+    layer = service.layers["usstates"]
+    zooms = {0, 1, 2}
+    job = job_id(layer, zooms)
+    path = str(tmp_path / "seed.sqlite")
+    # another worker finished the bottom left unit of zoom 2 already
+    SQLiteLeases(path, job, owner="other").finish((2, 0, 0))
+    leases = SQLiteLeases(path, job)
+    assert progress(layer, zooms, leases) == (1, 6)
+    with StubBackend() as stub:
+        assert run(service, layer, zooms, leases, poll=0) == 1 + 4 + 12
+        assert stub.calls == 17
+        assert progress(layer, zooms, leases) == (6, 6)
+        assert run(service, layer, zooms, leases, poll=0) == 0
+        assert stub.calls == 17
@@ -1,12 +1,20 @@
 """Tests."""
 
 import os
+import subprocess
+import sys
+import time
+from datetime import datetime, timedelta, timezone
 
 import mock
 import pytest
 
 from TileCache import InvalidTMSRequest
-from TileCache.Service import Service, wsgiHandler
+from TileCache.base import Request, TileCacheException
+from TileCache.Layer import Tile
+from TileCache.Replay import StubBackend
+from TileCache.Service import QueryParams, Service, negotiate, wsgiHandler
+from TileCache.Services.TMS import TMS
 
 
 @pytest.fixture
@@ -102,3 +110,100 @@ def test_wsgi_handler(service):
     sr = mock.MagicMock()
     res = wsgiHandler(env, sr, service)
     assert res[0][:4] == b"\x89PNG"
+
+
+def test_lazy_layers(service):
+    """Test that layers are only built when first requested."""
+    assert "layer:usstates" not in service.timings
+    assert "usstates" in service.layers
+    layer = service.layers["usstates"]
+    assert service.layers["usstates"] is layer
+    assert "layer:usstates" in service.timings
+    assert "built=1" in service.startup_report()
+
+
+def test_light_import():
+    """Test that importing the service does not load Pillow or requests."""
+    code = (
+        "import sys, TileCache.Service; "
+        "print('PIL' in sys.modules, 'requests' in sys.modules)"
+    )
+    out = subprocess.check_output([sys.executable, "-c", code])
+    assert out.strip() == b"False False"
+
+
+def test_immutable_archive(service):
+    """Test that only settled archive timestamps are immutable."""
+    req = Request(service)
+    layer = req.getLayer("ridge::USCOMP-N0R-202001010000")
+    assert layer.immutable
+    assert service.cache.ttl(Tile(layer, 0, 0, 0)) == 0
+    assert not req.getLayer("ridge::USCOMP-N0R-0").immutable
+    recent = datetime.now(timezone.utc) - timedelta(minutes=10)
+    name = f"ridge::USCOMP-N0R-{recent:%Y%m%d%H%M}"
+    assert not req.getLayer(name).immutable
+    # the shared layer definition is left alone
+    assert not service.layers["ridge-composite-t-n0r"].immutable
+
+
+def test_tms_fast_path(service):
+    """Test that the fast and general paths agree."""
+    tms = TMS(service)
+    fast = tms.parse({}, "/1.0.0/usstates/5/7/11.png", "http://x")
+    slow = tms.parse({}, "//1.0.0/usstates/5.0/+7/11.33.png", "http://x")
+    assert (fast.x, fast.y, fast.z) == (slow.x, slow.y, slow.z) == (7, 20, 5)
+    with pytest.raises(TileCacheException):
+        tms.parse({}, "/1.0.0/usstates/{z}/7/11.png", "http://x")
+
+
+def test_query_params():
+    """Test that parameters come from the query string only for a GET."""
+    body = mock.MagicMock()
+    params = QueryParams(
+        {
+            "QUERY_STRING": "FORCE&type=google",
+            "REQUEST_METHOD": "GET",
+            "wsgi.input": body,
+        }
+    )
+    assert "FORCE" in params
+    assert params.get("type") == "google"
+    assert params.get("product") is None
+    body.read.assert_not_called()
+
+
+def test_negotiate():
+    """Test picking a variant from the Accept header."""
+    pytest.importorskip("PIL")
+    assert negotiate("image/avif,image/webp,*/*", ("webp",)) == "webp"
+    assert negotiate("image/webp;q=0, image/png", ("webp",)) is None
+    assert negotiate("*/*", ("webp",)) is None
+    assert negotiate("image/webp", ()) is None
+
+
+def test_webp_variant(make_service):
+    """Test that a webp variant is made once and then served."""
+    pytest.importorskip("PIL")
+    service = make_service(
+        layer={"variants": "webp"},
+        options={"optimize_workers": 1},
+        cache={"size": "4M", "item_size": "16K"},
+    )
+    path = "/1.0.0/usstates/0/0/0.png"
+    with StubBackend() as stub:
+        headers = []
+        fmt, _data = service.dispatchRequest(
+            {}, path, headers=headers, accept="image/webp,*/*"
+        )
+        assert fmt == "image/png"
+        assert ("Vary", "Accept") in headers
+        for _ in range(100):
+            if not service.background.pending():
+                break
+            time.sleep(0.1)
+        fmt, data = service.dispatchRequest({}, path, accept="image/webp")
+        assert fmt == "image/webp"
+        assert data[8:12] == b"WEBP"
+        fmt, _data = service.dispatchRequest({}, path, accept="image/png")
+        assert fmt == "image/png"
+    assert stub.calls == 1
@@ -0,0 +1,50 @@
+"""Test the SharedMemory cache."""
+
+import os
+
+from TileCache.Caches.SharedMemory import SharedMemory
+from TileCache.Layer import Layer, Tile
+
+
+def test_roundtrip(tmp_path):
+    """Test that we can store and read back a tile."""
+    cache = SharedMemory(path=str(tmp_path / "arena"), size="1M")
+    tile = Tile(Layer("test"), 1, 2, 3)
+    assert cache.get(tile) is None
+    cache.set(tile, b"\x89PNG")
+    assert cache.get(Tile(Layer("test"), 1, 2, 3)) == b"\x89PNG"
+    # A second mapping sees the same data
+    other = SharedMemory(path=str(tmp_path / "arena"), size="1M")
+    assert other.get(tile) == b"\x89PNG"
+
+
+def test_eviction(tmp_path):
+    """Test that a full set evicts an entry not recently used."""
+    cache = SharedMemory(
+        path=str(tmp_path / "arena"), size="300", ways=2, item_size="64"
+    )
+    assert cache.sets == 1
+    layer = Layer("test")
+    for x in range(2):
+        cache.set(Tile(layer, x, 0, 0), b"%d" % x)
+    # reference the first entry, so the second is the victim
+    assert cache.get(Tile(layer, 0, 0, 0)) == b"0"
+    cache.set(Tile(layer, 2, 0, 0), b"2")
+    assert cache.get(Tile(layer, 0, 0, 0)) == b"0"
+    assert cache.get(Tile(layer, 1, 0, 0)) is None
+    assert cache.get(Tile(layer, 2, 0, 0)) == b"2"
+
+
+def test_oversized(tmp_path):
+    """Test that a tile larger than a slot is passed through."""
+    cache = SharedMemory(path=str(tmp_path / "arena"), item_size="16")
+    tile = Tile(Layer("test"), 0, 0, 0)
+    assert cache.set(tile, b"x" * 17) == b"x" * 17
+    assert cache.get(tile) is None
+
+
+def test_config(tmp_path, make_service):
+    """Test that the cache can be picked from the config."""
+    service = make_service()
+    assert isinstance(service.cache, SharedMemory)
+    assert os.path.getsize(tmp_path / "arena") <= 1 << 20
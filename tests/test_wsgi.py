@@ -1,13 +1,17 @@
 """Run some WSGI tests via wuerkzeug."""
 
+import json
 import os
+import time
 from datetime import datetime, timedelta, timezone
 
 import pytest
+import requests
 from requests_mock import ANY
 from werkzeug.test import Client
 
 from TileCache import InvalidTMSRequest
+from TileCache.Layer import Tile, blank_png
 from TileCache.Service import Service, wsgiHandler
 
 
@@ -163,3 +167,123 @@ def test_250314_malformed(client):
     """Test handling of another malformed request."""
     with pytest.raises(InvalidTMSRequest):
         client.get("/1.0.0/profit2015/10/279/429.png/tile/10/429/279")
+
+
+def test_out_of_grid(client):
+    """Test that a tile outside of the grid is rejected."""
+    res = client.get("/1.0.0/profit2015/2/4/1.png")
+    assert res.status_code == 422
+    res = client.get("/1.0.0/profit2015/2/1/-1.png")
+    assert res.status_code == 422
+
+
+def test_outside_data_extent(client):
+    """Test that a tile outside the data extent gets a blank tile."""
+    res = client.get("/1.0.0/conus/5/16/10.png")
+    assert res.status_code == 200
+    assert res.data[:4] == b"\x89PNG"
+
+
+@pytest.fixture
+def overzoom_client(make_service):
+    """Return a client and service with an overzoom layer."""
+    service = make_service(layer={"tms_type": "google", "overzoom": 2})
+
+    def app(environ, start_response):
+        return wsgiHandler(environ, start_response, service)
+
+    return Client(app), service
+
+
+def test_overzoom(requests_mock, overzoom_client):
+    """Test that a failing backend is covered by an ancestor tile."""
+    pytest.importorskip("PIL")
+    client, service = overzoom_client
+    requests_mock.get(ANY, status_code=404)
+    res = client.get("/1.0.0/usstates/5/7/11.png")
+    assert res.status_code == 503
+    # cache the grandparent, y is flipped for google
+    layer = service.layers["usstates"]
+    service.cache.set(Tile(layer, 1, 5, 3), blank_png(256, 256))
+    res = client.get("/1.0.0/usstates/5/7/11.png")
+    assert res.status_code == 200
+    assert res.headers["X-TileCache-Overzoom"] == "2"
+    assert res.headers["Cache-Control"] == "max-age=60"
+
+
+def test_overzoom_refused(requests_mock, overzoom_client):
+    """Test that a backend refusing connections is covered too."""
+    pytest.importorskip("PIL")
+    client, service = overzoom_client
+    requests_mock.get(ANY, exc=requests.ConnectionError)
+    layer = service.layers["usstates"]
+    service.cache.set(Tile(layer, 3, 10, 4), blank_png(256, 256))
+    res = client.get("/1.0.0/usstates/5/7/11.png")
+    assert res.status_code == 200
+    assert res.headers["X-TileCache-Overzoom"] == "1"
+
+
+def test_overzoom_queue_full(requests_mock, make_service):
+    """Test that a full background queue serves the ancestor directly."""
+    pytest.importorskip("PIL")
+    service = make_service(
+        layer={"tms_type": "google", "overzoom": 2},
+        options={"background_queue": 0},
+    )
+    requests_mock.get(ANY, content=blank_png(256, 256))
+    layer = service.layers["usstates"]
+    service.cache.set(Tile(layer, 3, 10, 4), blank_png(256, 256))
+    client = Client(lambda e, s: wsgiHandler(e, s, service))
+    res = client.get("/1.0.0/usstates/5/7/11.png")
+    assert res.status_code == 200
+    assert res.headers["X-TileCache-Overzoom"] == "1"
+    assert requests_mock.call_count == 0
+
+
+def test_deadline(requests_mock, make_service):
+    """Test that a backend outlasting the deadline gets a fast 504."""
+    service = make_service(layer={"deadline": 0.1})
+
+    def slow(request, _context):
+        assert request.timeout <= 0.1
+        time.sleep(0.15)
+        raise requests.Timeout("read timed out")
+
+    requests_mock.get(ANY, content=slow)
+    client = Client(lambda e, s: wsgiHandler(e, s, service))
+    res = client.get("/1.0.0/usstates/5/7/11.png")
+    assert res.status_code == 504
+    assert requests_mock.call_count == 1
+
+
+def test_server_timing(requests_mock, make_service, capsys):
+    """Test the Server-Timing header and the slow request log."""
+    service = make_service(
+        options={
+            "server_timing": "yes",
+            "slow_request_ms": 20,
+            "slow_request_stacks": "yes",
+        }
+    )
+
+    def slow(_request, _context):
+        time.sleep(0.2)
+        return blank_png(256, 256)
+
+    requests_mock.get(ANY, content=slow, headers={"content-type": "image/png"})
+    client = Client(lambda e, s: wsgiHandler(e, s, service))
+    res = client.get("/1.0.0/usstates/5/7/11.png")
+    assert res.status_code == 200
+    timing = res.headers["Server-Timing"]
+    assert "parse;dur=" in timing and "backend;dur=" in timing
+    entry = json.loads(capsys.readouterr().err.strip().split("\n")[-1])
+    assert entry["slow_request"] == "/1.0.0/usstates/5/7/11.png"
+    assert entry["status"] == "200"
+    assert entry["tile"] == "5/7/11"
+    assert entry["cache"] == "miss"
+    assert entry["backend_attempts"] == 1
+    assert entry["stages"]["backend"] >= 200
+    assert any("fetchUrl" in frame for frame in entry["stacks"][0])
+    res = client.get("/1.0.0/usstates/5/7/11.png")
+    assert "backend" not in res.headers["Server-Timing"]
+    assert capsys.readouterr().err == ""